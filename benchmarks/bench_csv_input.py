@@ -0,0 +1,65 @@
+"""
+Time reading a directory of large CSV files with CSVInput: reading the lines
+of every sheet (with the configuration and headings, as unflatten does), and
+unflattening them. The CSV files are flattened from synthetic releases.
+
+    python benchmarks/bench_csv_input.py [--releases N]
+
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
+from flattentool.input import CSVInput
+from flattentool.json_input import JSONParser
+from flattentool.output import CSVOutput
+from flattentool.schema import SchemaParser
+
+from synthetic import SCHEMA, synthetic_release
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--releases', type=int, default=1000)
+    args = argument_parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    schema_parser = SchemaParser(schema_filename=SCHEMA)
+    schema_parser.parse()
+    root_json_dict = [synthetic_release(schema_parser.flattened, i) for i in range(args.releases)]
+    parser = JSONParser(root_json_dict=root_json_dict)
+    parser.parse()
+
+    input_dir = tempfile.mkdtemp()
+    try:
+        CSVOutput(parser=parser, output_name=input_dir).write_sheets()
+        del parser, root_json_dict
+        size = sum(os.path.getsize(os.path.join(input_dir, name)) for name in os.listdir(input_dir))
+        print('input:      {} files, {:.1f} MB'.format(len(os.listdir(input_dir)), size / 1e6))
+
+        start = time.time()
+        spreadsheet_input = CSVInput(input_name=input_dir, root_list_path='releases')
+        spreadsheet_input.read_sheets()
+        lines = 0
+        for sheet_name in spreadsheet_input.sub_sheet_names:
+            spreadsheet_input.get_sheet_headings(sheet_name)
+            for _ in spreadsheet_input.get_sheet_lines(sheet_name):
+                lines += 1
+        print('read lines: {:.3f} s ({} lines)'.format(time.time() - start, lines))
+
+        start = time.time()
+        spreadsheet_input = CSVInput(input_name=input_dir, root_list_path='releases')
+        spreadsheet_input.read_sheets()
+        spreadsheet_input.unflatten()
+        print('unflatten:  {:.3f} s'.format(time.time() - start))
+    finally:
+        shutil.rmtree(input_dir)
+
+
+if __name__ == '__main__':
+    main()
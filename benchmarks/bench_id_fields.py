@@ -0,0 +1,59 @@
+"""
+Time flattening synthetic releases, and count the memory allocations made.
+Counting allocations needs memray (Linux and macOS only), and is skipped if
+it isn't installed:
+
+    pip install memray
+    python benchmarks/bench_id_fields.py [--releases N]
+
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import tempfile
+import time
+import warnings
+
+from flattentool.json_input import JSONParser
+from flattentool.schema import SchemaParser
+
+from synthetic import SCHEMA, synthetic_release
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--releases', type=int, default=1000)
+    args = argument_parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    schema_parser = SchemaParser(schema_filename=SCHEMA, root_id='ocid')
+    schema_parser.parse()
+    root_json_dict = [synthetic_release(schema_parser.flattened, i) for i in range(args.releases)]
+
+    start = time.time()
+    parser = JSONParser(root_json_dict=root_json_dict, schema_parser=schema_parser, root_id='ocid')
+    parser.parse()
+    print('parse:        {:.3f} s'.format(time.time() - start))
+
+    try:
+        import memray
+    except ImportError:
+        print('allocations:  not counted, install memray with: pip install memray')
+        return
+
+    capture_dir = tempfile.mkdtemp()
+    capture_file = os.path.join(capture_dir, 'capture.bin')
+    try:
+        parser = JSONParser(root_json_dict=root_json_dict, schema_parser=schema_parser, root_id='ocid')
+        with memray.Tracker(capture_file, trace_python_allocators=True):
+            parser.parse()
+        total_allocations = memray.FileReader(capture_file).metadata.total_allocations
+    finally:
+        os.remove(capture_file)
+        os.rmdir(capture_dir)
+    print('allocations:  {} ({:.0f} per release)'.format(total_allocations, total_allocations / args.releases))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Time reading the same JSON input with each JSON decoder that is installed
+(see flattentool/decoders.py), and with json.load as flatten used it before
+there were decoders (OrderedDicts, and the garbage collector left running).
+Every decoder must give the same data.
+
+    python benchmarks/bench_json_decoders.py [--releases N] [--repeat N]
+
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import tempfile
+import time
+import warnings
+from collections import OrderedDict
+from decimal import Decimal
+
+from flattentool.decoders import DECODERS
+from flattentool.schema import SchemaParser
+
+from synthetic import SCHEMA, synthetic_release
+
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, Decimal):
+            return float(o)
+        return super(DecimalEncoder, self).default(o)
+
+
+def ordered_dict_load(json_file):
+    return json.load(io.TextIOWrapper(json_file, encoding='utf-8'), object_pairs_hook=OrderedDict,
+                     parse_float=Decimal)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--releases', type=int, default=2000)
+    argument_parser.add_argument('--repeat', type=int, default=3)
+    args = argument_parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    schema_parser = SchemaParser(schema_filename=SCHEMA)
+    schema_parser.parse()
+    releases = [synthetic_release(schema_parser.flattened, i) for i in range(args.releases)]
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as json_file:
+        json.dump({'releases': releases}, json_file, cls=DecimalEncoder)
+    del releases
+
+    loads = [('json.load (before)', ordered_dict_load)]
+    for name, decoder_class in DECODERS.items():
+        if decoder_class.available():
+            loads.append((name, decoder_class().load))
+        else:
+            print('{} is not installed'.format(name))
+
+    try:
+        print('{:.1f} MB'.format(os.path.getsize(json_file.name) / 1e6))
+        print('{:>18} {:>10}'.format('decoder', 'seconds'))
+        expected = None
+        for name, load in loads:
+            times = []
+            for _ in range(args.repeat):
+                with open(json_file.name, 'rb') as binary_file:
+                    start = time.time()
+                    data = load(binary_file)
+                    times.append(time.time() - start)
+            if expected is None:
+                expected = data
+            elif data != expected:
+                print('{} gave different data'.format(name))
+            del data
+            print('{:>18} {:>10.3f}'.format(name, min(times)))
+    finally:
+        os.remove(json_file.name)
+
+
+if __name__ == '__main__':
+    main()
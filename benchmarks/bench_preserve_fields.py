@@ -0,0 +1,52 @@
+"""
+Time flattening with --preserve-fields, as the number of preserved fields
+grows. The same 10 fields are present in the data each time, the rest are
+missing from it, so the output doesn't change and the time taken should
+stay roughly flat.
+
+    python benchmarks/bench_preserve_fields.py [--releases N]
+
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import tempfile
+import time
+import warnings
+
+from flattentool.json_input import JSONParser
+from flattentool.schema import SchemaParser
+
+from synthetic import SCHEMA, synthetic_release
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--releases', type=int, default=2000)
+    args = argument_parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    schema_parser = SchemaParser(schema_filename=SCHEMA)
+    schema_parser.parse()
+    root_json_dict = [synthetic_release(schema_parser.flattened, i) for i in range(args.releases)]
+
+    present_fields = ['ocid', 'id', 'date', 'tag', 'tender/id', 'tender/title', 'tender/items',
+                      'awards/id', 'awards/title', 'awards/value/amount']
+    missing_fields = ['missing{}/missing'.format(i) for i in range(1000)]
+
+    print('{:>16} {:>10}'.format('preserved fields', 'seconds'))
+    for count in (10, 30, 100, 300, 1000):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as preserve_fields_file:
+            preserve_fields_file.write('\n'.join(present_fields + missing_fields[:count - 10]))
+        try:
+            start = time.time()
+            parser = JSONParser(root_json_dict=root_json_dict, preserve_fields=preserve_fields_file.name)
+            parser.parse()
+            print('{:>16} {:>10.3f}'.format(count, time.time() - start))
+        finally:
+            os.remove(preserve_fields_file.name)
+
+
+if __name__ == '__main__':
+    main()
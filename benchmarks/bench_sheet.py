@@ -0,0 +1,60 @@
+"""
+Time flattening synthetic releases into sheets and writing them out as CSV,
+and measure the memory used by the sheets' lines.
+
+    python benchmarks/bench_sheet.py [--releases N]
+
+"""
+from __future__ import print_function
+
+import argparse
+import shutil
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+from flattentool.json_input import JSONParser
+from flattentool.output import CSVOutput
+from flattentool.schema import SchemaParser
+
+from synthetic import SCHEMA, synthetic_release
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--releases', type=int, default=5000)
+    args = argument_parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    schema_parser = SchemaParser(schema_filename=SCHEMA)
+    schema_parser.parse()
+    root_json_dict = [synthetic_release(schema_parser.flattened, i) for i in range(args.releases)]
+
+    start = time.time()
+    parser = JSONParser(root_json_dict=root_json_dict)
+    parser.parse()
+    print('parse:      {:.3f} s'.format(time.time() - start))
+
+    output_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        CSVOutput(parser=parser, output_name=output_dir).write_sheets()
+        print('write CSV:  {:.3f} s'.format(time.time() - start))
+    finally:
+        shutil.rmtree(output_dir)
+
+    del parser
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    parser = JSONParser(root_json_dict=root_json_dict)
+    parser.parse()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    lines = len(parser.main_sheet.lines) + sum(len(sheet.lines) for sheet in parser.sub_sheets.values())
+    columns = len(list(parser.main_sheet)) + sum(len(list(sheet)) for sheet in parser.sub_sheets.values())
+    print('sheets:     {} lines, {} columns, {:.1f} MB'.format(lines, columns, (after - before) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Measure the peak memory (RSS) and time of unflattening a CSV file: without
+source maps (which builds the values directly), with the tree of cells that
+unflatten built before and then took the values from, and with the cell
+source map. Each measurement is made in a process of its own.
+
+    python benchmarks/bench_unflatten_memory.py [--rows N] [--columns N]
+
+Unix only (uses the resource module).
+
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from flattentool.input import CSVInput, extract_list_to_value
+
+
+def unflatten_values(spreadsheet_input):
+    spreadsheet_input.unflatten()
+
+
+def unflatten_cells(spreadsheet_input):
+    # As unflatten was before it built the values directly
+    extract_list_to_value(spreadsheet_input.do_unflatten())
+
+
+def unflatten_source_map(spreadsheet_input):
+    spreadsheet_input.fancy_unflatten(with_cell_source_map=True, with_heading_source_map=False)
+
+
+UNFLATTENS = {
+    'values': unflatten_values,
+    'cells (before)': unflatten_cells,
+    'cell source map': unflatten_source_map,
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1e6 if sys.platform == 'darwin' else 1e3)
+
+
+def make_csv(filename, rows, columns):
+    with open(filename, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['id'] + ['items/0/column{}'.format(column) for column in range(1, columns)])
+        for number in range(rows):
+            writer.writerow([str(number)] + ['value {}'.format(number % 1000)] * (columns - 1))
+
+
+def unflatten(unflatten_name, input_dir):
+    start = time.time()
+    spreadsheet_input = CSVInput(input_name=input_dir)
+    spreadsheet_input.read_sheets()
+    UNFLATTENS[unflatten_name](spreadsheet_input)
+    print(peak_rss_mb(), time.time() - start)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--rows', type=int, default=200000)
+    argument_parser.add_argument('--columns', type=int, default=10)
+    argument_parser.add_argument('--measure', nargs=2, help=argparse.SUPPRESS)
+    args = argument_parser.parse_args()
+
+    if args.measure:
+        unflatten(*args.measure)
+        return
+
+    input_dir = tempfile.mkdtemp()
+    try:
+        make_csv(os.path.join(input_dir, 'main.csv'), args.rows, args.columns)
+        print('{:>16} {:>14} {:>10}'.format('unflatten', 'peak RSS (MB)', 'seconds'))
+        for unflatten_name in UNFLATTENS:
+            peak, seconds = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__), '--measure', unflatten_name, input_dir]).split()
+            print('{:>16} {:>14.1f} {:>10.2f}'.format(unflatten_name, float(peak), float(seconds)))
+    finally:
+        shutil.rmtree(input_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Measure the peak memory (RSS) and time of unflattening an XLSX file with
+XLSXInput (which opens the workbook read-only and streams each sheet), and
+with the workbook loaded in full, as it was before. The sheet has data in its
+first rows, and empty formatted cells below them to the given row (as when a
+sheet is formatted to the end), which are read but not returned. Each
+measurement is made in a process of its own.
+
+    python benchmarks/bench_xlsx_input.py [--rows N] [--formatted-to N] [--columns N]
+
+Unix only (uses the resource module).
+
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import openpyxl
+
+from flattentool.input import XLSXInput
+
+
+class FullXLSXInput(XLSXInput):
+    # As XLSXInput was before it opened the workbook read-only
+    read_only = False
+
+
+INPUTS = {
+    'read-only': XLSXInput,
+    'full (before)': FullXLSXInput,
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1e6 if sys.platform == 'darwin' else 1e3)
+
+
+def make_workbook(filename, rows, formatted_to, columns):
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet('main')
+    worksheet.append(['id'] + ['column{}'.format(column) for column in range(1, columns)])
+    for number in range(rows):
+        worksheet.append([str(number)] + ['value {}'.format(number % 1000)] * (columns - 1))
+    bold = openpyxl.cell.WriteOnlyCell(worksheet, value=None)
+    bold.font = openpyxl.styles.Font(bold=True)
+    for _ in range(rows + 2, formatted_to + 1):
+        worksheet.append([bold] * columns)
+    workbook.save(filename)
+
+
+def unflatten(input_name, filename):
+    start = time.time()
+    spreadsheet_input = INPUTS[input_name](input_name=filename)
+    spreadsheet_input.read_sheets()
+    spreadsheet_input.unflatten()
+    print(peak_rss_mb(), time.time() - start)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--rows', type=int, default=10000)
+    argument_parser.add_argument('--formatted-to', type=int, default=200000)
+    argument_parser.add_argument('--columns', type=int, default=10)
+    argument_parser.add_argument('--measure', nargs=2, help=argparse.SUPPRESS)
+    args = argument_parser.parse_args()
+
+    if args.measure:
+        unflatten(*args.measure)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix='.xlsx') as xlsx_file:
+        make_workbook(xlsx_file.name, args.rows, args.formatted_to, args.columns)
+        print('{:>16} {:>14} {:>10}'.format('input', 'peak RSS (MB)', 'seconds'))
+        for input_name in INPUTS:
+            peak, seconds = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__), '--measure', input_name, xlsx_file.name]).split()
+            print('{:>16} {:>14.1f} {:>10.2f}'.format(input_name, float(peak), float(seconds)))
+
+
+if __name__ == '__main__':
+    main()
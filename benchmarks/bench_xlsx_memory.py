@@ -0,0 +1,92 @@
+"""
+Measure the peak memory (RSS) and time of writing XLSX output of an
+increasing number of rows, with XLSXOutput (a write-only workbook), with the
+in-memory workbook it used before, and with NativeXLSXOutput. Rows are
+made as they are written, so only the writer's memory grows with the number
+of rows. Each measurement is made in a process of its own.
+
+    python benchmarks/bench_xlsx_memory.py [--rows N [N ...]] [--columns N]
+
+Unix only (uses the resource module).
+
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+import openpyxl
+
+from flattentool.output import NativeXLSXOutput, XLSXOutput
+
+
+class InMemoryXLSXOutput(XLSXOutput):
+    # As XLSXOutput was before it used a write-only workbook
+    def open(self):
+        super(InMemoryXLSXOutput, self).open()
+        self.workbook = openpyxl.Workbook()
+
+    def close(self):
+        self.workbook.remove(self.workbook.active)
+        super(InMemoryXLSXOutput, self).close()
+
+
+OUTPUTS = {
+    'write-only': XLSXOutput,
+    'in-memory (before)': InMemoryXLSXOutput,
+    'native': NativeXLSXOutput,
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1e6 if sys.platform == 'darwin' else 1e3)
+
+
+def write(output_name, rows, columns):
+    output_class = OUTPUTS[output_name]
+    start = time.time()
+    with tempfile.NamedTemporaryFile(suffix='.xlsx') as xlsx_file:
+        spreadsheet_output = output_class(parser=None, output_name=xlsx_file.name)
+        spreadsheet_output.open()
+        write_row = spreadsheet_output.start_sheet_parts(
+            'main', ['column{}'.format(column) for column in range(columns)])
+        for number in range(rows):
+            write_row([
+                'value {}'.format(number % 1000) if column % 2 else Decimal(number) / 100
+                for column in range(columns)
+            ])
+        write_row.end()
+        spreadsheet_output.close()
+    print(peak_rss_mb(), time.time() - start)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--rows', type=int, nargs='+', default=[10000, 50000, 200000])
+    argument_parser.add_argument('--columns', type=int, default=20)
+    argument_parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = argument_parser.parse_args()
+
+    if args.measure:
+        write(args.measure, args.rows[0], args.columns)
+        return
+
+    print('{:>20} {:>10} {:>14} {:>10}'.format('output', 'rows', 'peak RSS (MB)', 'seconds'))
+    for output_name in OUTPUTS:
+        for rows in args.rows:
+            peak, seconds = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__), '--measure', output_name,
+                '--rows', str(rows), '--columns', str(args.columns)]).split()
+            print('{:>20} {:>10} {:>14.1f} {:>10.2f}'.format(output_name, rows, float(peak), float(seconds)))
+
+
+if __name__ == '__main__':
+    main()
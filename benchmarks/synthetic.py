@@ -0,0 +1,48 @@
+"""
+Synthetic data for the benchmarks.
+
+"""
+import os
+from collections import OrderedDict
+from decimal import Decimal
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'flattentool', 'tests', 'fixtures', 'release-schema.json')
+
+VALUES = {
+    'string': 'value',
+    'number': Decimal('1.5'),
+    'integer': 1,
+    'boolean': True,
+    'string_array': ['a', 'b'],
+    'number_array': [1, 2],
+}
+
+
+def synthetic_release(flattened, number):
+    """
+    Return a release with a value for every field in flattened (the
+    flattened attribute of a SchemaParser), where each array of objects has
+    two objects.
+
+    """
+    release = OrderedDict()
+    for path, field_type in flattened.items():
+        if field_type in ('object', 'array', 'array_array'):
+            continue
+        parts = path.split('/')
+        targets = [release]
+        for depth, part in enumerate(parts[:-1]):
+            container_type = flattened.get('/'.join(parts[:depth + 1]))
+            new_targets = []
+            for target in targets:
+                if container_type == 'array':
+                    items = target.setdefault(part, [OrderedDict([('id', '1')]), OrderedDict([('id', '2')])])
+                    new_targets.extend(items)
+                else:
+                    new_targets.append(target.setdefault(part, OrderedDict()))
+            targets = new_targets
+        for target in targets:
+            target[parts[-1]] = VALUES[field_type]
+    release['ocid'] = 'ocds-{}'.format(number)
+    release['id'] = str(number)
+    return release
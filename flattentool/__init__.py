@@ -1,13 +1,19 @@
+from flattentool.compression import STDIN, seekable_input
+from flattentool.incremental import FingerprintStore
 from flattentool.schema import SchemaParser
 from flattentool.json_input import JSONParser
 from flattentool.output import FORMATS as OUTPUT_FORMATS
-from flattentool.output import FORMATS_SUFFIX
+from flattentool.output import ALL_FORMATS, FORMATS_SUFFIX, PartitionedOutput, write_outputs, write_sheets_streaming
 from flattentool.input import FORMATS as INPUT_FORMATS
 from flattentool.xml_output import toxml
-from flattentool.lib import parse_sheet_configuration
+from flattentool.lib import RawNumberEncoder, parse_sheet_configuration
 import sys
+import os
+import glob
 import json
 import codecs
+import six
+from warnings import warn
 from decimal import Decimal
 from collections import OrderedDict
 
@@ -37,8 +43,8 @@ def create_template(schema, output_name=None, output_format='all', main_sheet_na
     if output_format == 'all':
         if not output_name:
             output_name = 'template'
-        for format_name, spreadsheet_output_class in OUTPUT_FORMATS.items():
-            spreadsheet_output(spreadsheet_output_class, output_name+FORMATS_SUFFIX[format_name])
+        for format_name in ALL_FORMATS:
+            spreadsheet_output(OUTPUT_FORMATS[format_name], output_name+FORMATS_SUFFIX[format_name])
 
     elif output_format in OUTPUT_FORMATS.keys():   # in dictionary of allowed formats
         if not output_name:
@@ -49,10 +55,32 @@ def create_template(schema, output_name=None, output_format='all', main_sheet_na
         raise Exception('The requested format is not available')
 
 
+def input_names(input_name):
+    """
+    Return the list of input files given by input_name, a file name, a glob
+    pattern, or a list of these.
+
+    """
+    if isinstance(input_name, six.string_types):
+        input_name = [input_name]
+    names = []
+    for name in input_name:
+        if not os.path.exists(name) and glob.has_magic(name):
+            # If nothing matches, keep the pattern for the error
+            names.extend(sorted(glob.glob(name)) or [name])
+        else:
+            names.append(name)
+    return names
+
+
 def flatten(input_name, schema=None, output_name=None, output_format='all', main_sheet_name='main',
             root_list_path='main', root_is_list=False, sheet_prefix='', filter_field=None, filter_value=None,
             preserve_fields=None, rollup=False, root_id=None, use_titles=False, xml=False, id_name='id',
-            disable_local_refs=False, remove_empty_schema_columns=False, truncation_length=3, **_):
+            disable_local_refs=False, remove_empty_schema_columns=False, truncation_length=3, streaming=False,
+            streaming_output=False, workers=1, xml_schemas=None, filters=None,
+            id_list=None, source_file_column=None, json_lines=False, csv_compression=None, json_decoder='stdlib',
+            raw_numbers=False, incremental_state=None, max_rows=None, partition_by=None, partitions=None,
+            output_threads=1, **_):
     """
     Flatten a nested structure (JSON) to a flat structure (spreadsheet - csv or xlsx).
 
@@ -61,6 +89,38 @@ def flatten(input_name, schema=None, output_name=None, output_format='all', main
     if (filter_field is None and filter_value is not None) or (filter_field is not None and filter_value is None):
         raise Exception('You must use filter_field and filter_value together')
 
+    if streaming_output and (streaming or json_lines) and STDIN in input_names(input_name):
+        # Checked before any output is written
+        raise Exception("Standard input can only be read once, but --streaming-output reads streamed input more "
+                        "than once. Save the input to a file first.")
+
+    if partitions and not partition_by:
+        partition_by = root_id or id_name
+
+    if incremental_state:
+        if output_format != 'csv' or csv_compression or streaming_output or max_rows or partition_by:
+            raise Exception('Incremental flatten only works with uncompressed csv output, without streaming, '
+                            'partitioned or row-capped output')
+        if workers > 1:
+            warn('Incremental flatten only uses one worker')
+        if not output_name:
+            output_name = 'flattened'
+        incremental = FingerprintStore(
+            incremental_state,
+            output_name,
+            settings=dict(
+                input_format='xml' if xml else 'json', schema=schema, root_list_path=root_list_path,
+                root_is_list=root_is_list, filter_field=filter_field, filter_value=filter_value,
+                preserve_fields=preserve_fields, rollup=rollup, root_id=root_id, use_titles=use_titles,
+                id_name=id_name, disable_local_refs=disable_local_refs,
+                remove_empty_schema_columns=remove_empty_schema_columns, truncation_length=truncation_length,
+                filters=filters, id_list=id_list, source_file_column=source_file_column, raw_numbers=raw_numbers,
+            ),
+            main_sheet_name=main_sheet_name,
+            sheet_prefix=sheet_prefix)
+    else:
+        incremental = None
+
     if schema:
         schema_parser = SchemaParser(
             schema_filename=schema,
@@ -68,13 +128,14 @@ def flatten(input_name, schema=None, output_name=None, output_format='all', main
             root_id=root_id,
             use_titles=use_titles,
             disable_local_refs=disable_local_refs,
-            truncation_length=truncation_length)
+            truncation_length=truncation_length,
+            json_decoder=json_decoder)
         schema_parser.parse()
     else:
         schema_parser = None
 
     parser = JSONParser(
-        json_filename=input_name,
+        json_filename=input_names(input_name),
         root_list_path=None if root_is_list else root_list_path,
         schema_parser=schema_parser,
         rollup=rollup,
@@ -86,22 +147,47 @@ def flatten(input_name, schema=None, output_name=None, output_format='all', main
         filter_value=filter_value,
         preserve_fields=preserve_fields,
         remove_empty_schema_columns=remove_empty_schema_columns,
-        truncation_length=truncation_length)
-    parser.parse()
+        truncation_length=truncation_length,
+        streaming=streaming,
+        workers=workers,
+        xml_schemas=xml_schemas,
+        filters=filters,
+        id_list=id_list,
+        source_file_column=source_file_column,
+        json_lines=json_lines,
+        json_decoder=json_decoder,
+        raw_numbers=raw_numbers,
+        incremental=incremental,
+        partition_by=partition_by)
+
+    if incremental:
+        parser.parse()
+        incremental.write(parser)
+        return
+
+    spreadsheet_outputs = []
 
     def spreadsheet_output(spreadsheet_output_class, name):
-        spreadsheet_output = spreadsheet_output_class(
+        options = {}
+        if csv_compression and spreadsheet_output_class is OUTPUT_FORMATS['csv']:
+            options['compression'] = csv_compression
+        if max_rows:
+            options['max_rows'] = max_rows
+        if partition_by:
+            options.update(output_class=spreadsheet_output_class, partitions=partitions)
+            spreadsheet_output_class = PartitionedOutput
+        spreadsheet_outputs.append(spreadsheet_output_class(
             parser=parser,
             main_sheet_name=main_sheet_name,
             output_name=name,
-            sheet_prefix=sheet_prefix)
-        spreadsheet_output.write_sheets()
+            sheet_prefix=sheet_prefix,
+            **options))
 
     if output_format == 'all':
         if not output_name:
             output_name = 'flattened'
-        for format_name, spreadsheet_output_class in OUTPUT_FORMATS.items():
-            spreadsheet_output(spreadsheet_output_class, output_name+FORMATS_SUFFIX[format_name])
+        for format_name in ALL_FORMATS:
+            spreadsheet_output(OUTPUT_FORMATS[format_name], output_name+FORMATS_SUFFIX[format_name])
 
     elif output_format in OUTPUT_FORMATS.keys():   # in dictionary of allowed formats
         if not output_name:
@@ -111,6 +197,17 @@ def flatten(input_name, schema=None, output_name=None, output_format='all', main
     else:
         raise Exception('The requested format is not available')
 
+    if streaming_output:
+        # With a schema the columns are already known, unless they are going
+        # to be removed. Standard output can't be written again if the data
+        # turns out to have others.
+        write_sheets_streaming(parser, spreadsheet_outputs,
+                               single_pass=bool(schema_parser) and not remove_empty_schema_columns
+                               and output_name != STDIN)
+    else:
+        parser.parse()
+        write_outputs(spreadsheet_outputs, threads=output_threads)
+
 
 # From http://bugs.python.org/issue16535
 class NumberStr(float):
@@ -148,6 +245,7 @@ def unflatten(input_name, base_json=None, input_format=None, output_name=None,
               disable_local_refs=False,
               xml_comment=None,
               truncation_length=3,
+              raw_numbers=False,
               **_):
     """
     Unflatten a flat structure (spreadsheet - csv or xlsx) into a nested structure (JSON).
@@ -159,6 +257,10 @@ def unflatten(input_name, base_json=None, input_format=None, output_name=None,
         raise Exception('The requested format is not available')
     if metatab_name and base_json:
         raise Exception('Not allowed to use base_json with metatab')
+    if input_name == STDIN:
+        # The spreadsheet may be read more than once (e.g. for the metatab),
+        # and XLSX and zip files have to be read from the end.
+        input_name = seekable_input(input_name)
 
     if root_is_list:
         base = None
@@ -187,7 +289,8 @@ def unflatten(input_name, base_json=None, input_format=None, output_name=None,
             vertical_orientation=metatab_vertical_orientation,
             id_name=id_name,
             xml=xml,
-            use_configuration=False
+            use_configuration=False,
+            raw_numbers=raw_numbers
         )
         if metatab_schema:
             parser = SchemaParser(schema_filename=metatab_schema, disable_local_refs=disable_local_refs)
@@ -230,7 +333,8 @@ def unflatten(input_name, base_json=None, input_format=None, output_name=None,
             vertical_orientation=vertical_orientation,
             id_name=id_name,
             xml=xml,
-            base_configuration=base_configuration
+            base_configuration=base_configuration,
+            raw_numbers=raw_numbers
         )
         if schema:
             parser = SchemaParser(schema_filename=schema, rollup=True, root_id=root_id,
@@ -250,6 +354,9 @@ def unflatten(input_name, base_json=None, input_format=None, output_name=None,
         else:
             base[root_list_path] = list(result)
 
+    json_options = dict(indent=4, default=decimal_default, ensure_ascii=False)
+    if raw_numbers:
+        json_options['cls'] = RawNumberEncoder
     if xml:
         xml_root_tag = base_configuration.get('XMLRootTag', 'iati-activities')
         xml_output = toxml(
@@ -264,13 +371,13 @@ def unflatten(input_name, base_json=None, input_format=None, output_name=None,
                 fp.write(xml_output)
     else:
         if output_name is None:
-            print(json.dumps(base, indent=4, default=decimal_default, ensure_ascii=False))
+            print(json.dumps(base, **json_options))
         else:
             with codecs.open(output_name, 'w', encoding='utf-8') as fp:
-                json.dump(base, fp, indent=4, default=decimal_default, ensure_ascii=False)
+                json.dump(base, fp, **json_options)
     if cell_source_map:
         with codecs.open(cell_source_map, 'w', encoding='utf-8') as fp:
-            json.dump(cell_source_map_data, fp, indent=4, default=decimal_default, ensure_ascii=False)
+            json.dump(cell_source_map_data, fp, **json_options)
     if heading_source_map:
         with codecs.open(heading_source_map, 'w', encoding='utf-8') as fp:
-            json.dump(heading_source_map_data, fp, indent=4, default=decimal_default, ensure_ascii=False)
+            json.dump(heading_source_map_data, fp, **json_options)
@@ -7,6 +7,7 @@ import sys
 from six import text_type
 
 from flattentool import create_template, unflatten, flatten
+from flattentool.decoders import DECODERS
 from flattentool.input import FORMATS as INPUT_FORMATS
 from flattentool.output import FORMATS as OUTPUT_FORMATS
 from flattentool.json_input import BadlyFormedJSONError
@@ -90,7 +91,8 @@ def create_parser():
         help='Flatten a JSON file')
     parser_flatten.add_argument(
         'input_name',
-        help="Name of the input JSON file.")
+        nargs='+',
+        help="Name of the input JSON file, or - for standard input. It can be compressed with gzip, bzip2 or xz, or be in a zip file on its own. More than one file, or a glob pattern (e.g. 'packages/*.json', quoted so that the shell doesn't expand it), can be given, and all the data is flattened into the same sheets.")
     parser_flatten.add_argument(
         "-s", "--schema",
         help="Path to a relevant schema.")
@@ -102,6 +104,18 @@ def create_parser():
         "--xml",
         action='store_true',
         help="Use XML as the input format")
+    parser_flatten.add_argument(
+        "--json-lines",
+        action='store_true',
+        help="The input is JSON Lines, one JSON object per line, which is read a line at a time. Each line is an item of the root list, so --root-list-path is ignored.")
+    parser_flatten.add_argument(
+        "--json-decoder",
+        choices=list(DECODERS),
+        help="The library used to read JSON input and schemas (not with --streaming). Numbers are kept exact with each of them. Defaults to stdlib, Python's json module. rapidjson needs python-rapidjson installed, otherwise stdlib is used.")
+    parser_flatten.add_argument(
+        "--raw-numbers",
+        action='store_true',
+        help="Keep numbers as the text they are written as in the input, and write them to CSV unchanged, instead of reading them as decimals. Not used with --streaming.")
     parser_flatten.add_argument(
         "--id-name",
         help="String to use for the identifier key, defaults to 'id'")
@@ -111,6 +125,10 @@ def create_parser():
     parser_flatten.add_argument(
         "-o", "--output-name",
         help="Name of the outputted file. Will have an extension appended if format is all.")
+    parser_flatten.add_argument(
+        "--csv-compression",
+        choices=['gzip', 'zip'],
+        help="Compress the CSV output: gzip each CSV file, or write them all into one zip file (with .zip added to the output name) instead of a directory. With zip, an output name of - writes the zip file to standard output.")
     parser_flatten.add_argument(
         "--root-list-path",
         help="Path of the root list, defaults to main")
@@ -144,6 +162,16 @@ def create_parser():
     parser_flatten.add_argument(
         "--filter-value",
         help="Data Filter - only data with this will be processed. Use with --filter-field")
+    parser_flatten.add_argument(
+        "--filter",
+        dest='filters',
+        nargs=3,
+        action='append',
+        metavar=('PATH', 'OPERATOR', 'VALUE'),
+        help="Data Filter - only data where the value at PATH (e.g. buyer/id) matches will be processed. OPERATOR is one of eq, in (VALUE is a comma separated list), prefix, from or to (compared to the precision of VALUE, e.g. a date). Can be given more than once, and all must match.")
+    parser_flatten.add_argument(
+        "--id-list",
+        help="Data Filter - only data with these ids will be processed. Pass a file with one id per line. Ids are matched on --root-id if given, otherwise on --id-name. Ids that are not found are reported.")
     parser_flatten.add_argument(
         "--preserve-fields",
         help="Only these fields will be processed. Pass a file with JSON paths to be preserved one per line.")
@@ -155,13 +183,54 @@ def create_parser():
         "--remove-empty-schema-columns",
         action='store_true',
         help="When using flatten with a schema, remove columns and sheets from the output that contain no data.")
+    parser_flatten.add_argument(
+        "--streaming",
+        action='store_true',
+        help="Read the input JSON file incrementally, one item of the root list at a time, instead of loading it all into memory. Requires the ijson package. With --xml, the file is read with lxml's iterparse, and is read twice to find which elements are lists, unless --xml-schema is given.")
+    parser_flatten.add_argument(
+        "--streaming-output",
+        action='store_true',
+        help="Write each row to the output as soon as it is produced, instead of keeping all rows in memory. The input is read twice, first to find the columns, unless a schema is given and --remove-empty-schema-columns is not used.")
+    parser_flatten.add_argument(
+        "--workers",
+        type=int,
+        help="The number of processes to flatten with (default 1). The root list is split into chunks that are flattened in parallel, or, with more than one input file, the files are read and flattened in parallel.")
+    parser_flatten.add_argument(
+        "--source-file-column",
+        help="Add a column with this name to every sheet, giving the input file that each row came from.")
+    parser_flatten.add_argument(
+        "--output-threads",
+        type=int,
+        help="The number of threads to write the output with (default 1). The CSV and XLSX output (with --output-format all) are written at the same time, as are the CSV files of each sheet. Not used with --streaming-output.")
+    parser_flatten.add_argument(
+        "--max-rows",
+        type=int,
+        help="The most rows a sheet can have (not counting the header). Further rows are written to more parts of the sheet, named with _2, _3... added. XLSX sheets are always split at Excel's limit of 1048575 rows.")
+    parser_flatten.add_argument(
+        "--partition-by",
+        metavar='PATH',
+        help="Split the output into partitions, one directory of CSV files or XLSX workbook each, by the value at PATH (e.g. buyer/id) in each item of the root list. The partition is added to the output name.")
+    parser_flatten.add_argument(
+        "--partitions",
+        type=int,
+        help="Split the output into this number of partitions by the hash of the value at --partition-by (by default --root-id, or --id-name).")
+    parser_flatten.add_argument(
+        "--incremental-state",
+        metavar='STATE_FILE',
+        help="Flatten incrementally: only records (matched on --root-id and --id-name) that are new or have changed since the last run with the same state file are flattened, and the CSV output is updated in place. The state is saved in STATE_FILE. Requires --output-format csv.")
+    parser_flatten.add_argument(
+        "--xml-schema",
+        dest='xml_schemas',
+        metavar='XML_SCHEMA',
+        nargs='*',
+        help="Path to one or more XML schemas. With --xml and --streaming, elements that can be repeated according to the schemas are treated as lists.")
 
     parser_unflatten = subparsers.add_parser(
         'unflatten',
         help='Unflatten a spreadsheet')
     parser_unflatten.add_argument(
         'input_name',
-        help="Name of the input file or directory.")
+        help="Name of the input file or directory, or - for standard input. For csv, a zip file of CSV files can be given instead of a directory, and the CSV files can be compressed with gzip, bzip2 or xz.")
     parser_unflatten.add_argument(
         "-f", "--input-format",
         help="File format of input file or directory.",
@@ -171,6 +240,10 @@ def create_parser():
         "--xml",
         action='store_true',
         help="Use XML as the output format")
+    parser_unflatten.add_argument(
+        "--raw-numbers",
+        action='store_true',
+        help="Write the numbers in number columns (according to the schema) to JSON as they are written in the input, instead of converting them to decimals. Numbers that aren't written as JSON would write them are still converted.")
     parser_unflatten.add_argument(
         "--id-name",
         help="String to use for the identifier key, defaults to 'id'")
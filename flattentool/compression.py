@@ -0,0 +1,330 @@
+"""
+Reading compressed input files (and standard input), and writing compressed
+output in a background thread.
+
+"""
+
+import bz2
+import gzip
+import io
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
+import zlib
+
+import six
+from six.moves import queue
+
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
+
+STDIN = '-'
+
+# The first bytes of files of each compression
+MAGIC_NUMBERS = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'PK\x03\x04', 'zip'),
+]
+
+# Standard input streams that have been read, as they can't be read again
+read_stdin = weakref.WeakSet()
+
+
+def stdin_buffer():
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    if stdin in read_stdin:
+        raise ValueError(
+            "Standard input can only be read once, but it's needed again (e.g. for --streaming-output, or "
+            "streaming XML without --xml-schema). Save the input to a file first.")
+    read_stdin.add(stdin)
+    return stdin
+
+
+def compression_of(binary_file):
+    """
+    Return the compression of binary_file (one of those in MAGIC_NUMBERS),
+    or None, by peeking at its first bytes.
+
+    """
+    start = binary_file.peek(6)[:6]
+    for magic_number, compression in MAGIC_NUMBERS:
+        if start.startswith(magic_number):
+            return compression
+    return None
+
+
+def decompressed(binary_file, filename=None):
+    """
+    Return binary_file, or if it's compressed with gzip, bzip2 or xz, a file
+    that decompresses it as it's read. If the filename of binary_file is
+    given, the file is opened again by name, so that closing the returned
+    file closes it.
+
+    """
+    compression = compression_of(binary_file)
+    if compression in (None, 'zip'):
+        return binary_file
+    if filename is not None:
+        binary_file.close()
+        binary_file = filename
+    if compression == 'gzip':
+        if filename is not None:
+            return gzip.GzipFile(filename, 'rb')
+        return gzip.GzipFile(fileobj=binary_file)
+    elif compression == 'bz2':
+        return bz2.BZ2File(binary_file)
+    if lzma is None:
+        raise ValueError('xz compressed input requires Python 3')
+    return lzma.LZMAFile(binary_file)
+
+
+def seekable_input(filename):
+    """
+    Return filename, or if it's '-', a temporary file with the contents of
+    standard input, for input that can't be read as a stream (e.g. zip
+    files, which are read from the end) or is read more than once.
+
+    """
+    if filename != STDIN:
+        return filename
+    spooled_file = tempfile.TemporaryFile()
+    shutil.copyfileobj(stdin_buffer(), spooled_file)
+    spooled_file.seek(0)
+    return spooled_file
+
+
+def open_input(filename):
+    """
+    Open filename for reading in binary mode, or standard input if it's '-'.
+
+    Files compressed with gzip, bzip2 or xz, or zip files containing one
+    file, are decompressed as they are read (whatever they are named).
+
+    """
+    if filename == STDIN:
+        binary_file = stdin_buffer()
+        if not hasattr(binary_file, 'peek'):
+            binary_file = io.BufferedReader(binary_file)
+    else:
+        binary_file = io.open(filename, 'rb')
+    if compression_of(binary_file) != 'zip':
+        return decompressed(binary_file, filename=None if filename == STDIN else filename)
+
+    if filename == STDIN:
+        # Zip files are read from the end, so standard input is copied first
+        spooled_file = tempfile.TemporaryFile()
+        shutil.copyfileobj(binary_file, spooled_file)
+        spooled_file.seek(0)
+        binary_file = spooled_file
+    zip_file = zipfile.ZipFile(binary_file)
+    names = [info.filename for info in zip_file.infolist() if not info.filename.endswith('/')]
+    if len(names) != 1:
+        zip_file.close()
+        raise ValueError('A zip file input must contain exactly one file, but {} contains {}'.format(
+            filename, len(names)))
+    # The zip file is closed when the file in it is
+    zip_member = zip_file.open(names[0])
+    zip_file.close()
+    return zip_member
+
+
+def is_plain_file(filename):
+    """
+    Return whether filename is an uncompressed file, which can be read from
+    any position.
+
+    """
+    if filename == STDIN:
+        return False
+    with io.open(filename, 'rb') as binary_file:
+        return compression_of(binary_file) is None
+
+
+class ThreadedWriter(object):
+    """
+    A file-like object for text, which is encoded and written to ``raw`` (a
+    binary file, e.g. a compressed one) in a background thread, so that the
+    compression overlaps with producing the text. Closing it closes ``raw``,
+    unless close_raw is False.
+
+    """
+
+    # Characters to collect before handing them to the thread
+    buffer_size = 2 ** 16
+
+    def __init__(self, raw, encoding='utf-8', close_raw=True):
+        self.raw = raw
+        self.close_raw = close_raw
+        self.encoding = encoding
+        self.buffer = []
+        self.buffered = 0
+        self.closed = False
+        self.error = None
+        self.queue = queue.Queue(maxsize=16)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    self.raw.write(data)
+                except Exception as error:
+                    # Raised in the writing thread by write() or close(),
+                    # carry on taking from the queue so that it doesn't block
+                    self.error = error
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            # Text, or bytes from Python 2's unicodecsv
+            data = self.buffer[0][:0].join(self.buffer)
+            if isinstance(data, six.text_type):
+                data = data.encode(self.encoding)
+            self.queue.put(data)
+            self.buffer = []
+            self.buffered = 0
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            if self.close_raw:
+                self.raw.close()
+        if self.error is not None:
+            raise self.error
+
+
+class DeflatedFile(object):
+    """
+    A binary file-like object that deflates what is written to it into a
+    temporary file, keeping the CRC-32 and sizes needed to put it in a zip
+    file with write_zip. Closing it finishes the compression, but keeps the
+    temporary file until write_zip copies it.
+
+    zlib releases the GIL while it compresses, so writing to DeflatedFiles
+    in several threads (e.g. with ThreadedWriter) compresses in parallel.
+
+    """
+
+    def __init__(self, compresslevel=6):
+        self.compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.file = tempfile.TemporaryFile()
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.file.write(self.compressor.compress(data))
+
+    def close(self):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+            self.compressed_size = self.file.tell()
+
+
+# Sizes and offsets from this on need the zip64 extensions
+ZIP64_LIMIT = 0xFFFFFFFF
+# Numbers of files from this on need the zip64 extensions
+ZIP64_FILE_LIMIT = 0xFFFF
+
+
+def zip_field(value, limit, marker=0xFFFFFFFF):
+    """
+    Return value, or marker if it's too big, i.e. is in a zip64 field.
+
+    """
+    return marker if value >= limit else value
+
+
+def write_zip(binary_file, members):
+    """
+    Write a zip file to binary_file, of members, a list of (name,
+    DeflatedFile) pairs, which are closed. The deflated data is copied as it
+    is, rather than compressed again (which zipfile can't do).
+
+    """
+    # MS-DOS date and time, as zipfile gives them
+    now = time.localtime()
+    dos_time = now.tm_hour << 11 | now.tm_min << 5 | now.tm_sec // 2
+    dos_date = (now.tm_year - 1980) << 9 | now.tm_mon << 5 | now.tm_mday
+    # Names are UTF-8
+    flags = 0x800
+    offset = 0
+    central_directory = []
+    for name, deflated_file in members:
+        deflated_file.close()
+        encoded_name = name.encode('utf-8')
+        sizes = (deflated_file.compressed_size, deflated_file.size)
+        zip64 = max(sizes) >= ZIP64_LIMIT
+        version = 45 if zip64 else 20
+        extra = struct.pack('<HHQQ', 1, 16, deflated_file.size, deflated_file.compressed_size) if zip64 else b''
+        header_sizes = (0xFFFFFFFF, 0xFFFFFFFF) if zip64 else sizes
+        binary_file.write(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, version, flags, zipfile.ZIP_DEFLATED, dos_time, dos_date,
+            deflated_file.crc & 0xFFFFFFFF, header_sizes[0], header_sizes[1], len(encoded_name), len(extra)))
+        binary_file.write(encoded_name)
+        binary_file.write(extra)
+        deflated_file.file.seek(0)
+        shutil.copyfileobj(deflated_file.file, binary_file)
+        deflated_file.file.close()
+
+        # In the central directory, only the values that don't fit are in
+        # the zip64 extra field
+        zip64_values = [value for value in (deflated_file.size, deflated_file.compressed_size, offset)
+                        if value >= ZIP64_LIMIT]
+        central_extra = b''
+        if zip64_values:
+            version = 45
+            central_extra = struct.pack('<HH', 1, 8 * len(zip64_values)) + struct.pack(
+                '<' + 'Q' * len(zip64_values), *zip64_values)
+        central_directory.append(struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, flags, zipfile.ZIP_DEFLATED, dos_time, dos_date,
+            deflated_file.crc & 0xFFFFFFFF, zip_field(deflated_file.compressed_size, ZIP64_LIMIT),
+            zip_field(deflated_file.size, ZIP64_LIMIT), len(encoded_name), len(central_extra), 0, 0, 0, 0,
+            zip_field(offset, ZIP64_LIMIT)) + encoded_name + central_extra)
+        offset += 30 + len(encoded_name) + len(extra) + deflated_file.compressed_size
+
+    central_directory_offset = offset
+    central_directory = b''.join(central_directory)
+    binary_file.write(central_directory)
+    offset += len(central_directory)
+    count = len(members)
+    if count >= ZIP64_FILE_LIMIT or max(central_directory_offset, len(central_directory)) >= ZIP64_LIMIT:
+        binary_file.write(struct.pack(
+            '<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, len(central_directory),
+            central_directory_offset))
+        binary_file.write(struct.pack('<IIQI', 0x07064b50, 0, offset, 1))
+    binary_file.write(struct.pack(
+        '<IHHHHIIH', 0x06054b50, 0, 0, zip_field(count, ZIP64_FILE_LIMIT, 0xFFFF),
+        zip_field(count, ZIP64_FILE_LIMIT, 0xFFFF), zip_field(len(central_directory), ZIP64_LIMIT),
+        zip_field(central_directory_offset, ZIP64_LIMIT), 0))
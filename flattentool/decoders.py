@@ -0,0 +1,125 @@
+"""
+Backends for decoding JSON input data and schemas.
+
+Every decoder keeps the order of keys in objects, and keeps numbers exact:
+integers are decoded to int, and other numbers to Decimal, never to float (so
+decoders that only give floats, e.g. orjson, can't be used). Decoding makes
+many objects that all stay alive, which Python's cyclic garbage collector
+would scan again and again for nothing, so it's paused while decoding.
+
+stdlib
+    The json module. Objects are decoded to dicts, which keep their key order
+    on Python 3.7 and above, or to OrderedDicts before that (which are much
+    slower to make).
+rapidjson
+    python-rapidjson (``pip install python-rapidjson``). Numbers with
+    exponents too large for a float are out of its range, documents that have
+    them are decoded with stdlib instead.
+
+stdlib is the default: without OrderedDicts it's as fast as rapidjson or
+faster (see benchmarks/bench_json_decoders.py).
+
+With raw_numbers, numbers other than integers are decoded to RawNumbers (the
+text of the number, see lib.RawNumber) instead of Decimals, which only stdlib
+can do.
+
+"""
+
+import gc
+import json
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
+from decimal import Decimal
+from warnings import warn
+
+from flattentool.lib import RawNumber
+
+# Whether dicts keep the order keys are added in
+ORDERED_DICTS = sys.version_info[:2] >= (3, 7)
+
+
+@contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class StdlibDecoder(object):
+    name = 'stdlib'
+    supports_raw_numbers = True
+
+    def __init__(self, raw_numbers=False):
+        self.parse_float = RawNumber if raw_numbers else Decimal
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def decode(self, text):
+        if ORDERED_DICTS:
+            return json.loads(text, parse_float=self.parse_float)
+        return json.loads(text, object_pairs_hook=OrderedDict, parse_float=self.parse_float)
+
+    def loads(self, data):
+        """
+        Decode data (text, or bytes in UTF-8). Raises UnicodeError if it
+        isn't UTF-8, or ValueError if it isn't JSON.
+
+        """
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        with gc_paused():
+            return self.decode(data)
+
+    def load(self, binary_file):
+        return self.loads(binary_file.read())
+
+
+class RapidJSONDecoder(StdlibDecoder):
+    name = 'rapidjson'
+    supports_raw_numbers = False
+
+    @classmethod
+    def available(cls):
+        if not ORDERED_DICTS:
+            return False
+        try:
+            import rapidjson  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def decode(self, text):
+        import rapidjson
+        try:
+            return rapidjson.loads(text, number_mode=rapidjson.NM_DECIMAL)
+        except rapidjson.JSONDecodeError as err:
+            if 'too big' not in str(err):
+                raise
+            return super(RapidJSONDecoder, self).decode(text)
+
+
+DECODERS = OrderedDict((decoder_class.name, decoder_class) for decoder_class in (StdlibDecoder, RapidJSONDecoder))
+
+
+def get_decoder(name='stdlib', raw_numbers=False):
+    """
+    Return the decoder called name (one of DECODERS). If it's not installed,
+    or can't give raw_numbers, stdlib is used instead, with a warning.
+
+    """
+    if name not in DECODERS:
+        raise ValueError('Unknown JSON decoder {!r}, expected one of: {}'.format(name, ', '.join(DECODERS)))
+    if not DECODERS[name].available():
+        warn('The {} JSON decoder is not installed, using stdlib instead'.format(name))
+        return StdlibDecoder(raw_numbers)
+    if raw_numbers and not DECODERS[name].supports_raw_numbers:
+        warn("The {} JSON decoder can't keep numbers raw, using stdlib instead".format(name))
+        return StdlibDecoder(raw_numbers)
+    return DECODERS[name](raw_numbers)
@@ -0,0 +1,188 @@
+"""
+Filters that choose which items of the root list are flattened.
+
+A filter is made of predicates, each a (path, operator, value) triple, which
+must all match. The path is a JSON path, e.g. ``buyer/id``, and is followed
+through any lists on the way, so ``awards/date`` matches if the date of any
+award matches. Operators are:
+
+eq
+    The value is equal to the given value.
+in
+    The value is one of the given values, separated by commas (or given as a
+    list).
+prefix
+    The value starts with the given value.
+from, to
+    The value is on or after (from) or on or before (to) the given value,
+    compared as strings to the precision of the given value. This suits ISO
+    8601 dates, e.g. ``to 2019-12`` includes every date in December 2019.
+    Timezone offsets are not taken into account.
+
+Items are filtered as soon as they are read, before they are flattened.
+
+"""
+
+import six
+
+OPERATORS = ('eq', 'in', 'prefix', 'from', 'to')
+
+
+def value_text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return six.text_type(value)
+
+
+def list_items(value):
+    """Yield value, or the items of value if it's a list (of lists...)."""
+    if isinstance(value, list):
+        for item in value:
+            for list_item in list_items(item):
+                yield list_item
+    else:
+        yield value
+
+
+def path_values(json_dict, path):
+    """
+    Yield the values found at path (a list of keys) in json_dict, following
+    every item of any lists on the way. A key that is a number can also be
+    used to pick one item of a list.
+
+    """
+    values = [json_dict]
+    for key in path:
+        next_values = []
+        for value in values:
+            if isinstance(value, list) and key.isdigit():
+                if int(key) < len(value):
+                    next_values.append(value[int(key)])
+                continue
+            for item in list_items(value):
+                if isinstance(item, dict) and key in item:
+                    next_values.append(item[key])
+        values = next_values
+    for value in values:
+        for item in list_items(value):
+            yield item
+
+
+class Predicate(object):
+    def __init__(self, path, operator, value):
+        if operator not in OPERATORS:
+            raise ValueError('Unknown filter operator {!r}, expected one of: {}'.format(
+                operator, ', '.join(OPERATORS)))
+        self.path = path.strip('/').split('/')
+        self.operator = operator
+        if operator == 'in':
+            if isinstance(value, six.string_types):
+                value = value.split(',')
+            self.value = set(value_text(item) for item in value)
+        else:
+            self.value = value
+        self.match_value = getattr(self, 'match_' + operator)
+
+    def match_eq(self, value):
+        return value == self.value or value_text(value) == self.value
+
+    def match_in(self, value):
+        return value_text(value) in self.value
+
+    def match_prefix(self, value):
+        return value_text(value).startswith(self.value)
+
+    def match_from(self, value):
+        return value_text(value)[:len(self.value)] >= self.value
+
+    def match_to(self, value):
+        return value_text(value)[:len(self.value)] <= self.value
+
+    def matches_item(self, json_dict):
+        """Return whether json_dict (an item of the root list) matches."""
+        return self.matches(path_values(json_dict, self.path))
+
+    def matches(self, values):
+        """Return whether any of values (those found at self.path) match."""
+        for value in values:
+            if isinstance(value, dict):
+                # The text of an XML element, as given by xmltodict
+                value = value.get('#text')
+            if value is not None and self.match_value(value):
+                return True
+        return False
+
+
+class IdsPredicate(Predicate):
+    """
+    Like an 'in' predicate, for a large set of ids (e.g. read from a file),
+    which also records which of the ids have been found.
+
+    """
+
+    def __init__(self, path, ids):
+        super(IdsPredicate, self).__init__(path, 'in', ids)
+        self.found = set()
+        self.match_value = self.match_id
+
+    def match_id(self, value):
+        value = value_text(value)
+        if value in self.value:
+            self.found.add(value)
+            return True
+        return False
+
+    def not_found(self):
+        return self.value - self.found
+
+
+class FieldPredicate(Predicate):
+    """
+    The filter of the --filter-field and --filter-value options: the field
+    (at the top level of the item) is exactly equal to the value. Unlike an
+    'eq' predicate, the field isn't a path, lists aren't followed, and values
+    of other types (e.g. the number 1 for '1') don't match.
+
+    """
+
+    def __init__(self, field, value):
+        super(FieldPredicate, self).__init__(field, 'eq', value)
+        self.path = [field]
+
+    def matches_item(self, json_dict):
+        return self.path[0] in json_dict and json_dict[self.path[0]] == self.value
+
+    def matches(self, values):
+        return any(value == self.value for value in values)
+
+
+class RecordFilter(object):
+    """
+    A filter for items of the root list. Called with an item, returns whether
+    all the predicates match.
+
+    """
+
+    def __init__(self, predicates):
+        self.predicates = [
+            predicate if isinstance(predicate, Predicate) else Predicate(*predicate)
+            for predicate in predicates
+        ]
+
+    def matches(self, get_values):
+        """
+        Return whether all the predicates match, where get_values(path)
+        returns the values found at a path. Predicates are checked in order,
+        and stop at the first one that doesn't match.
+
+        """
+        for predicate in self.predicates:
+            if not predicate.matches(get_values(predicate.path)):
+                return False
+        return True
+
+    def __call__(self, json_dict):
+        for predicate in self.predicates:
+            if not predicate.matches_item(json_dict):
+                return False
+        return True
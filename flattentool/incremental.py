@@ -0,0 +1,285 @@
+"""
+Incremental flatten: flatten only the records of the root list that are new
+or have changed since the last run, and update the CSV output in place.
+
+A state file (a sidecar, e.g. flattened.state.json) records what the output
+was made from:
+
+* a fingerprint of the settings (and of any files they name, e.g. the
+  schema), if it changes the output is rebuilt in full,
+* the header of each sheet, as written,
+* each record, in the order its rows are in the output, as its key (its
+  root_id and id values), a hash of its content, the number of rows it has
+  in each sheet, and which of the fields to preserve (see --preserve-fields)
+  it has, so that they count as present when it isn't flattened again.
+
+On the next run each record read is matched to the previous record with the
+same key (records with the same key are matched in order). If its hash is
+the same it isn't flattened, its rows are copied from the previous output.
+Otherwise it's flattened, and its new rows replace the old ones. Records
+that weren't read again are removed, and new records are added at the end.
+Columns never move: columns that appear for the first time are added at the
+end of the header.
+
+"""
+
+import csv
+import hashlib
+import io
+import json
+import os
+import sys
+from collections import deque
+from warnings import warn
+
+import six
+
+STATE_VERSION = 2
+
+
+def file_digest(filename):
+    sha1 = hashlib.sha1()
+    with io.open(filename, 'rb') as binary_file:
+        for block in iter(lambda: binary_file.read(2 ** 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def settings_fingerprint(settings):
+    """
+    Return a hash of settings (a dict of the options that change the
+    output). The contents of any files the options name are hashed too.
+
+    """
+    def with_files(value):
+        if isinstance(value, six.string_types) and os.path.isfile(value):
+            return [value, file_digest(value)]
+        if isinstance(value, (list, tuple)):
+            return [with_files(item) for item in value]
+        return value
+
+    text = json.dumps(dict((name, with_files(value)) for name, value in settings.items()),
+                      sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def record_hash(json_dict, source_file=None):
+    text = json.dumps([source_file, json_dict], default=str, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class FingerprintStore(object):
+    """
+    The state of an incremental flatten to a directory of CSV files (see the
+    module docstring).
+
+    Set as the incremental attribute of a JSONParser, which then calls
+    parse_record for each record, and write() once the parser is done.
+
+    """
+
+    def __init__(self, state_filename, output_name, settings, main_sheet_name='main', sheet_prefix=''):
+        if sys.version < '3':
+            raise ValueError('Incremental flatten requires Python 3')
+        self.state_filename = state_filename
+        self.output_name = output_name
+        self.main_sheet_name = main_sheet_name
+        self.sheet_prefix = sheet_prefix
+        self.settings = settings_fingerprint(settings)
+        self.sheet_headers = {}
+        # The previous records, as [key, hash, {sheet name: number of rows},
+        # [preserved fields]]
+        self.previous_records = []
+        self.load()
+        # For each key, the indexes of the previous records with it that
+        # haven't been matched yet
+        self.unmatched = {}
+        for index, record in enumerate(self.previous_records):
+            self.unmatched.setdefault(record[0], deque()).append(index)
+        # What has happened to each previous record: None until it's
+        # matched, True if it's unchanged, or the record that replaces it
+        self.outcomes = [None] * len(self.previous_records)
+        # The records that were flattened, in the order they were
+        self.parsed_records = []
+        # The flattened records that don't replace a previous one
+        self.new_records = []
+
+    def sheet_filename(self, sheet_name):
+        return os.path.join(self.output_name, self.sheet_prefix + sheet_name + '.csv')
+
+    def load(self):
+        if not os.path.exists(self.state_filename):
+            return
+        with io.open(self.state_filename, encoding='utf-8') as state_file:
+            state = json.load(state_file)
+        if state.get('version') != STATE_VERSION or state.get('settings') != self.settings:
+            warn('The settings have changed since the last incremental flatten, flattening everything again')
+            return
+        missing = [sheet_name for sheet_name in state['sheets']
+                   if not os.path.exists(self.sheet_filename(sheet_name))]
+        if missing:
+            warn('The output of the last incremental flatten is missing ({}), flattening everything again'.format(
+                ', '.join(self.sheet_filename(sheet_name) for sheet_name in missing)))
+            return
+        self.sheet_headers = state['sheets']
+        self.previous_records = state['records']
+
+    def save(self, records):
+        state = {
+            'version': STATE_VERSION,
+            'settings': self.settings,
+            'sheets': self.sheet_headers,
+            'records': records,
+        }
+        temporary_filename = self.state_filename + '.tmp'
+        with io.open(temporary_filename, 'w', encoding='utf-8') as state_file:
+            state_file.write(six.text_type(json.dumps(state, ensure_ascii=False, separators=(',', ':'))))
+        os.replace(temporary_filename, self.state_filename)
+
+    def record_key(self, parser, json_dict):
+        root_id_value = json_dict.get(parser.root_id) if parser.root_id else None
+        return json.dumps([root_id_value, json_dict.get(parser.id_name)], default=str, ensure_ascii=False)
+
+    def line_counts(self, parser):
+        counts = {self.main_sheet_name: len(parser.main_sheet.lines)}
+        for sheet_name, sheet in parser.sub_sheets.items():
+            counts[sheet_name] = len(sheet.lines)
+        return counts
+
+    def parse_record(self, parser, json_dict):
+        """
+        Flatten json_dict with parser, unless it's unchanged since the last
+        run.
+
+        """
+        key = self.record_key(parser, json_dict)
+        digest = record_hash(json_dict, parser.source_file if parser.source_file_column else None)
+        indexes = self.unmatched.get(key)
+        previous_index = indexes.popleft() if indexes else None
+        if previous_index is not None and self.previous_records[previous_index][1] == digest:
+            self.outcomes[previous_index] = True
+            parser.seen_paths.update(self.previous_records[previous_index][3])
+            return
+
+        before = self.line_counts(parser)
+        seen_paths = parser.seen_paths
+        parser.seen_paths = set()
+        try:
+            parser.parse_json_dict(json_dict, sheet=parser.main_sheet)
+            record_paths = parser.seen_paths
+        finally:
+            seen_paths.update(parser.seen_paths)
+            parser.seen_paths = seen_paths
+        row_counts = {}
+        for sheet_name, count in self.line_counts(parser).items():
+            if count > before.get(sheet_name, 0):
+                row_counts[sheet_name] = count - before.get(sheet_name, 0)
+        preserved_fields = sorted(record_paths & (parser.preserve_fields_input or set()))
+        record = [key, digest, row_counts, preserved_fields]
+        self.parsed_records.append(record)
+        if previous_index is None:
+            self.new_records.append(record)
+        else:
+            self.outcomes[previous_index] = record
+
+    def parser_sheets(self, parser):
+        sheets = {self.main_sheet_name: parser.main_sheet}
+        sheets.update(parser.sub_sheets)
+        return sheets
+
+    def write(self, parser):
+        """
+        Update the output with the records flattened by parser, and save the
+        new state.
+
+        """
+        if not os.path.isdir(self.output_name):
+            os.makedirs(self.output_name)
+        sheets = self.parser_sheets(parser)
+        records = []
+        for previous_record, outcome in zip(self.previous_records, self.outcomes):
+            if outcome is True:
+                records.append(previous_record)
+            elif outcome is not None:
+                records.append(outcome)
+        records.extend(self.new_records)
+
+        for sheet_name in sorted(set(sheets) | set(self.sheet_headers)):
+            previous_header = self.sheet_headers.get(sheet_name)
+            header = list(previous_header or [])
+            if sheet_name in sheets:
+                columns = set(header)
+                header.extend(column for column in sheets[sheet_name] if column not in columns)
+            self.write_sheet(sheet_name, sheets.get(sheet_name), previous_header, header)
+            self.sheet_headers[sheet_name] = header
+        self.save(records)
+
+    def parsed_rows(self, sheet_name, sheet, header):
+        """
+        Return the rows of each flattened record in the sheet, keyed by the
+        id() of the record.
+
+        """
+        rows = list(sheet.lines.rows(header)) if sheet is not None else []
+        rows_by_record = {}
+        position = 0
+        for record in self.parsed_records:
+            count = record[2].get(sheet_name, 0)
+            rows_by_record[id(record)] = rows[position:position + count]
+            position += count
+        return rows_by_record
+
+    def write_sheet(self, sheet_name, sheet, previous_header, header):
+        rows_by_record = self.parsed_rows(sheet_name, sheet, header)
+        new_rows = [row for record in self.new_records for row in rows_by_record[id(record)]]
+        filename = self.sheet_filename(sheet_name)
+        if previous_header is None:
+            # A new sheet, with the rows of changed records (in their order),
+            # then of new records
+            with io.open(filename, 'w', encoding='utf-8') as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(header)
+                for outcome in self.outcomes:
+                    if outcome is not True and outcome is not None:
+                        writer.writerows(rows_by_record[id(outcome)])
+                writer.writerows(new_rows)
+            return
+
+        # Removed or changed records that had or now have rows in the sheet
+        rewrite = header != previous_header or any(
+            outcome is not True and (previous_record[2].get(sheet_name) or outcome and outcome[2].get(sheet_name))
+            for previous_record, outcome in zip(self.previous_records, self.outcomes))
+        if not rewrite:
+            # Only new rows (if any), which go at the end
+            if new_rows:
+                with io.open(filename, 'a', encoding='utf-8') as csv_file:
+                    csv.writer(csv_file).writerows(new_rows)
+            return
+
+        padding = [''] * (len(header) - len(previous_header))
+        temporary_filename = filename + '.tmp'
+        try:
+            with io.open(filename, encoding='utf-8', newline='') as previous_file, \
+                    io.open(temporary_filename, 'w', encoding='utf-8') as csv_file:
+                previous_rows = csv.reader(previous_file)
+                next(previous_rows, None)
+                writer = csv.writer(csv_file)
+                writer.writerow(header)
+                for previous_record, outcome in zip(self.previous_records, self.outcomes):
+                    for _ in range(previous_record[2].get(sheet_name, 0)):
+                        try:
+                            row = next(previous_rows)
+                        except StopIteration:
+                            raise ValueError(
+                                '{} has fewer rows than the state file {} says, remove the state file to flatten '
+                                'everything again'.format(filename, self.state_filename))
+                        if outcome is True:
+                            writer.writerow(row + padding)
+                    if outcome is not True and outcome is not None:
+                        writer.writerows(rows_by_record[id(outcome)])
+                writer.writerows(new_rows)
+        except Exception:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+            raise
+        os.replace(temporary_filename, filename)
@@ -5,20 +5,25 @@ This file has classes describing input from spreadsheets.
 
 from __future__ import print_function
 from __future__ import unicode_literals
+import io
+import itertools
 import sys
+import zipfile
 from decimal import Decimal, InvalidOperation
 import os
 from collections import OrderedDict
 import openpyxl
-from six import text_type
+from six import string_types, text_type
+from six.moves import zip_longest
 from warnings import warn
 import traceback
 import datetime
 import pytz
 from openpyxl.utils import column_index_from_string
 from openpyxl.utils.cell import _get_column_letter
+from flattentool.compression import decompressed, open_input
 from flattentool.exceptions import DataErrorWarning
-from flattentool.lib import isint, parse_sheet_configuration
+from flattentool.lib import isint, parse_sheet_configuration, raw_number
 
 try:
     from zipfile import BadZipFile
@@ -26,19 +31,26 @@ except ImportError:
     from zipfile import BadZipfile as BadZipFile
 
 
-class Cell:
+class Cell(object):
+    """
+    The value of a cell, with its location (sheet, column, row and heading),
+    for the cell source map. sub_cells are the other cells with the same
+    value that have been merged into this one (a tuple, as most cells have
+    none).
+
+    """
+    __slots__ = ('cell_value', 'cell_location', 'sub_cells')
+
     def __init__(self, cell_value, cell_location):
         self.cell_value = cell_value
         self.cell_location = cell_location
-        self.sub_cells = []
+        self.sub_cells = ()
 
 # The "pylint: disable" lines exist to ignore warnings about the imports we expect not to work not working
 
 if sys.version > '3':
-    from csv import DictReader
     from csv import reader as csvreader
 else:
-    from unicodecsv import DictReader  # pylint: disable=F0401
     from unicodecsv import reader as csvreader  # pylint: disable=F0401
 
 try:
@@ -47,64 +59,126 @@ except ImportError:
     from UserDict import UserDict  # pylint: disable=F0401
 
 
-def convert_type(type_string, value, timezone = pytz.timezone('UTC')):
-    if value == '' or value is None:
-        return None
-    if type_string == 'number':
-        try:
-            return Decimal(value)
-        except (TypeError, ValueError, InvalidOperation):
-            warn('Non-numeric value "{}" found in number column, returning as string instead.'.format(value),
-                DataErrorWarning)
-            return text_type(value)
-    elif type_string == 'integer':
-        try:
-            return int(value)
-        except (TypeError, ValueError):
-            warn('Non-integer value "{}" found in integer column, returning as string instead.'.format(value),
-                DataErrorWarning)
-            return text_type(value)
-    elif type_string == 'boolean':
-        value = text_type(value)
-        if value.lower() in ['true', '1']:
-            return True
-        elif value.lower() in ['false', '0']:
-            return False
-        else:
-            warn('Unrecognised value for boolean: "{}", returning as string instead'.format(value),
-                DataErrorWarning)
-            return text_type(value)
-    elif type_string in ('array', 'array_array', 'string_array', 'number_array'):
-        value = text_type(value)
-        if type_string == 'number_array':
-            try:
-                if ',' in value:
-                    return [[Decimal(y) for y in x.split(',')] for x in value.split(';')]
-                else:
-                    return [Decimal(x) for x in value.split(';')]
-            except (TypeError, ValueError, InvalidOperation):
-                warn('Non-numeric value "{}" found in number array column, returning as string array instead.'.format(value),
-                    DataErrorWarning)
+# Each converter takes a (non-blank) value from a cell, the timezone and
+# raw_numbers (see convert_type), and returns the converted value and a
+# warning message, or None if the value could be converted
+
+
+def convert_number(value, timezone, raw_numbers):
+    if raw_numbers:
+        number = raw_number(value)
+        if number is not None:
+            return number, None
+    try:
+        return Decimal(value), None
+    except (TypeError, ValueError, InvalidOperation):
+        return text_type(value), 'Non-numeric value "{}" found in number column, returning as string instead.'.format(value)
+
+
+def convert_integer(value, timezone, raw_numbers):
+    try:
+        return int(value), None
+    except (TypeError, ValueError):
+        return text_type(value), 'Non-integer value "{}" found in integer column, returning as string instead.'.format(value)
+
+
+def convert_boolean(value, timezone, raw_numbers):
+    value = text_type(value)
+    if value.lower() in ['true', '1']:
+        return True, None
+    elif value.lower() in ['false', '0']:
+        return False, None
+    else:
+        return text_type(value), 'Unrecognised value for boolean: "{}", returning as string instead'.format(value)
+
+
+def convert_array(value, timezone, raw_numbers):
+    value = text_type(value)
+    if ',' in value:
+        return [x.split(',') for x in value.split(';')], None
+    else:
+        return value.split(';'), None
+
+
+def convert_number_array(value, timezone, raw_numbers):
+    value = text_type(value)
+    if raw_numbers:
+        numbers = [[raw_number(y) for y in x.split(',')] for x in value.split(';')]
+        if all(number is not None for x in numbers for number in x):
+            return (numbers if ',' in value else [x[0] for x in numbers]), None
+    try:
         if ',' in value:
-            return [x.split(',') for x in value.split(';')]
+            return [[Decimal(y) for y in x.split(',')] for x in value.split(';')], None
         else:
-            return value.split(';')
-    elif type_string == 'string':
-        if type(value) == datetime.datetime:
-            return timezone.localize(value).isoformat()
-        return text_type(value)
-    elif type_string == 'date':
-        if type(value) == datetime.datetime:
-            return value.date().isoformat()
-        return text_type(value)
-    elif type_string == '':
-        if type(value) == datetime.datetime:
-            return timezone.localize(value).isoformat()
-        if type(value) == float and int(value) == value:
-            return int(value)
-        return value if type(value) in [int] else text_type(value)
-    else:
-        raise ValueError('Unrecognised type: "{}"'.format(type_string))
+            return [Decimal(x) for x in value.split(';')], None
+    except (TypeError, ValueError, InvalidOperation):
+        return (convert_array(value, timezone, raw_numbers)[0],
+                'Non-numeric value "{}" found in number array column, returning as string array instead.'.format(value))
+
+
+def convert_string(value, timezone, raw_numbers):
+    if type(value) == datetime.datetime:
+        return timezone.localize(value).isoformat(), None
+    return text_type(value), None
+
+
+def convert_date(value, timezone, raw_numbers):
+    if type(value) == datetime.datetime:
+        return value.date().isoformat(), None
+    return text_type(value), None
+
+
+def convert_untyped(value, timezone, raw_numbers):
+    if type(value) == datetime.datetime:
+        return timezone.localize(value).isoformat(), None
+    if type(value) == float and int(value) == value:
+        return int(value), None
+    return (value if type(value) in [int] else text_type(value)), None
+
+
+CONVERTERS = {
+    'number': convert_number,
+    'integer': convert_integer,
+    'boolean': convert_boolean,
+    'array': convert_array,
+    'array_array': convert_array,
+    'string_array': convert_array,
+    'number_array': convert_number_array,
+    'string': convert_string,
+    'date': convert_date,
+    '': convert_untyped,
+}
+
+
+def get_converter(type_string):
+    """
+    Return the converter for type_string, a type from the schema, or '' if
+    it has none. If the type isn't known, the converter raises ValueError.
+
+    """
+    try:
+        return CONVERTERS[type_string]
+    except KeyError:
+        def unrecognised_type(value, timezone, raw_numbers):
+            raise ValueError('Unrecognised type: "{}"'.format(type_string))
+        return unrecognised_type
+
+
+def convert_type(type_string, value, timezone = pytz.timezone('UTC'), raw_numbers=False):
+    """
+    Convert value (from a cell) to type_string, a type from the schema, or ''
+    if it has none.
+
+    With raw_numbers, text in number columns that is a valid JSON number is
+    kept as it is (as a RawNumber), instead of being converted to a Decimal.
+
+    """
+    if value == '' or value is None:
+        return None
+    converted_value, message = get_converter(type_string)(value, timezone, raw_numbers)
+    if message:
+        warn(message, DataErrorWarning)
+    return converted_value
 
 
 def warnings_for_ignored_columns(v, extra_message):
@@ -120,7 +194,32 @@ def warnings_for_ignored_columns(v, extra_message):
         raise ValueError()
 
 
-def merge(base, mergee, debug_info=None):
+def cells_to_values(v):
+    """
+    Replace the cells in v (a dict or TemporaryDict, or a cell) by their
+    values, in place, and return it.
+
+    """
+    if isinstance(v, Cell):
+        return v.cell_value
+    if isinstance(v, TemporaryDict):
+        for key, value in v.items():
+            v[key] = cells_to_values(value)
+        for value in v.items_no_keyfield:
+            cells_to_values(value)
+    elif isinstance(v, dict):
+        for key, value in v.items():
+            v[key] = cells_to_values(value)
+    return v
+
+
+def merge(base, mergee, debug_info=None, keep_cells=True):
+    """
+    Merge mergee (a line unflattened to cells) into base. If keep_cells is
+    False, base has values rather than cells, and the values of the cells of
+    mergee are merged in.
+
+    """
     if not debug_info:
         debug_info = {}
     for key, v in mergee.items():
@@ -135,25 +234,25 @@ def merge(base, mergee, debug_info=None):
                     continue
                 for temporarydict_key, temporarydict_value in value.items():
                     if temporarydict_key in base[key]:
-                        merge(base[key][temporarydict_key], temporarydict_value, debug_info)
+                        merge(base[key][temporarydict_key], temporarydict_value, debug_info, keep_cells)
                     else:
                         assert temporarydict_key not in base[key], 'Overwriting cell {} by mistake'.format(temporarydict_value)
-                        base[key][temporarydict_key] = temporarydict_value
+                        base[key][temporarydict_key] = temporarydict_value if keep_cells else cells_to_values(temporarydict_value)
                 for temporarydict_value in  value.items_no_keyfield:
-                    base[key].items_no_keyfield.append(temporarydict_value)
+                    base[key].items_no_keyfield.append(temporarydict_value if keep_cells else cells_to_values(temporarydict_value))
             elif isinstance(value, dict):
                 if isinstance(base[key], dict):
-                    merge(base[key], value, debug_info)
+                    merge(base[key], value, debug_info, keep_cells)
                 else:
                     warnings_for_ignored_columns(v, 'because it treats {} as an object, but another column does not'.format(key))
             else:
-                if not isinstance(base[key], Cell):
+                if isinstance(base[key], (dict, TemporaryDict)):
                     id_info = '{} "{}"'.format(debug_info.get('id_name'), debug_info.get(debug_info.get('id_name')))
                     if debug_info.get('root_id'):
                         id_info = '{} "{}", '.format(debug_info.get('root_id'), debug_info.get('root_id_or_none'))+id_info
                     warnings_for_ignored_columns(v, 'because another column treats it as an array or object'.format(key))
                     continue
-                base_value = base[key].cell_value
+                base_value = base[key].cell_value if keep_cells else base[key]
                 if base_value != value:
                     id_info = '{} "{}"'.format(debug_info.get('id_name'), debug_info.get(debug_info.get('id_name')))
                     if debug_info.get('root_id'):
@@ -162,11 +261,11 @@ def merge(base, mergee, debug_info=None):
                         'You may have a duplicate Identifier: We couldn\'t merge these rows with the {}: field "{}" in sheet "{}": one cell has the value: "{}", the other cell has the value: "{}"'.format(
                             id_info, key, debug_info.get('sheet_name'), base_value, value),
                         DataErrorWarning)
-                else:
-                    base[key].sub_cells.append(v)
+                elif keep_cells:
+                    base[key].sub_cells += (v,)
         else:
             # This happens when a parent record finds the first a child record of a known type
-            base[key] = v
+            base[key] = v if keep_cells else cells_to_values(v)
 
 
 class SpreadsheetInput(object):
@@ -203,7 +302,8 @@ class SpreadsheetInput(object):
                  id_name='id',
                  xml=False,
                  base_configuration={},
-                 use_configuration=True
+                 use_configuration=True,
+                 raw_numbers=False
                 ):
         self.input_name = input_name
         self.root_list_path = root_list_path
@@ -221,6 +321,7 @@ class SpreadsheetInput(object):
         self.base_configuration = base_configuration or {}
         self.sheet_configuration = {}
         self.use_configuration = use_configuration
+        self.raw_numbers = raw_numbers
 
     def get_sub_sheets_lines(self):
         for sub_sheet_name in self.sub_sheet_names:
@@ -246,7 +347,26 @@ class SpreadsheetInput(object):
     def read_sheets(self):
         raise NotImplementedError
 
-    def do_unflatten(self):
+    def close(self):
+        """
+        Close the files read from. Reading a sheet again opens them again.
+
+        """
+        pass
+
+    def do_unflatten(self, keep_cells=True):
+        """
+        Unflatten the lines of every sheet into a list of dicts. Their values
+        are cells (with their locations, for the source maps), or if
+        keep_cells is False, the values themselves.
+
+        """
+        try:
+            return self.unflatten_sheets(keep_cells)
+        finally:
+            self.close()
+
+    def unflatten_sheets(self, keep_cells):
         main_sheet_by_ocid = OrderedDict()
         sheets = list(self.get_sub_sheets_lines())
         for i, sheet in enumerate(sheets):
@@ -312,22 +432,29 @@ class SpreadsheetInput(object):
             except NotImplementedError:
                 # The ListInput type used in the tests doesn't support getting headings.
                 actual_headings = None
+            plan = UnflattenPlan(self.parser, self.xml)
             for j, line in enumerate(lines):
                 if all(x is None or x == '' for x in line.values()):
                 #if all(x == '' for x in line.values()):
                     continue
                 root_id_or_none = line.get(self.root_id) if self.root_id else None
                 cells = OrderedDict()
+                column_letters = plan.column_letters(len(line))
                 for k, header in enumerate(line):
+                    value = line[header]
+                    if value is None or value == '':
+                        # Blank cells are skipped by unflatten_main_with_parser
+                        continue
                     heading = actual_headings[k] if actual_headings else header
                     if self.vertical_orientation:
                         # This is misleading as it specifies the row number as the distance vertically
                         # and the horizontal 'letter' as a number.
                         # https://github.com/OpenDataServices/flatten-tool/issues/153
-                        cells[header] = Cell(line[header], (sheet_name, str(k+1), j+2, heading))
+                        cells[header] = Cell(value, (sheet_name, str(k+1), j+2, heading))
                     else:
-                        cells[header] = Cell(line[header], (sheet_name, _get_column_letter(k+1), j+2, heading))
-                unflattened = unflatten_main_with_parser(self.parser, cells, self.timezone, self.xml, self.id_name)
+                        cells[header] = Cell(value, (sheet_name, column_letters[k], j+2, heading))
+                unflattened = unflatten_main_with_parser(self.parser, cells, self.timezone, self.xml, self.id_name,
+                                                         self.raw_numbers, plan)
                 if root_id_or_none not in main_sheet_by_ocid:
                     main_sheet_by_ocid[root_id_or_none] = TemporaryDict(self.id_name, xml=self.xml)
                 def inthere(unflattened, id_name):
@@ -349,19 +476,21 @@ class SpreadsheetInput(object):
                             'root_id_or_none': root_id_or_none,
                             'id_name': self.id_name,
                             self.id_name: unflattened_id
-                        }
+                        },
+                        keep_cells
                     )
                 else:
-                    main_sheet_by_ocid[root_id_or_none].append(unflattened)
+                    main_sheet_by_ocid[root_id_or_none].append(unflattened if keep_cells else cells_to_values(unflattened))
         temporarydicts_to_lists(main_sheet_by_ocid)
         return sum(main_sheet_by_ocid.values(), [])
 
     def unflatten(self):
-        result = self.do_unflatten()
-        result = extract_list_to_value(result)
-        return result
+        return self.do_unflatten(keep_cells=False)
 
     def fancy_unflatten(self, with_cell_source_map, with_heading_source_map):
+        if not with_cell_source_map and not with_heading_source_map:
+            # Without source maps, there's no need to keep the cells
+            return self.unflatten(), None, None
         cell_tree = self.do_unflatten()
         result = extract_list_to_value(cell_tree)
         ordered_cell_source_map = None
@@ -455,7 +584,57 @@ def extract_dict_to_value(input):
             raise Exception('Unexpected result type in the JSON cell tree: {}'.format(input[k]))
     return output
 
+# Sheet files (possibly compressed) of CSVInput, in order of preference
+CSV_EXTENSIONS = ('.csv', '.csv.gz', '.csv.bz2', '.csv.xz')
+
+
+class CSVSheet(object):
+    """
+    The rows of the CSV file of a sheet, read in one pass. The rows read
+    ahead of the lines (the configuration and heading rows) are kept, to be
+    read again from the start of the file.
+
+    """
+
+    def __init__(self, sheet_file, reader):
+        self.sheet_file = sheet_file
+        self.reader = reader
+        self.first_rows = []
+
+    def row(self, index):
+        """
+        Return the row at index (from 0), or None if the file ends before it.
+
+        """
+        while len(self.first_rows) <= index:
+            row = next(self.reader, None)
+            if row is None:
+                return None
+            self.first_rows.append(row)
+        return self.first_rows[index]
+
+    def __iter__(self):
+        for row in self.first_rows:
+            yield row
+        self.first_rows = []
+        for row in self.reader:
+            yield row
+
+    def close(self):
+        self.sheet_file.close()
+
+
 class CSVInput(SpreadsheetInput):
+    """
+    Reads a directory of CSV files, or a zip file of them (e.g. made by
+    flatten with --csv-compression zip). The CSV files may be compressed
+    with gzip, bzip2 or xz.
+
+    Each file is opened once, when its configuration is read, and read to
+    the end by get_sheet_lines. The files of sheets that aren't read (e.g.
+    if they're ignored) are closed by close().
+
+    """
     encoding = 'utf-8'
 
     def get_sheet_headings(self, sheet_name):
@@ -470,22 +649,63 @@ class CSVInput(SpreadsheetInput):
             # returning empty headers is a proxy for no data in the sheet.
             return []
 
+        return self.sheet(sheet_name).row(skip_rows + configuration_line)
+
+    def open_sheet_file(self, sheet_name):
+        """
+        Open the CSV file of a sheet, as text decoded with self.encoding on
+        Python 3, or bytes on Python 2 (which unicodecsv decodes).
+
+        """
+        file_name = self.sheet_file_names[sheet_name]
+        if self.zip_file is None:
+            binary_file = open_input(os.path.join(self.input_name, file_name))
+        else:
+            if self.zip_file.fp is None:
+                # Closed by close()
+                self.zip_file = zipfile.ZipFile(self.input_name)
+            binary_file = decompressed(self.zip_file.open(file_name))
         if sys.version > '3':  # If Python 3 or greater
-            with open(os.path.join(self.input_name, sheet_name+'.csv'), encoding=self.encoding) as main_sheet_file:
-                r = csvreader(main_sheet_file)
-                for num, row in enumerate(r):
-                    if num == (skip_rows + configuration_line):
-                        return row
-        else:  # If Python 2
-            with open(os.path.join(self.input_name, sheet_name+'.csv')) as main_sheet_file:
-                r = csvreader(main_sheet_file, encoding=self.encoding)
-                for num, row in enumerate(r):
-                    if num == (skip_rows + configuration_line):
-                        return row
+            return io.TextIOWrapper(binary_file, encoding=self.encoding)
+        return binary_file
+
+    def sheet(self, sheet_name):
+        """
+        Return the CSVSheet of a sheet, opening its file if it isn't open.
+
+        """
+        if sheet_name not in self.open_sheets:
+            sheet_file = self.open_sheet_file(sheet_name)
+            if sys.version > '3':  # If Python 3 or greater
+                reader = csvreader(sheet_file)
+            else:  # If Python 2
+                # Pass the encoding to the reader
+                reader = csvreader(sheet_file, encoding=self.encoding)
+            self.open_sheets[sheet_name] = CSVSheet(sheet_file, reader)
+        return self.open_sheets[sheet_name]
+
+    def close(self):
+        for sheet in self.open_sheets.values():
+            sheet.close()
+        self.open_sheets = {}
+        if self.zip_file is not None:
+            self.zip_file.close()
 
     def read_sheets(self):
-        sheet_file_names = os.listdir(self.input_name)
-        sheet_names = sorted([fname[:-4] for fname in sheet_file_names if fname.endswith('.csv')])
+        # The CSVSheets of the files that are open, by sheet name
+        self.open_sheets = {}
+        if isinstance(self.input_name, string_types) and os.path.isdir(self.input_name):
+            self.zip_file = None
+            sheet_file_names = os.listdir(self.input_name)
+        else:
+            self.zip_file = zipfile.ZipFile(self.input_name)
+            sheet_file_names = self.zip_file.namelist()
+        self.sheet_file_names = {}
+        for file_name in sorted(sheet_file_names):
+            for extension in CSV_EXTENSIONS:
+                if file_name.endswith(extension):
+                    self.sheet_file_names.setdefault(file_name[:-len(extension)], file_name)
+        sheet_names = sorted(self.sheet_file_names)
         if self.include_sheets:
             for sheet in list(sheet_names):
                 if sheet not in self.include_sheets:
@@ -499,7 +719,7 @@ class CSVInput(SpreadsheetInput):
         self.sheet_names_map = OrderedDict((sheet_name, sheet_name) for sheet_name in sheet_names)
         self.configure_sheets()
 
-    def generate_rows(self, dictreader, sheet_name):
+    def generate_rows(self, rows, sheet_name):
         sheet_configuration = self.sheet_configuration[self.sheet_names_map[sheet_name]]
         configuration_line = 1 if sheet_configuration else 0
         if not sheet_configuration:
@@ -509,53 +729,37 @@ class CSVInput(SpreadsheetInput):
 
         skip_rows = sheet_configuration.get("skipRows", 0)
         header_rows = sheet_configuration.get("headerRows", 1)
-        for i in range(0, configuration_line + skip_rows):
-            previous_row = next(dictreader.reader)
-        if sys.version > '3':  # If Python 3 or greater
-            fieldnames = dictreader.fieldnames
-        else:
-            # unicodecsv dictreader always reads the headingline first
-            # so in the case of there being any rows to skip look at
-            # previous row and use that for fieldnames.
-            if (configuration_line + skip_rows):
-                fieldnames = previous_row
-                dictreader.fieldnames = fieldnames
-                dictreader.unicode_fieldnames = fieldnames
-            else:
-                fieldnames = dictreader.unicode_fieldnames
-        for i in range(0, header_rows - 1):
-            next(dictreader.reader)
-        for line in dictreader:
-            yield OrderedDict((fieldname, line[fieldname]) for fieldname in fieldnames)
+        rows = iter(rows)
+        fieldnames = next(itertools.islice(rows, configuration_line + skip_rows, None), None)
+        if fieldnames is None:
+            return
+        width = len(fieldnames)
+        for row in itertools.islice(rows, header_rows - 1, None):
+            if not row:
+                # Blank lines are skipped
+                continue
+            if len(row) < width:
+                row = row + [None] * (width - len(row))
+            # Values past the last heading are dropped, and the last of any
+            # values with the same heading is kept
+            yield OrderedDict(zip(fieldnames, row))
 
     def get_sheet_configuration(self, sheet_name):
-        if sys.version > '3':  # If Python 3 or greater
-            with open(os.path.join(self.input_name, sheet_name+'.csv'), encoding=self.encoding) as main_sheet_file:
-                r = csvreader(main_sheet_file)
-                heading_row = next(r)
-        else:  # If Python 2
-            with open(os.path.join(self.input_name, sheet_name+'.csv')) as main_sheet_file:
-                r = csvreader(main_sheet_file, encoding=self.encoding)
-                heading_row = next(r)
-        if len(heading_row) > 0 and heading_row[0] == '#':
+        heading_row = self.sheet(sheet_name).row(0)
+        if heading_row and heading_row[0] == '#':
             return heading_row[1:]
         return []
 
-
-
     def get_sheet_lines(self, sheet_name):
-        if sys.version > '3':  # If Python 3 or greater
-            # Pass the encoding to the open function
-            with open(os.path.join(self.input_name, sheet_name+'.csv'), encoding=self.encoding) as main_sheet_file:
-                dictreader = DictReader(main_sheet_file)
-                for row in self.generate_rows(dictreader, sheet_name):
-                    yield row
-        else:  # If Python 2
-            # Pass the encoding to DictReader
-            with open(os.path.join(self.input_name, sheet_name+'.csv')) as main_sheet_file:
-                dictreader = DictReader(main_sheet_file, encoding=self.encoding)
-                for row in self.generate_rows(dictreader, sheet_name):
-                    yield row
+        sheet = self.sheet(sheet_name)
+        # The file is read to the end here, reading the lines again opens it
+        # again
+        del self.open_sheets[sheet_name]
+        try:
+            for row in self.generate_rows(sheet, sheet_name):
+                yield row
+        finally:
+            sheet.close()
 
 
 class BadXLSXZipFile(BadZipFile):
@@ -563,13 +767,57 @@ class BadXLSXZipFile(BadZipFile):
 
 
 class XLSXInput(SpreadsheetInput):
-    def read_sheets(self):
+    """
+    Reads an XLSX file. The workbook is opened read-only, so that each sheet
+    is read as a stream of rows rather than being loaded into memory (with
+    vertical_orientation, only the values of the sheet being read are kept,
+    to be read by column). Rows that are empty at the end of a sheet (e.g. if
+    it's formatted down to the last row) are counted, but not returned.
+
+    The lines returned are the same as when the workbook is loaded in full
+    (with read_only set to False), except that columns after the last heading
+    (whose values are ignored either way) are left out.
+
+    """
+
+    # Whether to open the workbook read-only
+    read_only = True
+
+    workbook = None
+    # The file of a read-only workbook, if opened here (rather than given)
+    workbook_file = None
+
+    def load_workbook(self):
+        workbook_input = self.input_name
+        if self.read_only and isinstance(self.input_name, string_types):
+            # Opened here so that close() can close it, as rows that are left
+            # unread keep openpyxl's archive open even once it's closed
+            workbook_input = self.workbook_file = io.open(self.input_name, 'rb')
         try:
-            self.workbook = openpyxl.load_workbook(self.input_name, data_only=True)
+            return openpyxl.load_workbook(workbook_input, data_only=True, read_only=self.read_only)
         except BadZipFile as e:
+            self.close()
             # TODO when we have python3 only add 'from e' to show exception chain
             raise BadXLSXZipFile("The supplied file has extension .xlsx but isn't an XLSX file.")
 
+    def worksheet(self, sheet_name):
+        if self.workbook is None:
+            # Closed by close()
+            self.workbook = self.load_workbook()
+        return self.workbook[self.sheet_names_map[sheet_name]]
+
+    def close(self):
+        # A read-only workbook keeps the file open until it's closed
+        if self.read_only and self.workbook is not None:
+            self.workbook.close()
+            self.workbook = None
+        if self.workbook_file is not None:
+            self.workbook_file.close()
+            self.workbook_file = None
+
+    def read_sheets(self):
+        self.workbook = self.load_workbook()
+
         self.sheet_names_map = OrderedDict((sheet_name, sheet_name) for sheet_name in self.workbook.sheetnames)
         if self.include_sheets:
             for sheet in list(self.sheet_names_map):
@@ -582,8 +830,46 @@ class XLSXInput(SpreadsheetInput):
         self.sub_sheet_names = sheet_names
         self.configure_sheets()
 
+    def sheet_rows(self, sheet_name):
+        """
+        Iterate over the values of each row of a sheet of a read-only
+        workbook, from the first row, as tuples that stop at the last cell in
+        the row.
+
+        """
+        worksheet = self.worksheet(sheet_name)
+        # Don't trust the dimensions the file gives, which pad every row to
+        # the size of the sheet
+        worksheet.reset_dimensions()
+        return worksheet.iter_rows(values_only=True)
+
+    def sheet_lines(self, sheet_name):
+        """
+        Iterate over the values of each line of a sheet of a read-only
+        workbook: its rows, or its columns with vertical_orientation.
+
+        """
+        if not self.vertical_orientation:
+            return self.sheet_rows(sheet_name)
+        rows = list(self.sheet_rows(sheet_name))
+        while rows and all(value is None for value in rows[-1]):
+            rows.pop()
+        return zip_longest(*rows)
+
+    def heading_line(self, lines, skip_rows, configuration_line):
+        """
+        Return the values of the heading line of a sheet, from lines (see
+        sheet_lines), or None if the sheet ends before it. The lines after it
+        are left in lines.
+
+        """
+        if self.vertical_orientation:
+            heading_line = next(itertools.islice(lines, skip_rows, None), None)
+            return heading_line[configuration_line:] if heading_line is not None else None
+        return next(itertools.islice(lines, skip_rows + configuration_line, None), None)
+
     def get_sheet_headings(self, sheet_name):
-        worksheet = self.workbook[self.sheet_names_map[sheet_name]]
+        worksheet = self.worksheet(sheet_name)
         sheet_configuration = self.sheet_configuration[self.sheet_names_map[sheet_name]]
         configuration_line = 1 if sheet_configuration else 0
         if not sheet_configuration:
@@ -597,6 +883,11 @@ class XLSXInput(SpreadsheetInput):
             # returning empty headers is a proxy for no data in the sheet.
             return []
 
+        if self.read_only:
+            heading_line = self.heading_line(self.sheet_lines(sheet_name), skip_rows, configuration_line)
+            # If the heading line is after data in the spreadsheet. i.e when skipRows
+            return list(heading_line) if heading_line is not None else []
+
         if self.vertical_orientation:
             return [cell.value for cell in worksheet[_get_column_letter(skip_rows + 1)][configuration_line:]]
 
@@ -607,7 +898,12 @@ class XLSXInput(SpreadsheetInput):
             return []
 
     def get_sheet_configuration(self, sheet_name):
-        worksheet = self.workbook[self.sheet_names_map[sheet_name]]
+        if self.read_only:
+            first_row = next(self.sheet_rows(sheet_name), None)
+            if first_row and first_row[0] == '#':
+                return [value for value in first_row[1:] if value]
+            return []
+        worksheet = self.worksheet(sheet_name)
         if worksheet['A1'].value == '#':
             return [cell.value for num, cell in enumerate(worksheet[1]) if num != 0 and cell.value]
         else:
@@ -624,8 +920,19 @@ class XLSXInput(SpreadsheetInput):
         skip_rows = sheet_configuration.get("skipRows", 0)
         header_rows = sheet_configuration.get("headerRows", 1)
 
-
-        worksheet = self.workbook[self.sheet_names_map[sheet_name]]
+        if self.read_only:
+            lines = self.sheet_lines(sheet_name)
+            heading_line = self.heading_line(lines, skip_rows, configuration_line)
+            if heading_line is None:
+                return
+            remaining_lines = itertools.islice(lines, header_rows - 1, None)
+            if self.vertical_orientation and configuration_line:
+                remaining_lines = (line[1:] for line in remaining_lines)
+            for line in self.read_only_lines(heading_line, remaining_lines, sheet_configuration):
+                yield line
+            return
+
+        worksheet = self.worksheet(sheet_name)
         if self.vertical_orientation:
             header_row = worksheet[_get_column_letter(skip_rows + 1)]
             remaining_rows = worksheet.iter_cols(min_col=skip_rows + header_rows + 1)
@@ -654,6 +961,36 @@ class XLSXInput(SpreadsheetInput):
                 output_row[header] = value
             yield output_row
 
+    def read_only_lines(self, heading_line, remaining_lines, sheet_configuration):
+        """
+        Make the lines of a sheet of a read-only workbook from the values of
+        its heading line and the lines after it. Empty lines are only
+        returned once a line with data follows them, so that the lines are
+        numbered as in the sheet.
+
+        """
+        hashcomments = sheet_configuration.get("hashcomments")
+        headers = list(heading_line)
+        empty_lines = 0
+        for line in remaining_lines:
+            if all(value is None for value in line):
+                empty_lines += 1
+                continue
+            for _ in range(empty_lines):
+                yield OrderedDict((header, None) for header in headers)
+            empty_lines = 0
+            output_row = OrderedDict()
+            for i, header in enumerate(headers):
+                value = line[i] if i < len(line) else None
+                if not header:
+                    # None means that the cell will be ignored
+                    value = None
+                elif hashcomments and header.startswith('#'):
+                    # None means that the cell will be ignored
+                    value = None
+                output_row[header] = value
+            yield output_row
+
 FORMATS = {
     'xlsx': XLSXInput,
     'csv': CSVInput
@@ -680,117 +1017,237 @@ def list_as_dicts_to_temporary_dicts(unflattened, id_name, xml):
     return unflattened
 
 
-def unflatten_main_with_parser(parser, line, timezone, xml, id_name):
-    unflattened = OrderedDict()
-    for path, cell in line.items():
-        # Skip blank cells
-        if cell.cell_value is None or cell.cell_value == '':
-            continue
-        current_path = unflattened
+# The kinds of step in the plan for a heading, see UnflattenPlan
+ARRAY_STEP = 0
+OBJECT_STEP = 1
+VALUE_STEP = 2
+NUMBER_WARNING_STEP = 3
+ERROR_STEP = 4
+
+
+class UnflattenPlan(object):
+    """
+    A compiled plan for unflattening the lines of a sheet.
+
+    Each heading is compiled, the first time a line has a value for it, into
+    the steps that put a value in place: the arrays and objects to walk
+    through (with their schema types and list indexes), then the value and
+    the converter for its type. unflatten_main_with_parser then only has to
+    take the steps for each cell, rather than working them out again for
+    every line.
+
+    """
+
+    # The number of converted datetimes to keep
+    datetime_cache_size = 2 ** 12
+
+    def __init__(self, parser=None, xml=False):
+        self.parser = parser
+        self.xml = xml
+        # The steps for each heading, and for XML headings of cells whose
+        # values are datetimes (which are converted to dates)
+        self.heading_steps = {}
+        self.date_heading_steps = {}
+        self.letters = []
+        # The warnings given, as (heading, message)
+        self.warned = set()
+        # Converted datetimes, by converter, timezone and datetime
+        self.datetimes = {}
+
+    def steps(self, path, value):
+        """
+        Return the steps for a cell with the heading path and value value.
+
+        """
+        if self.xml and type(value) == datetime.datetime and 'datetime' not in text_type(path):
+            heading_steps = self.date_heading_steps
+        else:
+            heading_steps = self.heading_steps
+        try:
+            return heading_steps[path]
+        except KeyError:
+            steps = heading_steps[path] = self.compile(path, heading_steps is self.date_heading_steps)
+            return steps
+
+    def column_letters(self, count):
+        """
+        Return a list of the letters of (at least) the first count columns.
+
+        """
+        while len(self.letters) < count:
+            self.letters.append(_get_column_letter(len(self.letters) + 1))
+        return self.letters
+
+    def compile(self, path, date):
+        xml = self.xml
+        steps = []
         path_list = [item.rstrip('[]') for item in text_type(path).split('/')]
+        numbers = [isint(item) for item in path_list]
         for num, path_item in enumerate(path_list):
-            if isint(path_item):
+            if numbers[num]:
                 if num == 0:
-                    warn('Column "{}" has been ignored because it is a number.'.format(path), DataErrorWarning)
+                    steps.append((NUMBER_WARNING_STEP,
+                                  'Column "{}" has been ignored because it is a number.'.format(path)))
                 continue
             current_type = None
-            path_till_now = '/'.join([item for item in path_list[:num + 1] if not isint(item)])
-            if parser:
-                current_type = parser.flattened.get(path_till_now)
+            path_till_now = '/'.join([item for item, number in zip(path_list[:num + 1], numbers) if not number])
+            if self.parser:
+                current_type = self.parser.flattened.get(path_till_now)
             try:
                 next_path_item = path_list[num + 1]
             except IndexError:
                 next_path_item = ''
 
             # Quick solution to avoid casting of date as datetinme in spreadsheet > xml
-            if xml:
-                if type(cell.cell_value) == datetime.datetime and not next_path_item:
-                    if 'datetime' not in path:
-                        current_type = 'date'
+            # (unless an earlier step has converted the value to text)
+            if date and not next_path_item and not any(step[0] == VALUE_STEP for step in steps):
+                current_type = 'date'
 
             ## Array
             list_index = -1
-            if isint(next_path_item):
+            if next_path_item and numbers[num + 1]:
                 if current_type and current_type != 'array':
-                    raise ValueError("There is an array at '{}' when the schema says there should be a '{}'".format(path_till_now, current_type))
+                    steps.append((ERROR_STEP, "There is an array at '{}' when the schema says there should be a '{}'".format(path_till_now, current_type)))
+                    break
                 list_index = int(next_path_item)
                 current_type = 'array'
 
             if current_type == 'array':
+                steps.append((ARRAY_STEP, path_item, path_till_now, list_index))
+                if not xml or num < len(path_list)-2:
+                    # In xml "arrays" can have text values, if they're the final element
+                    # This corresponds to a tag with text, but also possibly attributes
+                    continue
+
+            ## Object
+            if current_type == 'object' or (not current_type and next_path_item):
+                steps.append((OBJECT_STEP, path_item, path_till_now))
+                continue
+            if current_type and current_type not in ['object', 'array'] and next_path_item:
+                steps.append((ERROR_STEP, "There is an object or list at '{}' but it should be an {}".format(path_till_now, current_type)))
+                break
+
+            ## Other Types
+            if xml and current_type == 'array':
+                # In xml "arrays" can have text values, if they're the final element
+                # However the type of the text value itself should not be "array",
+                # as that would split the text on commas, which we don't want.
+                # https://github.com/OpenDataServices/cove/issues/1030
+                converter = get_converter('')
+            else:
+                converter = get_converter(current_type or '')
+            steps.append((VALUE_STEP, path_item, path_till_now, current_type, converter))
+        return steps
+
+    def convert(self, path, converter, value, timezone, raw_numbers):
+        """
+        Convert the value of a cell with the heading path, like convert_type.
+        Conversions of datetimes are cached, and each warning is only given
+        once for each column.
+
+        """
+        if value == '' or value is None:
+            return None
+        if type(value) == datetime.datetime:
+            key = (converter, timezone, value)
+            try:
+                converted_value, message = self.datetimes[key]
+            except KeyError:
+                if len(self.datetimes) >= self.datetime_cache_size:
+                    self.datetimes.clear()
+                converted_value, message = self.datetimes[key] = converter(value, timezone, raw_numbers)
+        else:
+            converted_value, message = converter(value, timezone, raw_numbers)
+        if message and (path, message) not in self.warned:
+            self.warned.add((path, message))
+            warn(message, DataErrorWarning)
+        return converted_value
+
+
+def unflatten_main_with_parser(parser, line, timezone, xml, id_name, raw_numbers=False, plan=None):
+    """
+    Unflatten a line of cells (Cell objects, by heading) into a dict, using
+    plan (an UnflattenPlan), or a new plan if none is given.
+
+    """
+    if plan is None:
+        plan = UnflattenPlan(parser, xml)
+    unflattened = OrderedDict()
+    for path, cell in line.items():
+        # Skip blank cells
+        if cell.cell_value is None or cell.cell_value == '':
+            continue
+        current_path = unflattened
+        for step in plan.steps(path, cell.cell_value):
+            kind = step[0]
+            if kind == ARRAY_STEP:
+                path_item = step[1]
                 list_as_dict = current_path.get(path_item)
                 if list_as_dict is None:
                     list_as_dict = ListAsDict()
                     current_path[path_item] = list_as_dict
                 elif type(list_as_dict) is not ListAsDict:
-                    warn('Column {} has been ignored, because it treats {} as an array, but another column does not.'.format(path, path_till_now),
+                    warn('Column {} has been ignored, because it treats {} as an array, but another column does not.'.format(path, step[2]),
                         DataErrorWarning)
                     break
-                new_path = list_as_dict.get(list_index)
+                new_path = list_as_dict.get(step[3])
                 if new_path is None:
                     new_path = OrderedDict()
-                    list_as_dict[list_index] = new_path
+                    list_as_dict[step[3]] = new_path
                 current_path = new_path
-                if not xml or num < len(path_list)-2:
-                    # In xml "arrays" can have text values, if they're the final element
-                    # This corresponds to a tag with text, but also possibly attributes
-                    continue
 
-            ## Object
-            if current_type == 'object' or (not current_type and next_path_item):
+            elif kind == OBJECT_STEP:
+                path_item = step[1]
                 new_path = current_path.get(path_item)
                 if new_path is None:
                     new_path = OrderedDict()
                     current_path[path_item] = new_path
                 elif type(new_path) is ListAsDict or not hasattr(new_path, 'items'):
-                    warn('Column {} has been ignored, because it treats {} as an object, but another column does not.'.format(path, path_till_now),
+                    warn('Column {} has been ignored, because it treats {} as an object, but another column does not.'.format(path, step[2]),
                         DataErrorWarning)
                     break
                 current_path = new_path
-                continue
-            if current_type and current_type not in ['object', 'array'] and next_path_item:
-                raise ValueError("There is an object or list at '{}' but it should be an {}".format(path_till_now, current_type))
 
-            ## Other Types
-            current_path_value = current_path.get(path_item)
-            if not xml and (type(current_path_value) is ListAsDict or hasattr(current_path_value, 'items')):
-                #   ^
-                # xml can have an object/array that also has a text value
-                warn(
-                    'Column {} has been ignored, because another column treats it as an array or object'.format(
-                        path_till_now),
-                    DataErrorWarning)
-                continue
+            elif kind == VALUE_STEP:
+                path_item, path_till_now, current_type, converter = step[1:]
+                current_path_value = current_path.get(path_item)
+                if not xml and (type(current_path_value) is ListAsDict or hasattr(current_path_value, 'items')):
+                    #   ^
+                    # xml can have an object/array that also has a text value
+                    warn(
+                        'Column {} has been ignored, because another column treats it as an array or object'.format(
+                            path_till_now),
+                        DataErrorWarning)
+                    continue
 
-            value = cell.cell_value
-            if xml and current_type == 'array':
-                # In xml "arrays" can have text values, if they're the final element
-                # However the type of the text value itself should not be "array",
-                # as that would split the text on commas, which we don't want.
-                # https://github.com/OpenDataServices/cove/issues/1030
-                converted_value = convert_type('', value, timezone)
-            else:
-                converted_value = convert_type(current_type or '', value, timezone)
-            cell.cell_value = converted_value
-            if converted_value is not None and converted_value != '':
-                if xml:
-                    # For XML we want to support text and attributes at the
-                    # same level, e.g.
-                    # <my-element a="b">some text</my-element>
-                    # which we represent in a dict as:
-                    # {"@a":"b", "text()": "some text"}
-                    # To ensure we can attach attributes everywhere, all
-                    # element text must be added as a dict with a `text()` key.
-                    if path_item.startswith('@'):
-                        current_path[path_item] = cell
-                    else:
-                        if current_type == 'array':
-                            current_path['text()'] = cell
-                        elif path_item not in current_path:
-                            current_path[path_item] = {'text()': cell}
+                converted_value = plan.convert(path, converter, cell.cell_value, timezone, raw_numbers)
+                cell.cell_value = converted_value
+                if converted_value is not None and converted_value != '':
+                    if xml:
+                        # For XML we want to support text and attributes at the
+                        # same level, e.g.
+                        # <my-element a="b">some text</my-element>
+                        # which we represent in a dict as:
+                        # {"@a":"b", "text()": "some text"}
+                        # To ensure we can attach attributes everywhere, all
+                        # element text must be added as a dict with a `text()` key.
+                        if path_item.startswith('@'):
+                            current_path[path_item] = cell
                         else:
-                            current_path[path_item]['text()'] = cell
-                else:
-                    current_path[path_item] = cell
+                            if current_type == 'array':
+                                current_path['text()'] = cell
+                            elif path_item not in current_path:
+                                current_path[path_item] = OrderedDict([('text()', cell)])
+                            else:
+                                current_path[path_item]['text()'] = cell
+                    else:
+                        current_path[path_item] = cell
+
+            elif kind == NUMBER_WARNING_STEP:
+                warn(step[1], DataErrorWarning)
+
+            else:
+                raise ValueError(step[1])
 
     unflattened = list_as_dicts_to_temporary_dicts(unflattened, id_name, xml)
     return unflattened
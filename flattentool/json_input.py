@@ -6,19 +6,27 @@ JSON schema, for that see schema.py).
 """
 
 import os
-import json
 import six
 import copy
-from collections import OrderedDict
+import itertools
+import multiprocessing
+import warnings
+from collections import OrderedDict, deque
 from decimal import Decimal
-from flattentool.schema import SchemaParser, make_sub_sheet_name
+from flattentool.schema import SchemaParser, FlattenPlan
+from flattentool.compression import STDIN, is_plain_file, open_input
+from flattentool.decoders import get_decoder
+from flattentool.filters import FieldPredicate, IdsPredicate, RecordFilter, path_values
 from flattentool.input import path_search
+from flattentool.lib import RawNumber
+from flattentool.output import PARTITION_KEY
 from flattentool.sheet import Sheet
+from flattentool.xml_input import iter_xml_root_list
 from warnings import warn
 import codecs
 import xmltodict
 
-BASIC_TYPES = [six.text_type, bool, int, Decimal, type(None)]
+BASIC_TYPES = [six.text_type, bool, int, Decimal, RawNumber, type(None)]
 
 
 class BadlyFormedJSONError(ValueError):
@@ -29,6 +37,36 @@ class BadlyFormedJSONErrorUTF8(BadlyFormedJSONError):
     pass
 
 
+def is_utf8_error(err, json_filename):
+    """
+    Return whether err, an ijson.JSONError from reading json_filename, is
+    because the file isn't valid UTF-8. ijson's C backend gives a lexical
+    error rather than a UnicodeError, so if the message doesn't say, the
+    file is checked (unless it's standard input, which can't be read again).
+
+    """
+    if not err.args:
+        return False
+    message = err.args[0]
+    if isinstance(message, UnicodeError):
+        return True
+    if isinstance(message, bytes):
+        message = message.decode('utf-8', 'replace')
+    if 'UTF8' in six.text_type(message):
+        return True
+    if json_filename == STDIN:
+        return False
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open_input(json_filename) as json_file:
+        try:
+            for chunk in iter(lambda: json_file.read(2 ** 16), b''):
+                decoder.decode(chunk)
+            decoder.decode(b'', True)
+        except UnicodeError:
+            return True
+    return False
+
+
 def sheet_key_field(sheet, key):
     if key not in sheet:
         sheet.append(key)
@@ -89,14 +127,107 @@ def list_dict_consistency(xml_dict):
     dicts_to_list_of_dicts(lists_of_dicts_paths_set, xml_dict)
 
 
+# Set in each worker process by init_worker
+worker_parser = None
+
+
+def init_worker(parser):
+    global worker_parser
+    worker_parser = parser
+
+
+def parse_in_worker(method_name, *args):
+    """
+    Call a parse method of a copy of worker_parser in a worker process, with
+    fresh copies of the sheets that worker_parser started with.
+
+    Warnings are returned, rather than shown, so that the main process can
+    give them in the same order as parsing in one process would.
+
+    """
+    parser = copy.copy(worker_parser)
+    parser.main_sheet = copy.deepcopy(worker_parser.main_sheet)
+    parser.sub_sheets = copy.deepcopy(worker_parser.sub_sheets)
+    parser.seen_paths = set()
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter('always')
+        getattr(parser, method_name)(*args)
+    return (
+        parser.main_sheet,
+        parser.sub_sheets,
+        parser.seen_paths,
+        parser.ids_predicate.found if parser.ids_predicate else set(),
+        [(six.text_type(w.message), w.category) for w in caught_warnings]
+    )
+
+
+def parse_chunk(json_dicts):
+    """Parse a chunk of the root list in a worker process."""
+    return parse_in_worker('parse_json_list', json_dicts)
+
+
+def parse_file(json_filename):
+    """Read and parse one of several input files in a worker process."""
+    return parse_in_worker('parse_json_file', json_filename)
+
+
+def parse_json_lines_chunk(json_filename, start, end, line_number):
+    """Read and parse a chunk of a JSON Lines file in a worker process."""
+    return parse_in_worker('parse_json_lines', json_filename, start, end, line_number)
+
+
+def json_lines_chunks(json_filename, chunk_size):
+    """
+    Yield (start, end, line_number) for chunks of about chunk_size bytes of a
+    JSON Lines file, split at the ends of lines. start and end are byte
+    offsets, and line_number is the number of the first line of the chunk.
+
+    """
+    line_number = 1
+    with open(json_filename, 'rb') as json_file:
+        while True:
+            start = json_file.tell()
+            block = json_file.read(chunk_size)
+            if not block:
+                return
+            if not block.endswith(b'\n'):
+                # Carry on to the end of the line
+                block += json_file.readline()
+            yield start, start + len(block), line_number
+            line_number += block.count(b'\n')
+
+
+def add_id_field(id_fields, column, value):
+    """
+    Return id_fields, a tuple of (column, value) pairs, with the value for
+    column added at the end, or replaced where it is if column is already
+    there.
+
+    id_fields are passed down to nested objects as they are, so only objects
+    with ids make a new tuple.
+
+    """
+    for position, (existing_column, _) in enumerate(id_fields):
+        if existing_column == column:
+            return id_fields[:position] + ((column, value),) + id_fields[position + 1:]
+    return id_fields + ((column, value),)
+
+
 class JSONParser(object):
     # Named for consistency with schema.SchemaParser, but not sure it's the most appropriate name.
     # Similarily with methods like parse_json_dict
 
+    # Number of items of the root list given to a worker process at a time
+    chunk_size = 1000
+    # Number of bytes of a JSON Lines file given to a worker process at a time
+    json_lines_chunk_size = 2 ** 24
+
     def __init__(self, json_filename=None, root_json_dict=None, schema_parser=None, root_list_path=None,
                  root_id='ocid', use_titles=False, xml=False, id_name='id', filter_field=None,
                  filter_value=None, preserve_fields=None, remove_empty_schema_columns=False,
-                 rollup=False, truncation_length=3):
+                 rollup=False, truncation_length=3, streaming=False, workers=1, xml_schemas=None,
+                 filters=None, id_list=None, source_file_column=None, json_lines=False, json_decoder='stdlib',
+                 raw_numbers=False, incremental=None, partition_by=None):
         self.sub_sheets = {}
         self.main_sheet = Sheet()
         self.root_list_path = root_list_path
@@ -107,8 +238,43 @@ class JSONParser(object):
         self.xml = xml
         self.filter_field = filter_field
         self.filter_value = filter_value
+        predicates = list(filters or [])
+        if self.filter_field and self.filter_value:
+            predicates.insert(0, FieldPredicate(self.filter_field, self.filter_value))
+        if id_list:
+            # Extract the ids to be flattened from input file (one per line),
+            # they are matched on the root id if there is one.
+            with codecs.open(id_list, encoding='utf-8') as id_list_file:
+                ids = set(line.strip() for line in id_list_file)
+            ids.discard('')
+            self.ids_predicate = IdsPredicate(self.root_id or self.id_name, ids)
+            predicates.insert(0, self.ids_predicate)
+        else:
+            self.ids_predicate = None
+        self.record_filter = RecordFilter(predicates) if predicates else None
         self.remove_empty_schema_columns = remove_empty_schema_columns
         self.seen_paths = set()
+        self.streaming = streaming
+        self.workers = workers
+        self.json_filename = None
+        self.xml_schemas = xml_schemas
+        self.source_file_column = source_file_column
+        self.json_lines = json_lines
+        # An incremental.FingerprintStore, if only new or changed records are
+        # to be flattened
+        self.incremental = incremental
+        # The path of the value of each item that every line of it is given,
+        # under output.PARTITION_KEY, to partition the output by
+        self.partition_path = partition_by.split('/') if partition_by else None
+        # Decodes JSON input (not in streaming mode), see decoders.DECODERS
+        self.json_decoder = get_decoder(json_decoder, raw_numbers=raw_numbers)
+        if raw_numbers and streaming and not xml:
+            warn('raw_numbers has no effect in streaming mode, numbers are read as Decimals by ijson')
+        # The line of a JSON Lines file that is being parsed, see data_warning
+        self.line_number = None
+        # Called to create the lines of any sub sheet found while parsing,
+        # replaced when lines are streamed straight to the output.
+        self.lines_factory = list
         
         if schema_parser:
             self.main_sheet = copy.deepcopy(schema_parser.main_sheet)
@@ -147,33 +313,26 @@ class JSONParser(object):
             else:
                 warn('Invalid value passed for rollup (pass json path directly, as a list in a file, or via a schema)')
 
-        if self.xml:
-            with codecs.open(json_filename, 'rb') as xml_file:
-                top_dict = xmltodict.parse(
-                    xml_file,
-                    force_list=(root_list_path,),
-                    force_cdata=True,
-                    )
-                # AFAICT, this should be true for *all* XML files
-                assert len(top_dict) == 1
-                root_json_dict = list(top_dict.values())[0]
-                list_dict_consistency(root_json_dict)
-            json_filename = None
+        self.json_filenames = None
+        # The input file that is being parsed, see source_file_column
+        self.source_file = None
+        if isinstance(json_filename, (list, tuple)):
+            if len(json_filename) == 1:
+                json_filename = json_filename[0]
+            else:
+                # Each file is read when it's parsed, see parse_json_file
+                self.json_filenames = list(json_filename)
+                json_filename = None
 
-        if json_filename is None and root_json_dict is None:
+        if json_filename is None and root_json_dict is None and not self.json_filenames:
             raise ValueError('Etiher json_filename or root_json_dict must be supplied')
 
-        if json_filename is not None and root_json_dict is not None:
+        if (json_filename is not None or self.json_filenames) and root_json_dict is not None:
             raise ValueError('Only one of json_file or root_json_dict should be supplied')
 
-        if json_filename:
-            with codecs.open(json_filename, encoding='utf-8') as json_file:
-                try:
-                    self.root_json_dict = json.load(json_file, object_pairs_hook=OrderedDict, parse_float=Decimal)
-                except UnicodeError as err:
-                    raise BadlyFormedJSONErrorUTF8(*err.args)
-                except ValueError as err:
-                    raise BadlyFormedJSONError(*err.args)
+        if json_filename is not None:
+            self.source_file = json_filename
+            self.json_filename, self.root_json_dict = self.read_json_file(json_filename)
         else:
             self.root_json_dict = root_json_dict
 
@@ -185,8 +344,9 @@ class JSONParser(object):
                 for line in preserve_fields_file:
                     line = line.strip()
                     path_fields = line.rsplit('/', 1)
-                    preserve_fields_all = preserve_fields_all + path_fields + [line.rstrip('/')]
-                    preserve_fields_input = preserve_fields_input + [line.rstrip('/')]
+                    preserve_fields_all.extend(path_fields)
+                    preserve_fields_all.append(line.rstrip('/'))
+                    preserve_fields_input.append(line.rstrip('/'))
 
             self.preserve_fields = set(preserve_fields_all)
             self.preserve_fields_input = set(preserve_fields_input)
@@ -204,19 +364,252 @@ class JSONParser(object):
             self.preserve_fields = None
             self.preserve_fields_input = None
 
+        plan_options = dict(
+            use_titles=self.use_titles,
+            rollup=self.rollup,
+            preserve_fields=self.preserve_fields,
+            truncation_length=self.truncation_length,
+            xml=self.xml,
+            id_name=self.id_name,
+            root_id=self.root_id,
+        )
+        if self.schema_parser:
+            self.plan = self.schema_parser.flatten_plan(**plan_options)
+        else:
+            self.plan = FlattenPlan(**plan_options)
 
-    def parse(self):
+
+    def read_json_file(self, json_filename):
+        """
+        Read an input file, returning (json_filename, root_json_dict).
+
+        In streaming mode, and for JSON Lines, the file is read incrementally
+        by parse() (see iter_root_json_list), so only json_filename is
+        returned, otherwise root_json_dict is the whole file, and
+        json_filename is None.
+
+        """
+        if self.streaming or self.json_lines:
+            return json_filename, None
+        if self.xml:
+            with open_input(json_filename) as xml_file:
+                top_dict = xmltodict.parse(
+                    xml_file,
+                    force_list=(self.root_list_path,),
+                    force_cdata=True,
+                    )
+                # AFAICT, this should be true for *all* XML files
+                assert len(top_dict) == 1
+                root_json_dict = list(top_dict.values())[0]
+                list_dict_consistency(root_json_dict)
+            return None, root_json_dict
+        with open_input(json_filename) as json_file:
+            try:
+                return None, self.json_decoder.load(json_file)
+            except UnicodeError as err:
+                raise BadlyFormedJSONErrorUTF8(*err.args)
+            except ValueError as err:
+                raise BadlyFormedJSONError(*err.args)
+
+    def iter_root_json_list(self):
+        """
+        Return an iterator over the items of the root list that match
+        self.record_filter (if any).
+
+        Items are filtered as soon as they are read, so those that don't
+        match are never flattened, or sent to worker processes.
+
+        """
+        if self.xml and self.json_filename is not None:
+            # Elements are filtered before being converted to dicts
+            return iter_xml_root_list(self.json_filename, self.root_list_path, self.xml_schemas,
+                                      record_filter=self.record_filter)
+        return self.filter_root_json_list(self.read_root_json_list())
+
+    def filter_root_json_list(self, json_dicts):
+        if self.record_filter is None:
+            return json_dicts
+        return (json_dict for json_dict in json_dicts if json_dict is not None and self.record_filter(json_dict))
+
+    def read_json_lines(self, json_filename, start=0, end=None, line_number=1):
+        """
+        Yield the object on each line of a JSON Lines file, from the byte
+        offset start to end (see json_lines_chunks), one line at a time.
+
+        self.line_number is set to the number of the line each object is
+        from, while it's being parsed.
+
+        """
+        with open_input(json_filename) as json_file:
+            if start:
+                json_file.seek(start)
+            position = start
+            for line in json_file:
+                if end is not None and position >= end:
+                    break
+                position += len(line)
+                self.line_number = line_number
+                line_number += 1
+                if not line.strip():
+                    continue
+                try:
+                    json_dict = self.json_decoder.loads(line)
+                except UnicodeError as err:
+                    raise BadlyFormedJSONErrorUTF8('Line {}: {}'.format(self.line_number, err))
+                except ValueError as err:
+                    raise BadlyFormedJSONError('Line {}: {}'.format(self.line_number, err))
+                yield json_dict
+        self.line_number = None
+
+    def read_root_json_list(self):
+        """
+        Yield each item of the root list.
+
+        In streaming mode the input file is read incrementally with ijson, so
+        only one item is held in memory at a time. For JSON Lines the root
+        list is the lines of the file.
+
+        """
+        if self.json_filename is None:
+            if self.root_list_path is None:
+                root_json_list = self.root_json_dict
+            else:
+                root_json_list = path_search(self.root_json_dict, self.root_list_path.split('/'))
+            for json_dict in root_json_list:
+                yield json_dict
+            return
+
+        if self.json_lines:
+            for json_dict in self.read_json_lines(self.json_filename):
+                yield json_dict
+            return
+
+        try:
+            import ijson
+        except ImportError:
+            raise ImportError('Streaming mode requires the ijson package, install it with: pip install flattentool[streaming]')
         if self.root_list_path is None:
-            root_json_list = self.root_json_dict
+            prefix = 'item'
         else:
-            root_json_list = path_search(self.root_json_dict, self.root_list_path.split('/'))
-        for json_dict in root_json_list:
+            prefix = '.'.join(self.root_list_path.split('/') + ['item'])
+        with open_input(self.json_filename) as json_file:
+            items = ijson.items(json_file, prefix, map_type=OrderedDict)
+            while True:
+                try:
+                    json_dict = next(items)
+                except StopIteration:
+                    return
+                except UnicodeError as err:
+                    raise BadlyFormedJSONErrorUTF8(*err.args)
+                except ijson.JSONError as err:
+                    if is_utf8_error(err, self.json_filename):
+                        raise BadlyFormedJSONErrorUTF8(*err.args)
+                    raise BadlyFormedJSONError(*err.args)
+                yield json_dict
+
+    def parse_json_list(self, json_dicts):
+        for json_dict in json_dicts:
             if json_dict is None:
                 # This is particularly useful for IATI XML, in order to not
                 # fallover on empty activity, e.g. <iati-activity/>
                 continue
+            if self.incremental is not None:
+                self.incremental.parse_record(self, json_dict)
+                continue
             self.parse_json_dict(json_dict, sheet=self.main_sheet)
 
+    def parse_json_file(self, json_filename):
+        """
+        Read and parse one of several input files (see json_filenames) into
+        the sheets of this parser.
+
+        """
+        file_parser = copy.copy(self)
+        file_parser.source_file = json_filename
+        file_parser.json_filename, file_parser.root_json_dict = self.read_json_file(json_filename)
+        file_parser.parse_json_list(file_parser.iter_root_json_list())
+
+    def parse_json_lines(self, json_filename, start, end, line_number):
+        """
+        Parse a chunk of a JSON Lines file (see json_lines_chunks) into the
+        sheets of this parser.
+
+        """
+        self.parse_json_list(self.filter_root_json_list(
+            self.read_json_lines(json_filename, start, end, line_number)))
+
+    def parse_in_workers(self):
+        """
+        Parse in a pool of worker processes, and merge the resulting sheets in
+        order. The result is the same as parsing in one process.
+
+        With several input files, each is read and parsed by a worker. A JSON
+        Lines file is split into chunks of bytes, each read and parsed by a
+        worker, unless it's compressed. Otherwise the root list is read here and split into chunks.
+
+        """
+        # What the workers need to parse a chunk: the settings, and the sheets
+        # as they are before any data is parsed, but not the data itself.
+        template = copy.copy(self)
+        template.root_json_dict = None
+        template.json_filename = None
+        if self.json_filenames:
+            tasks = ((parse_file, (json_filename,)) for json_filename in self.json_filenames)
+        elif self.json_lines and self.json_filename is not None and is_plain_file(self.json_filename):
+            tasks = ((parse_json_lines_chunk, (self.json_filename,) + chunk)
+                     for chunk in json_lines_chunks(self.json_filename, self.json_lines_chunk_size))
+        else:
+            root_json_list = self.iter_root_json_list()
+            chunks = iter(lambda: list(itertools.islice(root_json_list, self.chunk_size)), [])
+            tasks = ((parse_chunk, (chunk,)) for chunk in chunks)
+            # Items are filtered before they are sent to the workers
+            template.record_filter = None
+            template.ids_predicate = None
+        template.main_sheet = copy.copy(self.main_sheet)
+        template.main_sheet.lines = []
+        template.sub_sheets = {}
+        for sheet_name, sheet in self.sub_sheets.items():
+            template.sub_sheets[sheet_name] = copy.copy(sheet)
+            template.sub_sheets[sheet_name].lines = []
+        template.lines_factory = list
+
+        def merge(result):
+            main_sheet, sub_sheets, seen_paths, found_ids, caught_warnings = result
+            for message, category in caught_warnings:
+                warn(message, category)
+            self.main_sheet.merge(main_sheet)
+            for sheet_name, sheet in sub_sheets.items():
+                if sheet_name not in self.sub_sheets:
+                    self.sub_sheets[sheet_name] = Sheet(name=sheet_name, lines=self.lines_factory())
+                self.sub_sheets[sheet_name].merge(sheet)
+            self.seen_paths.update(seen_paths)
+            if self.ids_predicate:
+                self.ids_predicate.found.update(found_ids)
+
+        pool = multiprocessing.Pool(self.workers, initializer=init_worker, initargs=(template,))
+        try:
+            # Only a few tasks are handed out ahead of being merged, so that
+            # with streaming the input isn't all read into memory at once.
+            pending = deque()
+            for function, args in tasks:
+                pending.append(pool.apply_async(function, args))
+                if len(pending) >= 2 * self.workers:
+                    merge(pending.popleft().get())
+            while pending:
+                merge(pending.popleft().get())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def parse(self):
+        if self.workers > 1 and self.incremental is None:
+            self.parse_in_workers()
+        elif self.json_filenames:
+            for json_filename in self.json_filenames:
+                self.parse_json_file(json_filename)
+        else:
+            self.parse_json_list(self.iter_root_json_list())
+
         if self.remove_empty_schema_columns:
             # Remove sheets with no lines of data
             for sheet_name, sheet in list(self.sub_sheets.items()):
@@ -231,157 +624,193 @@ class JSONParser(object):
             if len(nonexistent_input_paths) > 0:
                 warn('You wanted to preserve the following fields which are not present in the input data: {}'.format(nonexistent_input_paths))
 
+        if self.ids_predicate:
+            nonexistent_ids = sorted(self.ids_predicate.not_found())
+            if nonexistent_ids:
+                warn('You wanted to flatten the following ids which are not present in the input data: {}'.format(nonexistent_ids))
 
-    def parse_json_dict(self, json_dict, sheet, json_key=None, parent_name='', flattened_dict=None, parent_id_fields=None, top_level_of_sub_sheet=False):
-        """
-        Parse a json dictionary.
 
-        json_dict - the json dictionary
-        sheet - a sheet.Sheet object representing the resulting spreadsheet
-        json_key - the key that maps to this JSON dict, either directly to the dict, or to a dict that this list contains.  Is None if this dict is contained in root_json_list directly.
+    def start_json_dict(self, json_dict, node, sheet, flattened_dict=None, parent_id_fields=(), top_level_of_sub_sheet=False):
         """
-        # Possibly main_sheet should be main_sheet_columns, but this is
-        # currently named for consistency with schema.py
+        Start parsing a json dictionary found at the path of the given plan
+        node. Returns the stack frame for parse_json_dict to carry on with.
 
-        if self.use_titles:
-            sheet_key = sheet_key_title
-        else:
-            sheet_key = sheet_key_field
+        parent_id_fields is a tuple of (column, value) pairs, see
+        add_id_field. It's only replaced (not copied) when this dictionary
+        has ids of its own.
 
-        parent_id_fields = copy.copy(parent_id_fields) or OrderedDict()
+        """
         if flattened_dict is None:
             flattened_dict = {}
             top = True
         else:
             top = False
 
-        if parent_name == '' and self.filter_field and self.filter_value:
-            if self.filter_field not in json_dict:
-                return
-            if json_dict[self.filter_field] != self.filter_value:
-                return
-
         if top_level_of_sub_sheet:
             # Add the IDs for the top level of object in an array
-            for k, v in parent_id_fields.items():
-                if self.xml:
-                    flattened_dict[sheet_key(sheet, k)] = v['#text']
+            for k, v in parent_id_fields:
+                if k == PARTITION_KEY:
+                    # Not a column
+                    flattened_dict[k] = v
+                    continue
+                column = node.column(k)
+                if column not in sheet:
+                    sheet.append(column)
+                if self.xml and isinstance(v, dict):
+                    flattened_dict[column] = v['#text']
                 else:
-                    flattened_dict[sheet_key(sheet, k)] = v
-
-        if self.root_id and self.root_id in json_dict:
-            parent_id_fields[sheet_key(sheet, self.root_id)] = json_dict[self.root_id]
+                    flattened_dict[column] = v
+
+        if node.is_root and self.source_file_column and self.source_file is not None:
+            # Passed down to sub sheets like the ids
+            sheet.add_field(self.source_file_column, id_field=True)
+            flattened_dict[self.source_file_column] = self.source_file
+            parent_id_fields = add_id_field(parent_id_fields, self.source_file_column, self.source_file)
+
+        if node.is_root and self.partition_path:
+            value = next(path_values(json_dict, self.partition_path), None)
+            if self.xml and isinstance(value, dict):
+                value = value.get('#text')
+            flattened_dict[PARTITION_KEY] = value
+            parent_id_fields = add_id_field(parent_id_fields, PARTITION_KEY, value)
+
+        if node.root_id_column is not None and self.root_id in json_dict:
+            if node.root_id_column not in sheet:
+                sheet.append(node.root_id_column)
+            parent_id_fields = add_id_field(parent_id_fields, node.root_id_column, json_dict[self.root_id])
 
         if self.id_name in json_dict:
-            parent_id_fields[sheet_key(sheet, parent_name+self.id_name)] = json_dict[self.id_name]
+            if node.id_column not in sheet:
+                sheet.append(node.id_column)
+            parent_id_fields = add_id_field(parent_id_fields, node.id_column, json_dict[self.id_name])
 
-        for key, value in json_dict.items():
+        return [iter(json_dict.items()), node, sheet, flattened_dict, parent_id_fields, top]
 
-            # Keep a unique list of all the JSON paths in the data that have been seen.
-            parent_path = parent_name.replace('/0', '')
-            full_path = parent_path + key
-            self.seen_paths.add(full_path)
+    def parse_json_dict(self, json_dict, sheet, json_key=None, parent_name='', flattened_dict=None, parent_id_fields=None, top_level_of_sub_sheet=False):
+        """
+        Parse a json dictionary.
 
-            if self.preserve_fields:
+        json_dict - the json dictionary
+        sheet - a sheet.Sheet object representing the resulting spreadsheet
+        json_key - the key that maps to this JSON dict, either directly to the dict, or to a dict that this list contains.  Is None if this dict is contained in root_json_list directly.
 
-                siblings = False
-                for field in self.preserve_fields:
-                    if parent_path in field:
-                        siblings = True
-                if siblings and full_path not in self.preserve_fields:
+        Nested dictionaries and lists are walked with an explicit stack rather
+        than by recursion, so there is no limit on how deeply nested the data
+        can be. What to do with each key is looked up in self.plan.
+        """
+        # Possibly main_sheet should be main_sheet_columns, but this is
+        # currently named for consistency with schema.py
+
+        node = self.plan.node(parent_name, None if sheet is self.main_sheet else sheet.name)
+        if parent_id_fields is None:
+            parent_id_fields = ()
+        elif hasattr(parent_id_fields, 'items'):
+            parent_id_fields = tuple(parent_id_fields.items())
+        stack = [self.start_json_dict(json_dict, node, sheet, flattened_dict, parent_id_fields, top_level_of_sub_sheet)]
+
+        while stack:
+            frame = stack[-1]
+
+            if frame[0] is None:
+                # The objects in an array, each a line of a sub sheet
+                _, json_dicts, node, sheet, parent_id_fields = frame
+                for json_dict in json_dicts:
+                    if json_dict is None:
+                        continue
+                    stack.append(self.start_json_dict(
+                        json_dict, node, sheet, parent_id_fields=parent_id_fields, top_level_of_sub_sheet=True))
+                    break
+                else:
+                    stack.pop()
+                continue
+
+            items, node, sheet, flattened_dict, parent_id_fields, top = frame
+            for key, value in items:
+                plan_key = node.keys.get(key) or node.key(key)
+
+                # Keep a unique list of all the JSON paths in the data that have been seen.
+                self.seen_paths.add(plan_key.full_path)
+
+                if plan_key.skip:
                     continue
 
-            if type(value) in BASIC_TYPES:
-                if self.xml and key == '#text':
-                    # Handle the text output from xmltodict
-                    key = ''
-                    parent_name = parent_name.strip('/')
-                flattened_dict[sheet_key(sheet, parent_name+key)] = value
-            elif hasattr(value, 'items'):
-                self.parse_json_dict(
-                    value,
-                    sheet=sheet,
-                    json_key=key,
-                    parent_name=parent_name+key+'/',
-                    flattened_dict=flattened_dict,
-                    parent_id_fields=parent_id_fields)
-            elif hasattr(value, '__iter__'):
-                if all(type(x) in BASIC_TYPES for x in value):
-                    # Check for an array of BASIC types
-                    # TODO Make this check the schema
-                    # TODO Error if the any of the values contain the seperator
-                    # TODO Support doubly nested arrays
-                    flattened_dict[sheet_key(sheet, parent_name+key)] = ';'.join(map(six.text_type, value))
+                if type(value) in BASIC_TYPES:
+                    if plan_key.text_column is not None:
+                        column = plan_key.text_column
+                        # The rest of this element's keys are treated as if
+                        # parent_name had no trailing '/'
+                        node = frame[1] = node.text_node()
+                    else:
+                        column = plan_key.column
+                    if column not in sheet:
+                        sheet.append(column)
+                    flattened_dict[column] = value
+                elif hasattr(value, 'items'):
+                    stack.append(self.start_json_dict(
+                        value, plan_key.dict_node(), sheet, flattened_dict, parent_id_fields))
+                    break
+                elif hasattr(value, '__iter__'):
+                    if all(type(x) in BASIC_TYPES for x in value):
+                        # Check for an array of BASIC types
+                        # TODO Make this check the schema
+                        # TODO Error if the any of the values contain the seperator
+                        # TODO Support doubly nested arrays
+                        if plan_key.column not in sheet:
+                            sheet.append(plan_key.column)
+                        flattened_dict[plan_key.column] = ';'.join(map(six.text_type, value))
+                    else:
+                        if self.rollup and node.is_root: # Rollup only currently possible to main sheet
+                            self.rollup_list(value, plan_key, sheet, flattened_dict)
+
+                        sub_sheet_name = plan_key.sub_sheet_name
+                        if sub_sheet_name not in self.sub_sheets:
+                            self.sub_sheets[sub_sheet_name] = Sheet(name=sub_sheet_name, lines=self.lines_factory())
+
+                        stack.append([None, iter(value), plan_key.list_node(), self.sub_sheets[sub_sheet_name], parent_id_fields])
+                        break
                 else:
-                    if self.rollup and parent_name == '': # Rollup only currently possible to main sheet
-                        
-                        if self.use_titles and not self.schema_parser:
-                            warn('Warning: No schema was provided so column headings are JSON keys, not titles.')
-
-                        if len(value) == 1:
-                            for k, v in value[0].items():
-
-                                if self.preserve_fields and parent_name+key+'/'+k not in self.preserve_fields:
-                                    continue
-
-                                if type(v) not in BASIC_TYPES:
-                                    raise ValueError('Rolled up values must be basic types')
-                                else:
-                                    if self.schema_parser:
-                                        # We want titles and there's a schema and rollUp is in it
-                                        if self.use_titles and \
-                                        parent_name+key+'/0/'+k in self.schema_parser.main_sheet.titles:
-                                            flattened_dict[sheet_key_title(sheet, parent_name+key+'/0/'+k)] = v
-                                        
-                                        # We want titles and there's a schema but rollUp isn't in it
-                                        # so the titles for rollup properties aren't in the main sheet
-                                        # so we need to try to get the titles from a subsheet
-                                        elif self.use_titles and parent_name+key in self.rollup and \
-                                        parent_name+key in self.schema_parser.sub_sheets:
-                                            relevant_subsheet = self.schema_parser.sub_sheets.get(parent_name+key)
-                                            if relevant_subsheet is not None:
-                                                rollup_field_title = sheet_key_title(relevant_subsheet, parent_name+key+'/0/'+k)
-                                                flattened_dict[sheet_key(sheet, rollup_field_title)] = v
-                                        
-                                        # We don't want titles even though there's a schema
-                                        elif not self.use_titles and \
-                                        (parent_name+key+'/0/'+k in self.schema_parser.main_sheet or \
-                                        parent_name+key in self.rollup):
-                                            flattened_dict[sheet_key(sheet, parent_name+key+'/0/'+k)] = v
-
-                                    # No schema, so no titles
-                                    elif parent_name+key in self.rollup:
-                                        flattened_dict[sheet_key(sheet, parent_name+key+'/0/'+k)] = v
-                        
-                        elif len(value) > 1:
-                            for k in set(sum((list(x.keys()) for x in value), [])):
-
-                                if self.preserve_fields and parent_name+key+'/'+k not in self.preserve_fields:
-                                    continue
-
-                                if self.schema_parser and parent_name+key+'/0/'+k in self.schema_parser.main_sheet:
-                                    warn('More than one value supplied for "{}". Could not provide rollup, so adding a warning to the relevant cell(s) in the spreadsheet.'.format(parent_name+key))
-                                    flattened_dict[sheet_key(sheet, parent_name+key+'/0/'+k)] = 'WARNING: More than one value supplied, consult the relevant sub-sheet for the data.'
-                                elif parent_name+key in self.rollup:
-                                    warn('More than one value supplied for "{}". Could not provide rollup, so adding a warning to the relevant cell(s) in the spreadsheet.'.format(parent_name+key))
-                                    flattened_dict[sheet_key(sheet, parent_name+key+'/0/'+k)] = 'WARNING: More than one value supplied, consult the relevant sub-sheet for the data.'
-
-                    sub_sheet_name = make_sub_sheet_name(parent_name, key, truncation_length=self.truncation_length)
-                    if sub_sheet_name not in self.sub_sheets:
-                        self.sub_sheets[sub_sheet_name] = Sheet(name=sub_sheet_name)
-
-                    for json_dict in value:
-                        if json_dict is None:
-                            continue
-                        self.parse_json_dict(
-                            json_dict,
-                            sheet=self.sub_sheets[sub_sheet_name],
-                            json_key=key,
-                            parent_id_fields=parent_id_fields,
-                            parent_name=parent_name+key+'/0/',
-                            top_level_of_sub_sheet=True)
+                    raise ValueError('Unsupported type {}'.format(type(value)))
             else:
-                raise ValueError('Unsupported type {}'.format(type(value)))
+                stack.pop()
+                if top:
+                    sheet.lines.append(flattened_dict)
 
-        if top:
-            sheet.lines.append(flattened_dict)
+    def data_warning(self, message):
+        """
+        Warn about the data being parsed, giving the line it's on for JSON
+        Lines.
+
+        """
+        if self.line_number is not None:
+            message = 'Line {}: {}'.format(self.line_number, message)
+        warn(message)
+
+    def rollup_list(self, value, plan_key, sheet, flattened_dict):
+        """
+        Roll up the values of an array of objects into the main sheet, or if
+        there is more than one object, add warnings instead.
+
+        """
+        if self.use_titles and not self.schema_parser:
+            self.data_warning('Warning: No schema was provided so column headings are JSON keys, not titles.')
+
+        if len(value) == 1:
+            for k, v in value[0].items():
+                preserved, column = plan_key.rollup_single_column(k)
+                if not preserved:
+                    continue
+                if type(v) not in BASIC_TYPES:
+                    raise ValueError('Rolled up values must be basic types')
+                if column is not None:
+                    if column not in sheet:
+                        sheet.append(column)
+                    flattened_dict[column] = v
+
+        elif len(value) > 1:
+            for k in set(sum((list(x.keys()) for x in value), [])):
+                column = plan_key.rollup_multiple_column(k)
+                if column is not None:
+                    self.data_warning('More than one value supplied for "{}". Could not provide rollup, so adding a warning to the relevant cell(s) in the spreadsheet.'.format(plan_key.rollup_path))
+                    if column not in sheet:
+                        sheet.append(column)
+                    flattened_dict[column] = 'WARNING: More than one value supplied, consult the relevant sub-sheet for the data.'
@@ -1,3 +1,9 @@
+import json
+import re
+
+import six
+
+
 def isint(string):
     try:
         int(string)
@@ -24,3 +30,55 @@ def parse_sheet_configuration(configuration_list):
         if (len(parts) == 2 and parts[0].lower() == "idname"):
             configuration['IDName'] = parts[1]
     return configuration
+
+
+class RawNumber(six.text_type):
+    """
+    A number kept as the text it's written as in the input (e.g. '1.50'), so
+    that it's written out again unchanged, without being converted to a
+    Decimal and back. Used with the raw_numbers option of flatten and
+    unflatten.
+
+    """
+    __slots__ = ()
+
+
+# A number as JSON allows it to be written
+JSON_NUMBER_RE = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?\Z')
+
+
+def raw_number(value):
+    """
+    Return value as a RawNumber if it's text that is a valid JSON number,
+    otherwise None.
+
+    """
+    if isinstance(value, six.text_type) and JSON_NUMBER_RE.match(value):
+        return RawNumber(value)
+    return None
+
+
+class RawNumberEncoder(json.JSONEncoder):
+    """
+    A JSONEncoder that writes RawNumbers as they are, rather than as strings.
+
+    Only the pure Python encoder can do this (as for an indented output), so
+    it's always used.
+
+    """
+
+    def iterencode(self, o, _one_shot=False):
+        if self.ensure_ascii:
+            encode_string = json.encoder.encode_basestring_ascii
+        else:
+            encode_string = json.encoder.encode_basestring
+
+        def encoder(string):
+            if type(string) is RawNumber:
+                return string
+            return encode_string(string)
+
+        iterencode = json.encoder._make_iterencode(
+            {} if self.check_circular else None, self.default, encoder, self.indent, float.__repr__,
+            self.key_separator, self.item_separator, self.sort_keys, self.skipkeys, _one_shot)
+        return iterencode(o, 0)
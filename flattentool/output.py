@@ -6,40 +6,267 @@ formats.
 
 import openpyxl
 from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import get_column_letter
 import csv
+from decimal import Decimal
+import gzip
+import itertools
 import os
+import re
+import shutil
 import sys
+import tempfile
+import time
+import warnings
+import zipfile
+import zlib
 from warnings import warn
+from xml.sax.saxutils import escape as xml_escape
 import six
+from collections import OrderedDict
+from flattentool.compression import STDIN, DeflatedFile, ThreadedWriter, write_zip
 from flattentool.exceptions import DataErrorWarning
+from flattentool.filters import value_text
+from flattentool.lib import RawNumber
+from flattentool.sheet import StreamedLines
 
 if sys.version > '3':
     import csv
 else:
     import unicodecsv as csv  # pylint: disable=F0401
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2, without the futures backport
+    ThreadPoolExecutor = None
+
+# The parts of an XLSX file written by NativeXLSXOutput, other than the data
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+SPREADSHEETML = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIPS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+WORKSHEET_START = XML_DECLARATION + '<worksheet xmlns="' + SPREADSHEETML + '"><sheetData>'
+WORKSHEET_END = '</sheetData></worksheet>'
+CONTENT_TYPES = XML_DECLARATION + (
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '{}</Types>')
+WORKSHEET_CONTENT_TYPE = (
+    '<Override PartName="/xl/worksheets/sheet{}.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>')
+ROOT_RELATIONSHIPS = XML_DECLARATION + (
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="' + RELATIONSHIPS + '/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>')
+WORKBOOK = XML_DECLARATION + (
+    '<workbook xmlns="' + SPREADSHEETML + '" xmlns:r="' + RELATIONSHIPS + '"><sheets>{}</sheets></workbook>')
+WORKBOOK_RELATIONSHIPS = XML_DECLARATION + (
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{}'
+    '<Relationship Id="rId{}" Type="' + RELATIONSHIPS + '/styles" Target="styles.xml"/></Relationships>')
+WORKSHEET_RELATIONSHIP = (
+    '<Relationship Id="rId{0}" Type="' + RELATIONSHIPS + '/worksheet" Target="worksheets/sheet{0}.xml"/>')
+STYLES = XML_DECLARATION + (
+    '<styleSheet xmlns="' + SPREADSHEETML + '">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>')
+# The most characters a cell can have, longer strings are cut short (as
+# openpyxl does)
+MAX_CELL_LENGTH = 32767
+NUMBER_TYPES = six.integer_types + (float, Decimal)
+QUOTE = {'"': '&quot;'}
+# Escaped, so that it isn't lost when the XML is read
+CARRIAGE_RETURN = {'\r': '&#13;'}
+
+
+def number_text(value):
+    """
+    Return the text of a number in an XLSX cell: to 16 significant figures,
+    as openpyxl gives them, or empty (as openpyxl leaves infinities and NaN).
+
+    """
+    text = '%.16g' % value
+    if text in ('inf', '-inf', 'nan', '-nan'):
+        return ''
+    return text
+
+
+class SheetParts(object):
+    """
+    Writes the rows of a sheet to an output, in parts of at most max_rows
+    rows (not counting the header) if max_rows is given. The first part has
+    the name of the sheet, the others have _2, _3... added to it.
+
+    Called with each row, like the function start_sheet returns, or given
+    many rows at once with write_rows.
+
+    """
+
+    # The number of rows write_rows hands to the output at a time
+    batch_size = 1000
+
+    def __init__(self, output, sheet_name, sheet_header, max_rows=None):
+        self.output = output
+        self.sheet_name = sheet_name
+        self.sheet_header = sheet_header
+        self.max_rows = max_rows
+        self.part = 1
+        self.part_name = sheet_name
+        self.rows = 0
+        self.write_row = output.start_sheet(sheet_name, sheet_header)
+
+    def next_part(self):
+        self.output.end_sheet(self.part_name)
+        self.part += 1
+        self.part_name = '{}_{}'.format(self.sheet_name, self.part)
+        self.write_row = self.output.start_sheet(self.part_name, self.sheet_header)
+        self.rows = 0
+
+    def __call__(self, row):
+        if self.rows == self.max_rows:
+            self.next_part()
+        self.rows += 1
+        self.write_row(row)
+
+    def write_rows(self, rows):
+        """
+        Write rows (an iterable of rows), in batches of batch_size, see
+        SpreadsheetOutput.write_batch.
+
+        """
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                return
+            while batch:
+                if self.rows == self.max_rows:
+                    self.next_part()
+                if self.max_rows is not None and len(batch) > self.max_rows - self.rows:
+                    part_batch, batch = batch[:self.max_rows - self.rows], batch[self.max_rows - self.rows:]
+                else:
+                    part_batch, batch = batch, []
+                self.rows += len(part_batch)
+                self.output.write_batch(self.part_name, self.write_row, part_batch)
+
+    def end(self):
+        self.output.end_sheet(self.part_name)
+
 
 class SpreadsheetOutput(object):
+    # The most rows a sheet can have (not counting the header), further rows
+    # are written to more parts of the sheet, see SheetParts. None for no
+    # limit.
+    max_rows = None
+
+    # Whether sheets can be written at the same time, in different threads,
+    # see write_sheets
+    concurrent_sheets = False
+
     # output_name is given a default here, partly to help with tests,
     # but should have been defined by the time we get here.
-    def __init__(self, parser, main_sheet_name='main', output_name='unflattened', sheet_prefix=''):
+    def __init__(self, parser, main_sheet_name='main', output_name='unflattened', sheet_prefix='', max_rows=None):
         self.parser = parser
         self.main_sheet_name = main_sheet_name
         self.output_name = output_name
         self.sheet_prefix = sheet_prefix
+        if max_rows:
+            self.max_rows = min(max_rows, self.max_rows or max_rows)
 
     def open(self):
         pass
 
-    def write_sheet(self, sheet_name, sheet_header, sheet_lines=None):
+    def start_sheet(self, sheet_name, sheet_header):
+        """
+        Start writing a sheet, with the given header (a list of column names).
+
+        Returns a function that writes one row (a list of values in the order
+        of the header) to the sheet.
+
+        """
         raise NotImplementedError
 
-    def write_sheets(self):
-        self.open()
+    def end_sheet(self, sheet_name):
+        """
+        Finish writing a sheet (or part of a sheet) started with start_sheet.
+
+        """
+        pass
+
+    def write_batch(self, sheet_name, write_row, rows):
+        """
+        Write a list of rows to a sheet (or part of a sheet) started with
+        start_sheet, which returned write_row.
+
+        """
+        for row in rows:
+            write_row(row)
+
+    def start_sheet_parts(self, sheet_name, sheet_header):
+        """
+        Start writing a sheet, split into parts of at most max_rows rows.
+
+        Returns a SheetParts, which writes one row when called.
+
+        """
+        return SheetParts(self, sheet_name, sheet_header, self.max_rows)
+
+    def open_sheet(self, sheet_name, sheet):
+        """
+        Start writing a sheet, with the header taken from ``sheet``.
+
+        Returns a function that writes one line (a dict) to the sheet.
 
-        self.write_sheet(self.main_sheet_name, self.parser.main_sheet)
+        """
+        sheet_header = list(sheet)
+        write_row = self.start_sheet_parts(sheet_name, sheet_header)
+
+        def write_line(sheet_line):
+            write_row([sheet_line.get(header) for header in sheet_header])
+
+        return write_line
+
+    def write_sheet(self, sheet_name, sheet):
+        sheet_header = list(sheet)
+        write_row = self.start_sheet_parts(sheet_name, sheet_header)
+        if hasattr(sheet.lines, 'rows'):
+            write_row.write_rows(sheet.lines.rows(sheet_header))
+        else:
+            write_row.write_rows([sheet_line.get(header) for header in sheet_header] for sheet_line in sheet.lines)
+        write_row.end()
+
+    def sheets(self):
+        yield self.main_sheet_name, self.parser.main_sheet
         for sheet_name, sub_sheet in sorted(self.parser.sub_sheets.items()):
-            self.write_sheet(sheet_name, sub_sheet)
+            yield sheet_name, sub_sheet
+
+    def write_sheets(self, executor=None):
+        """
+        Write all the sheets. If executor (a concurrent.futures.Executor) is
+        given, and concurrent_sheets is true, each sheet is written in a task
+        of its own.
+
+        """
+        self.open()
+
+        if executor is not None and self.concurrent_sheets:
+            futures = [executor.submit(self.write_sheet, sheet_name, sheet)
+                       for sheet_name, sheet in self.sheets()]
+            for future in futures:
+                future.result()
+        else:
+            for sheet_name, sheet in self.sheets():
+                self.write_sheet(sheet_name, sheet)
 
         self.close()
 
@@ -48,62 +275,483 @@ class SpreadsheetOutput(object):
 
 
 class XLSXOutput(SpreadsheetOutput):
+    """
+    Writes an XLSX workbook, with a worksheet per sheet.
+
+    The workbook is write-only, so each row is written out (to a temporary
+    file, until the workbook is saved) as it's appended, rather than kept in
+    memory.
+
+    """
+
+    # Excel's limit of 1,048,576 rows, less the header
+    max_rows = 1048575
+    # The number of strings to keep cleaned copies of, see clean_string
+    clean_cache_size = 2 ** 16
+
     def open(self):
-        self.workbook = openpyxl.Workbook()
+        self.workbook = openpyxl.Workbook(write_only=True)
+        # Strings with the characters not allowed in a cell removed, by the
+        # strings they are cleaned from
+        self.cleaned_strings = {}
 
-    def write_sheet(self, sheet_name, sheet):
-        sheet_header = list(sheet)
-        worksheet = self.workbook.create_sheet()
-        worksheet.title = self.sheet_prefix + sheet_name
+    def clean_string(self, value):
+        """
+        Return value with any characters that aren't allowed in a cell
+        removed, warning if there were any. Each distinct string is only
+        checked once (until the cache is full, when it's emptied).
+
+        """
+        new_value = self.cleaned_strings.get(value)
+        if new_value is None:
+            new_value = ILLEGAL_CHARACTERS_RE.sub('', value)
+            if new_value != value:
+                warn("Character(s) in '{}' are not allowed in a spreadsheet cell. Those character(s) will be removed".format(value),
+                    DataErrorWarning)
+            if len(self.cleaned_strings) >= self.clean_cache_size:
+                self.cleaned_strings.clear()
+            self.cleaned_strings[value] = new_value
+        return new_value
+
+    def start_sheet(self, sheet_name, sheet_header):
+        worksheet = self.workbook.create_sheet(title=self.sheet_prefix + sheet_name)
         worksheet.append(sheet_header)
-        for sheet_line in sheet.lines:
-            line = []
-            for header in sheet_header:
-                value = sheet_line.get(header)
-                if isinstance(value, six.text_type):
-                    new_value = ILLEGAL_CHARACTERS_RE.sub('', value)
-                    if new_value != value:
-                        warn("Character(s) in '{}' are not allowed in a spreadsheet cell. Those character(s) will be removed".format(value),
-                            DataErrorWarning)
-                    value = new_value
-                line.append(value)
-            worksheet.append(line)
+        clean_string = self.clean_string
+
+        def write_row(row):
+            for position, value in enumerate(row):
+                if type(value) is RawNumber:
+                    # A number in the spreadsheet, not text
+                    row[position] = Decimal(value)
+                elif isinstance(value, six.text_type):
+                    row[position] = clean_string(value)
+            worksheet.append(row)
+
+        return write_row
 
     def close(self):
-        self.workbook.remove(self.workbook.active)
         self.workbook.save(self.output_name)
+        self.cleaned_strings = {}
+
+
+class NativeXLSXOutput(XLSXOutput):
+    """
+    Writes an XLSX workbook like XLSXOutput, but without openpyxl: the XML
+    of each worksheet is written directly, with strings inline in the cells,
+    and compressed in a thread of its own (see compression.DeflatedFile), so
+    that sheets are compressed in parallel, and alongside the flattening.
+
+    The workbook opens with the same values as one written by XLSXOutput.
+
+    """
+
+    def open(self):
+        self.cleaned_strings = {}
+        # The titles of the worksheets, and the files they are written to
+        self.worksheets = []
+        # The writers of the worksheets, by sheet name
+        self.open_files = OrderedDict()
+        # The writers of the worksheets that have been written, which are
+        # closed (i.e. waited for) in close()
+        self.closing_files = []
+
+    def start_sheet(self, sheet_name, sheet_header):
+        deflated_file = DeflatedFile()
+        xml_file = ThreadedWriter(deflated_file)
+        self.worksheets.append((self.sheet_prefix + sheet_name, deflated_file))
+        self.open_files[sheet_name] = xml_file
+        xml_file.write(WORKSHEET_START)
+        clean_string = self.clean_string
+        letters = []
+        row_numbers = itertools.count(1)
+
+        def write_row(row):
+            while len(letters) < len(row):
+                letters.append(get_column_letter(len(letters) + 1))
+            row_number = str(next(row_numbers))
+            cells = ['<row r="', row_number, '">']
+            for letter, value in zip(letters, row):
+                if value is None:
+                    continue
+                cells.append('<c r="' + letter + row_number)
+                value_type = type(value)
+                if value_type is bool:
+                    cells.append('" t="b"><v>1</v></c>' if value else '" t="b"><v>0</v></c>')
+                elif value_type is RawNumber:
+                    cells.extend(('" t="n"><v>', number_text(float(value)), '</v></c>'))
+                elif isinstance(value, six.text_type):
+                    value = clean_string(value)[:MAX_CELL_LENGTH]
+                    if not value:
+                        cells.append('" t="inlineStr"></c>')
+                    elif len(value) > 1 and value.startswith('='):
+                        # openpyxl writes these as formulas
+                        cells.extend(('"><f>', xml_escape(value[1:], CARRIAGE_RETURN), '</f><v></v></c>'))
+                    elif value != value.strip():
+                        cells.extend(('" t="inlineStr"><is><t xml:space="preserve">',
+                                      xml_escape(value, CARRIAGE_RETURN), '</t></is></c>'))
+                    else:
+                        cells.extend(('" t="inlineStr"><is><t>', xml_escape(value, CARRIAGE_RETURN),
+                                      '</t></is></c>'))
+                elif isinstance(value, NUMBER_TYPES):
+                    cells.extend(('" t="n"><v>', number_text(value), '</v></c>'))
+                else:
+                    cells.extend(('" t="inlineStr"><is><t>', xml_escape(six.text_type(value), CARRIAGE_RETURN),
+                                  '</t></is></c>'))
+            cells.append('</row>')
+            xml_file.write(''.join(cells))
+
+        write_row(list(sheet_header))
+        return write_row
+
+    def end_sheet(self, sheet_name):
+        # The rest is compressed in the background, until close()
+        xml_file = self.open_files.pop(sheet_name)
+        xml_file.write(WORKSHEET_END)
+        xml_file.flush()
+        self.closing_files.append(xml_file)
+
+    def close(self):
+        for sheet_name in list(self.open_files):
+            self.end_sheet(sheet_name)
+        for xml_file in self.closing_files:
+            xml_file.close()
+        self.closing_files = []
+
+        members = []
+        for number, (title, deflated_file) in enumerate(self.worksheets, 1):
+            members.append(('xl/worksheets/sheet{}.xml'.format(number), deflated_file))
+        parts = [
+            ('[Content_Types].xml', CONTENT_TYPES.format(''.join(
+                WORKSHEET_CONTENT_TYPE.format(number) for number in range(1, len(self.worksheets) + 1)))),
+            ('_rels/.rels', ROOT_RELATIONSHIPS),
+            ('xl/workbook.xml', WORKBOOK.format(''.join(
+                '<sheet name="{}" sheetId="{}" r:id="rId{}"/>'.format(xml_escape(title, QUOTE), number, number)
+                for number, (title, deflated_file) in enumerate(self.worksheets, 1)))),
+            ('xl/_rels/workbook.xml.rels', WORKBOOK_RELATIONSHIPS.format(''.join(
+                WORKSHEET_RELATIONSHIP.format(number) for number in range(1, len(self.worksheets) + 1)),
+                len(self.worksheets) + 1)),
+            ('xl/styles.xml', STYLES),
+        ]
+        for name, xml in parts:
+            deflated_file = DeflatedFile()
+            deflated_file.write(xml.encode('utf-8'))
+            members.append((name, deflated_file))
+        members.sort(key=lambda member: member[0] != '[Content_Types].xml')
+        with open(self.output_name, 'wb') as xlsx_file:
+            write_zip(xlsx_file, members)
+        self.worksheets = []
+        self.cleaned_strings = {}
 
 
 class CSVOutput(SpreadsheetOutput):
+    """
+    Writes a directory of CSV files, one per sheet.
+
+    With compression='gzip' each file is gzipped, and with compression='zip'
+    they are written into one zip file instead of a directory (named
+    output_name, with .zip added if needed, or written to standard output if
+    output_name is '-'). Compression is done in a background thread.
+
+    """
+
+    # The size of the buffer of each CSV file
+    buffer_size = 2 ** 20
+
+    def __init__(self, parser, main_sheet_name='main', output_name='unflattened', sheet_prefix='', compression=None,
+                 max_rows=None):
+        super(CSVOutput, self).__init__(parser, main_sheet_name, output_name, sheet_prefix, max_rows)
+        if compression not in (None, 'gzip', 'zip'):
+            raise ValueError('Unknown CSV compression {!r}'.format(compression))
+        self.compression = compression
+        # Only one file can be written into a zip file at a time
+        self.concurrent_sheets = compression != 'zip'
+
     def open(self):
+        # The files of the sheets being written, and their csv writers, by
+        # sheet name
+        self.open_files = OrderedDict()
+        self.writers = {}
+        if self.compression == 'zip':
+            if self.output_name == STDIN:
+                zip_output = getattr(sys.stdout, 'buffer', sys.stdout)
+            elif self.output_name.endswith('.zip'):
+                zip_output = self.output_name
+            else:
+                zip_output = self.output_name + '.zip'
+            self.zip_file = zipfile.ZipFile(zip_output, 'w', zipfile.ZIP_DEFLATED)
+            # The file being written into the zip file, only one can be at a
+            # time, so any others are written to temporary files first.
+            self.zip_writer = None
+            self.spooled_files = []
+            return
         try:
             os.makedirs(self.output_name)
         except OSError:
             pass
 
-    def write_sheet(self, sheet_name, sheet):
-        sheet_header = list(sheet)
+    def open_csv_file(self, sheet_name):
+        filename = self.sheet_prefix + sheet_name + '.csv'
+        if self.compression == 'zip':
+            if self.zip_writer is None or self.zip_writer.closed:
+                self.zip_writer = ThreadedWriter(self.zip_file.open(self.zip_info(filename), 'w'))
+                return self.zip_writer
+            spooled_file = tempfile.TemporaryFile()
+            self.spooled_files.append((filename, spooled_file))
+            return ThreadedWriter(spooled_file, close_raw=False)
+        filename = os.path.join(self.output_name, filename)
+        if self.compression == 'gzip':
+            return ThreadedWriter(gzip.open(filename + '.gz', 'wb', compresslevel=6))
         if sys.version > '3':  # If Python 3 or greater
             # Pass the encoding to the open function
-            with open(os.path.join(self.output_name, self.sheet_prefix + sheet_name+'.csv'), 'w', encoding='utf-8') as csv_file:
-                dictwriter = csv.DictWriter(csv_file, sheet_header)
-                dictwriter.writeheader()
-                for sheet_line in sheet.lines:
-                    dictwriter.writerow(sheet_line)
+            return open(filename, 'w', encoding='utf-8', buffering=self.buffer_size)
+        else:  # If Python 2
+            return open(filename, 'w', self.buffer_size)
+
+    def zip_info(self, filename):
+        zip_info = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        return zip_info
+
+    def start_sheet(self, sheet_name, sheet_header):
+        # The file is kept open until end_sheet() or close(), as rows are
+        # written to it as they are produced.
+        csv_file = self.open_csv_file(sheet_name)
+        self.open_files[sheet_name] = csv_file
+        if sys.version > '3':  # If Python 3 or greater
+            writer = csv.writer(csv_file)
         else:  # If Python 2
-            # Pass the encoding to DictReader
-            with open(os.path.join(self.output_name, self.sheet_prefix + sheet_name+'.csv'), 'w') as csv_file:
-                dictwriter = csv.DictWriter(csv_file, sheet_header, encoding='utf-8')
-                dictwriter.writeheader()
-                for sheet_line in sheet.lines:
-                    dictwriter.writerow(sheet_line)
+            # Pass the encoding to the writer
+            writer = csv.writer(csv_file, encoding='utf-8')
+        writer.writerow(sheet_header)
+        self.writers[sheet_name] = writer
+        return writer.writerow
+
+    def write_batch(self, sheet_name, write_row, rows):
+        self.writers[sheet_name].writerows(rows)
+
+    def end_sheet(self, sheet_name):
+        del self.writers[sheet_name]
+        self.open_files.pop(sheet_name).close()
+
+    def close(self):
+        for csv_file in self.open_files.values():
+            csv_file.close()
+        self.open_files = OrderedDict()
+        self.writers = {}
+        if self.compression == 'zip':
+            for filename, spooled_file in self.spooled_files:
+                spooled_file.seek(0)
+                with self.zip_file.open(self.zip_info(filename), 'w') as zip_member:
+                    shutil.copyfileobj(spooled_file, zip_member)
+                spooled_file.close()
+            self.spooled_files = []
+            self.zip_file.close()
+
+
+# The key of the partition value in each line (see json_input.JSONParser
+# partition_by), which is never a column
+PARTITION_KEY = '\x00partition'
+
+
+def partition_name(value, partitions=None):
+    """
+    Return the name of the partition for value: with a number of partitions,
+    the number of its hash, otherwise the value itself, made safe to use in
+    a file name.
+
+    """
+    text = '' if value is None else value_text(value)
+    if partitions:
+        number = zlib.crc32(text.encode('utf-8')) % partitions
+        return '{:0{}d}'.format(number, len(str(partitions - 1)))
+    return re.sub(r'[^\w.-]+', '_', text, flags=re.UNICODE).strip('.') or 'none'
+
+
+def partition_output_name(output_name, name):
+    """
+    Return output_name with the partition name added, before any .xlsx or
+    .zip extension.
+
+    """
+    root, extension = os.path.splitext(output_name)
+    if extension not in ('.xlsx', '.zip'):
+        root, extension = output_name, ''
+    return '{}_{}{}'.format(root, name, extension)
+
+
+class PartitionedOutput(SpreadsheetOutput):
+    """
+    Writes the sheets split into partitions by the partition value of each
+    line, each partition written on its own by output_class (e.g. to a
+    directory of CSV files, or an XLSX workbook) with the partition name
+    added to output_name. All partitions have every sheet, with the same
+    columns.
+
+    With a number of partitions, lines are partitioned by the hash of their
+    partition value, otherwise by the value itself.
+
+    """
+
+    def __init__(self, parser, output_class, main_sheet_name='main', output_name='unflattened', sheet_prefix='',
+                 partitions=None, **options):
+        super(PartitionedOutput, self).__init__(parser, main_sheet_name, output_name, sheet_prefix)
+        if output_name == STDIN:
+            raise ValueError("Partitioned output can't be written to standard output")
+        self.output_class = output_class
+        self.partitions = partitions
+        self.options = options
+
+    def open(self):
+        # The output of each partition, by partition name
+        self.outputs = OrderedDict()
+        # The sheets opened with open_sheet, to open in outputs made later
+        self.opened_sheets = []
+        # The line writers of each partition, by sheet name
+        self.line_writers = {}
+        main_lines = self.parser.main_sheet.lines
+        if hasattr(main_lines, 'rows'):
+            # Every item has a line in the main sheet, so all the partitions
+            # are found before any sheet is written
+            for row in main_lines.rows([PARTITION_KEY]):
+                self.partition_output(partition_name(row[0], self.partitions))
+
+    def partition_output(self, name):
+        output = self.outputs.get(name)
+        if output is None:
+            output = self.outputs[name] = self.output_class(
+                parser=self.parser, main_sheet_name=self.main_sheet_name,
+                output_name=partition_output_name(self.output_name, name), sheet_prefix=self.sheet_prefix,
+                **self.options)
+            output.open()
+            self.line_writers[name] = writers = {}
+            for sheet_name, sheet in self.opened_sheets:
+                writers[sheet_name] = output.open_sheet(sheet_name, sheet)
+        return output
+
+    def open_sheet(self, sheet_name, sheet):
+        self.opened_sheets.append((sheet_name, sheet))
+        for name, output in self.outputs.items():
+            self.line_writers[name][sheet_name] = output.open_sheet(sheet_name, sheet)
+
+        def write_line(sheet_line):
+            name = partition_name(sheet_line.get(PARTITION_KEY), self.partitions)
+            self.partition_output(name)
+            self.line_writers[name][sheet_name](sheet_line)
+
+        return write_line
+
+    def write_sheet(self, sheet_name, sheet):
+        sheet_header = list(sheet)
+        sheet_parts = {}
+
+        def parts(name):
+            if name not in sheet_parts:
+                sheet_parts[name] = self.partition_output(name).start_sheet_parts(sheet_name, sheet_header)
+            return sheet_parts[name]
+
+        for name in self.outputs:
+            parts(name)
+        if hasattr(sheet.lines, 'rows'):
+            rows = sheet.lines.rows(sheet_header + [PARTITION_KEY])
+        else:
+            rows = ([sheet_line.get(header) for header in sheet_header + [PARTITION_KEY]]
+                    for sheet_line in sheet.lines)
+        for row in rows:
+            parts(partition_name(row.pop(), self.partitions))(row)
+        for write_row in sheet_parts.values():
+            write_row.end()
+
+    def close(self):
+        for output in self.outputs.values():
+            output.close()
+
+
+def write_outputs(spreadsheet_outputs, threads=1):
+    """
+    Write all of spreadsheet_outputs. With more than one thread, the outputs
+    are written at the same time, as are the sheets of outputs that allow it
+    (see SpreadsheetOutput.concurrent_sheets), in a pool of that many
+    threads.
+
+    """
+    if threads <= 1 or ThreadPoolExecutor is None:
+        for spreadsheet_output in spreadsheet_outputs:
+            spreadsheet_output.write_sheets()
+        return
+    # Outputs wait for their sheets, so they have threads of their own
+    with ThreadPoolExecutor(threads) as sheet_executor, \
+            ThreadPoolExecutor(len(spreadsheet_outputs)) as output_executor:
+        futures = [output_executor.submit(spreadsheet_output.write_sheets, sheet_executor)
+                   for spreadsheet_output in spreadsheet_outputs]
+        for future in futures:
+            future.result()
+
+
+def sheets_layout(parser):
+    return [(sheet_name, list(sheet)) for sheet_name, sheet in
+            [(None, parser.main_sheet)] + sorted(parser.sub_sheets.items())]
+
+
+def write_sheets_streaming(parser, spreadsheet_outputs, single_pass=False):
+    """
+    Parse the input and write each line straight to all of
+    ``spreadsheet_outputs``, instead of collecting the lines in memory.
+
+    The header of a sheet has to be written before its first line, so by
+    default the input is parsed twice: the first pass only finds the sheets
+    and their columns, the second writes the lines.
+
+    With ``single_pass`` the sheets and columns the parser starts with (i.e.
+    those from a schema) are assumed to be complete. If the data turns out to
+    have other sheets or columns, the output is written again with the full
+    set, so the result is always the same as ``SpreadsheetOutput.write_sheets``.
+
+    """
+    first_pass = True
+    parser.lines_factory = StreamedLines
+    if not single_pass:
+        parser.main_sheet.lines = StreamedLines()
+        for sub_sheet in parser.sub_sheets.values():
+            sub_sheet.lines = StreamedLines()
+        parser.parse()
+        first_pass = False
+
+    while True:
+        layout = sheets_layout(parser)
+        for spreadsheet_output in spreadsheet_outputs:
+            spreadsheet_output.open()
+        for sheet_name, sheet in spreadsheet_outputs[0].sheets():
+            write_lines = [spreadsheet_output.open_sheet(sheet_name, sheet)
+                           for spreadsheet_output in spreadsheet_outputs]
+
+            def write_line(line, write_lines=write_lines):
+                for write_line in write_lines:
+                    write_line(line)
+
+            sheet.lines = StreamedLines(write_line)
+
+        with warnings.catch_warnings():
+            if not first_pass:
+                # Warnings about the data were already given on the first pass
+                warnings.filterwarnings('ignore', module=r'flattentool\.json_input')
+            parser.parse()
+        first_pass = False
+
+        for spreadsheet_output in spreadsheet_outputs:
+            spreadsheet_output.close()
+        if sheets_layout(parser) == layout:
+            break
 
 
 FORMATS = {
     'xlsx': XLSXOutput,
-    'csv': CSVOutput
+    'csv': CSVOutput,
+    'xlsx-native': NativeXLSXOutput,
 }
 FORMATS_SUFFIX = {
     'xlsx': '.xlsx',
-    'csv': ''  # This is the suffix for the directory
+    'csv': '',  # This is the suffix for the directory
+    'xlsx-native': '.xlsx',
 }
+# The formats written with output_format='all'
+ALL_FORMATS = ['xlsx', 'csv']
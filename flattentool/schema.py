@@ -5,10 +5,11 @@ from __future__ import unicode_literals
 from collections import OrderedDict
 from six.moves import UserDict
 from six import text_type
+import functools
 import jsonref
 from warnings import warn
+from flattentool.decoders import get_decoder
 from flattentool.sheet import Sheet
-import codecs
 import os
 import sys
 if sys.version_info[:2] > (3, 0):
@@ -93,7 +94,8 @@ class SchemaParser(object):
     """Parse the fields of a JSON schema into a flattened structure."""
 
     def __init__(self, schema_filename=None, root_schema_dict=None, rollup=False, root_id=None, use_titles=False,
-                 disable_local_refs=False, truncation_length=3, exclude_deprecated_fields=False):
+                 disable_local_refs=False, truncation_length=3, exclude_deprecated_fields=False,
+                 json_decoder='stdlib'):
         self.sub_sheets = {}
         self.main_sheet = Sheet()
         self.sub_sheet_mapping = {}
@@ -105,31 +107,32 @@ class SchemaParser(object):
         self.title_lookup = TitleLookup()
         self.flattened = {}
         self.exclude_deprecated_fields = exclude_deprecated_fields
+        self.flatten_plans = {}
 
         if root_schema_dict is None and schema_filename is  None:
             raise ValueError('One of schema_filename or root_schema_dict must be supplied')
         if root_schema_dict is not None and schema_filename is not None:
             raise ValueError('Only one of schema_filename or root_schema_dict should be supplied')
         if schema_filename:
+            # Schemas that are referenced are loaded by jsonref
+            loader = functools.partial(jsonref.jsonloader, object_pairs_hook=OrderedDict)
+            base_uri = ''
+            json_decoder = get_decoder(json_decoder)
             if schema_filename.startswith('http'):
                 import requests
                 r = requests.get(schema_filename)
-                self.root_schema_dict = jsonref.loads(r.text, object_pairs_hook=OrderedDict)
+                schema_dict = json_decoder.loads(r.text)
             else:
                 if disable_local_refs:
-                    with codecs.open(schema_filename, encoding="utf-8") as schema_file:
-                        self.root_schema_dict = jsonref.load(schema_file, object_pairs_hook=OrderedDict,
-                                                             loader=JsonLoaderLocalRefsDisabled())
+                    loader = JsonLoaderLocalRefsDisabled()
                 else:
                     if sys.version_info[:2] > (3, 0):
                         base_uri = pathlib.Path(os.path.realpath(schema_filename)).as_uri()
                     else:
                         base_uri = urlparse.urljoin('file:', urllib.pathname2url(os.path.abspath(schema_filename)))
-                    with codecs.open(schema_filename, encoding="utf-8") as schema_file:
-                        self.root_schema_dict = jsonref.load(schema_file, object_pairs_hook=OrderedDict,
-                                                             base_uri=base_uri)
-
-
+                with open(schema_filename, 'rb') as schema_file:
+                    schema_dict = json_decoder.load(schema_file)
+            self.root_schema_dict = jsonref.JsonRef.replace_refs(schema_dict, base_uri=base_uri, loader=loader)
         else:
             self.root_schema_dict = root_schema_dict
 
@@ -145,6 +148,29 @@ class SchemaParser(object):
             else:
                 self.main_sheet.append(field)
 
+    def flatten_plan(self, use_titles=False, rollup=False, preserve_fields=None, truncation_length=3,
+                     xml=False, id_name='id', root_id=None):
+        """
+        Return a FlattenPlan for flattening data that matches this schema, with
+        the given options. Plans are cached, so JSONParsers with the same
+        options share what has been compiled so far.
+
+        """
+        key = (
+            use_titles,
+            frozenset(rollup) if rollup else None,
+            frozenset(preserve_fields) if preserve_fields else None,
+            truncation_length,
+            xml,
+            id_name,
+            root_id,
+        )
+        if key not in self.flatten_plans:
+            self.flatten_plans[key] = FlattenPlan(
+                self, use_titles=use_titles, rollup=rollup, preserve_fields=preserve_fields,
+                truncation_length=truncation_length, xml=xml, id_name=id_name, root_id=root_id)
+        return self.flatten_plans[key]
+
     def parse_schema_dict(self, parent_path, schema_dict, parent_id_fields=None, title_lookup=None, parent_title=''):
         if parent_path:
             parent_path = parent_path + '/'
@@ -289,3 +315,215 @@ class SchemaParser(object):
 
         else:
             warn('Skipping field "{}", because it has no properties.'.format(parent_path))
+
+
+def restricted_paths(preserve_fields):
+    """
+    Return the set of parent paths (ending in '/', or '') that are part of
+    (a substring of) any of preserve_fields. Objects at these paths only keep
+    the keys that are preserved.
+
+    """
+    paths = set([''])
+    for field in preserve_fields:
+        for end, char in enumerate(field):
+            if char == '/':
+                for start in range(end + 1):
+                    paths.add(field[start:end + 1])
+    return paths
+
+
+class FlattenPlan(object):
+    """
+    A compiled plan for flattening JSON data, made by SchemaParser.flatten_plan
+    (or directly, when there is no schema).
+
+    The plan is a trie of PlanNode objects, one for each path that a JSON
+    object can be found at. Nodes and their keys are compiled the first time
+    they are seen in the data, so the plan grows to cover paths that are not
+    in the schema, and are then looked up rather than worked out again for
+    every object.
+
+    """
+
+    def __init__(self, schema_parser=None, use_titles=False, rollup=False, preserve_fields=None,
+                 truncation_length=3, xml=False, id_name='id', root_id=None):
+        self.schema_parser = schema_parser
+        self.use_titles = use_titles
+        self.rollup = rollup
+        self.preserve_fields = preserve_fields
+        self.truncation_length = truncation_length
+        self.xml = xml
+        self.id_name = id_name
+        self.root_id = root_id
+        self.restricted_paths = restricted_paths(preserve_fields) if preserve_fields else set()
+        self.nodes = {}
+        self.root = self.node('', None)
+
+    def node(self, parent_name, sheet_name):
+        """
+        Return the node for objects at parent_name (a path ending in '/', or
+        '' for the items of the root list), that are flattened into the sheet
+        called sheet_name (None for the main sheet).
+
+        """
+        if (parent_name, sheet_name) not in self.nodes:
+            self.nodes[(parent_name, sheet_name)] = PlanNode(self, parent_name, sheet_name)
+        return self.nodes[(parent_name, sheet_name)]
+
+    def sheet_titles(self, sheet_name):
+        if not self.use_titles or not self.schema_parser:
+            return {}
+        if sheet_name is None:
+            return self.schema_parser.main_sheet.titles
+        if sheet_name in self.schema_parser.sub_sheets:
+            return self.schema_parser.sub_sheets[sheet_name].titles
+        return {}
+
+
+class PlanNode(object):
+    """
+    The part of a FlattenPlan for objects found at one path.
+
+    Knows which sheet the objects are flattened into, which columns their
+    ids go in, and (in self.keys) a PlanKey for each key seen so far.
+
+    """
+
+    def __init__(self, plan, parent_name, sheet_name):
+        self.plan = plan
+        self.parent_name = parent_name
+        self.parent_path = parent_name.replace('/0', '')
+        self.sheet_name = sheet_name
+        self.is_root = parent_name == ''
+        self.titles = plan.sheet_titles(sheet_name)
+        self.columns = {}
+        self.id_column = self.column(parent_name + plan.id_name)
+        self.root_id_column = self.column(plan.root_id) if plan.root_id else None
+        # If any field to preserve is at this path, only those fields are kept
+        if not plan.preserve_fields:
+            self.siblings = False
+        elif self.parent_path.endswith('/') or self.parent_path == '':
+            self.siblings = self.parent_path in plan.restricted_paths
+        else:
+            # Only after the text of an XML element, see text_node
+            self.siblings = any(self.parent_path in field for field in plan.preserve_fields)
+        self.keys = {}
+
+    def column(self, field):
+        """
+        Return the column heading for field in this node's sheet, its title if
+        titles are being used and it has one.
+
+        """
+        if field not in self.columns:
+            self.columns[field] = self.titles.get(field, field)
+        return self.columns[field]
+
+    def key(self, key):
+        if key not in self.keys:
+            self.keys[key] = PlanKey(self, key)
+        return self.keys[key]
+
+    def text_node(self):
+        """
+        The node for the keys of an XML element that come after its text,
+        which (to match previous output) are treated as if there was no
+        trailing '/' on parent_name.
+
+        """
+        return self.plan.node(self.parent_name.strip('/'), self.sheet_name)
+
+
+class PlanKey(object):
+    """
+    The part of a FlattenPlan for the values of one key of objects found at
+    one path.
+
+    """
+
+    def __init__(self, node, key):
+        plan = node.plan
+        self.node = node
+        self.key = key
+        self.full_path = node.parent_path + key
+        self.skip = node.siblings and self.full_path not in plan.preserve_fields
+        # Column for basic values, and arrays of basic values
+        self.column = node.column(node.parent_name + key)
+        if plan.xml and key == '#text':
+            # Handle the text output from xmltodict
+            self.text_column = node.column(node.parent_name.strip('/'))
+        else:
+            self.text_column = None
+        self.sub_sheet_name = make_sub_sheet_name(node.parent_name, key, truncation_length=plan.truncation_length)
+        self.rollup_path = node.parent_name + key
+        self.rollup_single_columns = {}
+        self.rollup_multiple_columns = {}
+
+    def dict_node(self):
+        """The node for an object that is the value of this key."""
+        return self.node.plan.node(self.node.parent_name + self.key + '/', self.node.sheet_name)
+
+    def list_node(self):
+        """The node for objects in an array that is the value of this key."""
+        return self.node.plan.node(self.node.parent_name + self.key + '/0/', self.sub_sheet_name)
+
+    def rollup_single_column(self, k):
+        """
+        For key k of the only object in an array, return whether k is kept,
+        and the main sheet column it is rolled up into (None if it isn't).
+
+        """
+        if k not in self.rollup_single_columns:
+            self.rollup_single_columns[k] = self.compile_rollup_single_column(k)
+        return self.rollup_single_columns[k]
+
+    def compile_rollup_single_column(self, k):
+        plan = self.node.plan
+        schema_parser = plan.schema_parser
+        path = self.rollup_path + '/0/' + k
+        if plan.preserve_fields and self.rollup_path + '/' + k not in plan.preserve_fields:
+            return False, None
+        if schema_parser:
+            # We want titles and there's a schema and rollUp is in it
+            if plan.use_titles and path in schema_parser.main_sheet.titles:
+                return True, self.node.column(path)
+            # We want titles and there's a schema but rollUp isn't in it
+            # so the titles for rollup properties aren't in the main sheet
+            # so we need to try to get the titles from a subsheet
+            elif plan.use_titles and self.rollup_path in plan.rollup and \
+                    self.rollup_path in schema_parser.sub_sheets:
+                relevant_subsheet = schema_parser.sub_sheets[self.rollup_path]
+                rollup_field_title = relevant_subsheet.titles.get(path, path)
+                if rollup_field_title not in relevant_subsheet:
+                    relevant_subsheet.append(rollup_field_title)
+                return True, self.node.column(rollup_field_title)
+            # We don't want titles even though there's a schema
+            elif not plan.use_titles and \
+                    (path in schema_parser.main_sheet or self.rollup_path in plan.rollup):
+                return True, path
+            return True, None
+        # No schema, so no titles
+        elif self.rollup_path in plan.rollup:
+            return True, self.node.column(path)
+        return True, None
+
+    def rollup_multiple_column(self, k):
+        """
+        For key k of objects in an array of more than one, return the main
+        sheet column that gets a warning instead of a rolled up value (None
+        if there isn't one).
+
+        """
+        if k not in self.rollup_multiple_columns:
+            plan = self.node.plan
+            path = self.rollup_path + '/0/' + k
+            column = None
+            if plan.preserve_fields and self.rollup_path + '/' + k not in plan.preserve_fields:
+                pass
+            elif plan.schema_parser and path in plan.schema_parser.main_sheet:
+                column = self.node.column(path)
+            elif self.rollup_path in plan.rollup:
+                column = self.node.column(path)
+            self.rollup_multiple_columns[k] = column
+        return self.rollup_multiple_columns[k]
@@ -1,29 +1,220 @@
+from array import array
+from operator import itemgetter
+
+
 class Sheet(object):
     """
     An abstract representation of a single sheet of a spreadsheet.
 
+    Every column that is used in the sheet's columns or lines is given an
+    integer index, which doesn't change once given, see column_index.
+
     """
 
-    def __init__(self, columns=None, root_id='', name=None):
+    def __init__(self, columns=None, root_id='', name=None, lines=None):
+        self.column_indexes = {}
+        self.column_names = []
         self.id_columns = []
         self.columns = columns if columns else []
         self.titles = {}
-        self.lines = []
+        self.lines = lines if lines is not None else []
         self.root_id = root_id
         self.name = name
 
+    @property
+    def columns(self):
+        return self._columns
+
+    @columns.setter
+    def columns(self, columns):
+        self._columns = list(columns)
+        self._column_set = set(self._columns)
+        for column in self._columns:
+            self.column_index(column)
+
+    @property
+    def id_columns(self):
+        return self._id_columns
+
+    @id_columns.setter
+    def id_columns(self, id_columns):
+        self._id_columns = list(id_columns)
+        self._id_column_set = set(self._id_columns)
+        for column in self._id_columns:
+            self.column_index(column)
+
+    @property
+    def lines(self):
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines):
+        """
+        Lines are kept in a SheetLines, which lists of lines are converted to.
+        Anything else with an append method (e.g. StreamedLines) is kept
+        as it is.
+
+        """
+        if isinstance(lines, list):
+            sheet_lines = SheetLines(self)
+            for line in lines:
+                sheet_lines.append(line)
+            lines = sheet_lines
+        self._lines = lines
+
+    def column_index(self, column):
+        """
+        Return the index of column, giving it the next index if it doesn't
+        have one yet.
+
+        """
+        index = self.column_indexes.get(column)
+        if index is None:
+            index = self.column_indexes[column] = len(self.column_names)
+            self.column_names.append(column)
+        return index
+
     def add_field(self, field, id_field=False):
-        columns = self.id_columns if id_field else self.columns
-        if field not in columns:
+        if id_field:
+            columns, column_set = self._id_columns, self._id_column_set
+        else:
+            columns, column_set = self._columns, self._column_set
+        if field not in column_set:
             columns.append(field)
+            column_set.add(field)
+            self.column_index(field)
 
     def append(self, item):
         self.add_field(item)
 
+    def merge(self, other):
+        """
+        Add the columns and lines of ``other``, a sheet produced from data that
+        comes after the data of this sheet.
+
+        New columns are added in the order they appear in ``other``, which is
+        the order they would have had if all the data was parsed into one
+        sheet.
+
+        """
+        for column in other.id_columns:
+            self.add_field(column, id_field=True)
+        for column in other.columns:
+            self.add_field(column)
+        for line in other.lines:
+            self.lines.append(line)
+
     def __iter__(self):
         if self.root_id:
             yield self.root_id
-        for column in self.id_columns:
+        for column in self._id_columns:
             yield column
-        for column in self.columns:
+        for column in self._columns:
             yield column
+
+    def __contains__(self, column):
+        return column in self._column_set or column in self._id_column_set or \
+            bool(self.root_id and column == self.root_id)
+
+
+class SheetLines(object):
+    """
+    The lines of a Sheet, stored compactly.
+
+    Lines are appended as dicts of column to value, but each is kept as a
+    tuple of values and the number of its layout (the tuple of column
+    indexes its values are for). Lines from the same data usually share a
+    few layouts, so the column names aren't repeated for every line.
+
+    Iterating gives each line as a dict again. Writers should use rows()
+    instead, which doesn't need to make the dicts.
+
+    """
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.layouts = []
+        self.layout_numbers = {}
+        self.line_layouts = array('l')
+        self.line_values = []
+
+    def append(self, line):
+        keys = tuple(line)
+        layout_number = self.layout_numbers.get(keys)
+        if layout_number is None:
+            layout_number = self.layout_numbers[keys] = len(self.layouts)
+            self.layouts.append(tuple(self.sheet.column_index(key) for key in keys))
+        self.line_layouts.append(layout_number)
+        self.line_values.append(tuple(line.values()))
+
+    def rows(self, header):
+        """
+        Yield each line as a list of values in the order of header (a list of
+        column names), with None for columns the line has no value for.
+
+        """
+        getters = []
+        for layout in self.layouts:
+            value_positions = dict((column_index, position) for position, column_index in enumerate(layout))
+            # Columns the line has no value for are looked up at the end of
+            # the values, where a None is added. Two extra items are got, so
+            # that itemgetter always returns a tuple.
+            getters.append(itemgetter(*[
+                value_positions.get(self.sheet.column_indexes.get(column), len(layout))
+                for column in header
+            ] + [len(layout), len(layout)]))
+        for layout_number, values in zip(self.line_layouts, self.line_values):
+            yield list(getters[layout_number](values + (None,))[:-2])
+
+    def line(self, layout_number, values):
+        column_names = self.sheet.column_names
+        return dict(zip((column_names[index] for index in self.layouts[layout_number]), values))
+
+    def __len__(self):
+        return len(self.line_values)
+
+    def __iter__(self):
+        for layout_number, values in zip(self.line_layouts, self.line_values):
+            yield self.line(layout_number, values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        return self.line(self.line_layouts[index], self.line_values[index])
+
+    def __eq__(self, other):
+        if isinstance(other, SheetLines):
+            other = list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class StreamedLines(object):
+    """
+    Stands in for ``Sheet.lines`` when lines should not be kept in memory.
+
+    Each appended line is passed to ``write_line`` (if given) and then
+    dropped, only a count is kept, so that checks like ``if not sheet.lines``
+    still work.
+
+    """
+
+    def __init__(self, write_line=None):
+        self.write_line = write_line
+        self.count = 0
+
+    def append(self, line):
+        self.count += 1
+        if self.write_line is not None:
+            self.write_line(line)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        raise TypeError('Lines have been streamed to the output, and are not kept in memory.')
@@ -118,6 +118,26 @@ class XMLSchemaWalker(object):
             (name, self.create_schema_dict(name, element))
             for name, element, _, _, _ in self.element_loop(parent_element, '')])
 
+    def list_paths(self, parent_name, parent_element=None, path=()):
+        """
+        Yield the paths (tuples of element names) of the elements below the
+        named element that can occur more than once, i.e. that have a
+        maxOccurs other than 1.
+        """
+        if parent_element is None:
+            parent_element = self.get_schema_element('element', parent_name)
+        if parent_element is None:
+            return
+
+        for name, element, _, _, max_occurs in self.element_loop(parent_element, ''):
+            if name in path or name == parent_name:
+                # Don't follow elements that can contain themselves
+                continue
+            if max_occurs not in (None, '1'):
+                yield path + (name,)
+            for child_path in self.list_paths(name, element, path + (name,)):
+                yield child_path
+
 
 def sort_element(element, schema_subdict):
     """
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import bz2
+import gzip
+import io
+import sys
+import zipfile
+
+import pytest
+
+from flattentool.compression import ThreadedWriter, is_plain_file, open_input, seekable_input
+
+DATA = '{"main": [{"id": "1", "name": "é"}]}'.encode('utf-8')
+
+
+def write_zip(path, members):
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        for name, data in members:
+            zip_file.writestr(name, data)
+
+
+def write_compressed(path, compression):
+    if compression is None:
+        path.write_binary(DATA)
+    elif compression == 'gzip':
+        gzip_data = io.BytesIO()
+        with gzip.GzipFile(fileobj=gzip_data, mode='wb') as gzip_file:
+            gzip_file.write(DATA)
+        path.write_binary(gzip_data.getvalue())
+    elif compression == 'bz2':
+        path.write_binary(bz2.compress(DATA))
+    elif compression == 'xz':
+        lzma = pytest.importorskip('lzma')
+        path.write_binary(lzma.compress(DATA))
+    elif compression == 'zip':
+        write_zip(path.strpath, [('data.json', DATA)])
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'bz2', 'xz', 'zip'])
+def test_open_input(tmpdir, compression):
+    # The name doesn't matter, the compression is found from the contents
+    path = tmpdir.join('input.json')
+    write_compressed(path, compression)
+    with open_input(path.strpath) as binary_file:
+        assert binary_file.read() == DATA
+    assert is_plain_file(path.strpath) == (compression is None)
+
+
+def test_open_input_zip_of_several_files(tmpdir):
+    path = tmpdir.join('input.zip')
+    write_zip(path.strpath, [('a.json', DATA), ('b.json', DATA)])
+    with pytest.raises(ValueError) as excinfo:
+        open_input(path.strpath)
+    assert 'must contain exactly one file' in str(excinfo.value)
+
+
+class MockStdin(object):
+    def __init__(self, data):
+        self.buffer = io.BytesIO(data)
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'zip'])
+def test_open_input_stdin(tmpdir, monkeypatch, compression):
+    path = tmpdir.join('input.json')
+    write_compressed(path, compression)
+    monkeypatch.setattr(sys, 'stdin', MockStdin(path.read_binary()))
+    with open_input('-') as binary_file:
+        assert binary_file.read() == DATA
+    assert not is_plain_file('-')
+    # Standard input can't be read again
+    with pytest.raises(ValueError):
+        open_input('-')
+
+
+def test_flatten_stdin_streaming_output(tmpdir, monkeypatch):
+    from flattentool import flatten
+    monkeypatch.setattr(sys, 'stdin', MockStdin(b'{"main": [{"id": "1"}]}'))
+    with pytest.raises(Exception) as excinfo:
+        flatten('-', output_name=tmpdir.join('flattened').strpath, output_format='csv',
+                streaming=True, streaming_output=True)
+    assert 'Standard input can only be read once' in str(excinfo.value)
+    # No output has been written
+    assert tmpdir.listdir() == []
+
+
+def test_flatten_stdout_streaming_output(tmpdir, monkeypatch):
+    # The data has a column the schema doesn't, which would mean writing the
+    # output twice in a single pass
+    from flattentool import flatten
+    tmpdir.join('input.json').write('{"main": [{"id": "1", "extra": "x"}]}')
+    tmpdir.join('schema.json').write('{"properties": {"id": {"type": "string"}}}')
+    # With a binary buffer, like sys.stdout
+    stdout = MockStdin(b'')
+    monkeypatch.setattr(sys, 'stdout', stdout)
+    flatten(tmpdir.join('input.json').strpath, output_name='-', output_format='csv', csv_compression='zip',
+            schema=tmpdir.join('schema.json').strpath, streaming=True, streaming_output=True)
+    data = stdout.buffer.getvalue()
+    # One zip file, with the extra column
+    assert data.count(b'PK\x05\x06') == 1
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+        assert zip_file.read('main.csv').decode('utf-8').splitlines() == ['id,extra', '1,x']
+
+
+def test_seekable_input(monkeypatch):
+    assert seekable_input('input.json') == 'input.json'
+    monkeypatch.setattr(sys, 'stdin', MockStdin(DATA))
+    spooled_file = seekable_input('-')
+    assert spooled_file.read() == DATA
+    spooled_file.seek(0)
+    assert spooled_file.read() == DATA
+
+
+def test_threaded_writer():
+    raw = io.BytesIO()
+    raw_close = raw.close
+    closed = []
+    raw.close = lambda: closed.append(raw.getvalue())
+    writer = ThreadedWriter(raw)
+    writer.buffer_size = 10
+    for number in range(100):
+        writer.write('{},é\n'.format(number))
+    writer.close()
+    writer.close()
+    assert closed == [''.join('{},é\n'.format(number) for number in range(100)).encode('utf-8')]
+    raw_close()
+
+
+def test_threaded_writer_error():
+    class BrokenFile(object):
+        def write(self, data):
+            raise IOError('Disk full')
+
+        def close(self):
+            pass
+
+    writer = ThreadedWriter(BrokenFile())
+    writer.write('a')
+    with pytest.raises(IOError):
+        writer.close()
+
+
+@pytest.mark.parametrize('zip64', [False, True])
+def test_write_zip(tmpdir, monkeypatch, zip64):
+    from flattentool import compression
+    if zip64:
+        monkeypatch.setattr(compression, 'ZIP64_LIMIT', 10)
+        monkeypatch.setattr(compression, 'ZIP64_FILE_LIMIT', 2)
+    members = []
+    for name, data in [('a.xml', b'<a/>' * 1000), ('dir/b.txt', 'é'.encode('utf-8')), ('empty', b'')]:
+        deflated_file = compression.DeflatedFile()
+        deflated_file.write(data[:10])
+        deflated_file.write(data[10:])
+        members.append((name, deflated_file))
+    with open(tmpdir.join('test.zip').strpath, 'wb') as zip_output:
+        compression.write_zip(zip_output, members)
+
+    with zipfile.ZipFile(tmpdir.join('test.zip').strpath) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == ['a.xml', 'dir/b.txt', 'empty']
+        assert zip_file.read('a.xml') == b'<a/>' * 1000
+        assert zip_file.read('dir/b.txt') == 'é'.encode('utf-8')
+        assert zip_file.read('empty') == b''
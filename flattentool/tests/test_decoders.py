@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import gc
+from decimal import Decimal
+
+import pytest
+
+from flattentool.decoders import DECODERS, StdlibDecoder, get_decoder
+from flattentool.lib import RawNumber
+
+JSON = '{"b": 1.50, "a": [12345678901234567890123, 0.1e-5, -0, "é"], "c": {"z": null, "y": true}}'
+
+
+@pytest.fixture(params=list(DECODERS))
+def decoder(request):
+    if not DECODERS[request.param].available():
+        pytest.skip('{} is not installed'.format(request.param))
+    return DECODERS[request.param]()
+
+
+def test_decoder(decoder):
+    for data in [JSON, JSON.encode('utf-8')]:
+        decoded = decoder.loads(data)
+        assert list(decoded) == ['b', 'a', 'c']
+        assert list(decoded['c']) == ['z', 'y']
+        assert repr(decoded['b']) == repr(Decimal('1.50'))
+        assert decoded['a'] == [12345678901234567890123, Decimal('0.000001'), 0, 'é']
+        assert type(decoded['a'][0]) is int
+
+
+def test_decoder_errors(decoder):
+    with pytest.raises(ValueError):
+        decoder.loads('{"a": 1,}')
+    with pytest.raises(UnicodeError):
+        decoder.loads(b'{"a": "\xff"}')
+
+
+def test_decoder_large_exponent(decoder):
+    assert decoder.loads('[1e400]') == [Decimal('1e400')]
+
+
+def test_decoder_gc_paused(decoder):
+    assert gc.isenabled()
+    decoder.loads(JSON)
+    assert gc.isenabled()
+    gc.disable()
+    try:
+        decoder.loads(JSON)
+        assert not gc.isenabled()
+    finally:
+        gc.enable()
+
+
+def test_decoder_raw_numbers():
+    decoded = StdlibDecoder(raw_numbers=True).loads(JSON)
+    assert type(decoded['b']) is RawNumber
+    assert decoded['b'] == '1.50'
+    assert decoded['a'] == [12345678901234567890123, '0.1e-5', 0, 'é']
+
+
+def test_get_decoder(monkeypatch):
+    assert type(get_decoder()) is StdlibDecoder
+    with pytest.raises(ValueError):
+        get_decoder('nonexistent')
+    monkeypatch.setattr(DECODERS['rapidjson'], 'available', classmethod(lambda cls: False))
+    with pytest.warns(UserWarning):
+        assert type(get_decoder('rapidjson')) is StdlibDecoder
+
+
+def test_get_decoder_raw_numbers():
+    with pytest.warns(UserWarning):
+        decoder = get_decoder('rapidjson', raw_numbers=True)
+    assert type(decoder) is StdlibDecoder
+    assert decoder.loads('[1.50]') == ['1.50']
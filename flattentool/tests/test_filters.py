@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from decimal import Decimal
+
+import pytest
+
+from flattentool.filters import IdsPredicate, Predicate, RecordFilter, path_values
+
+
+def test_path_values():
+    json_dict = {
+        'buyer': {'id': 'GB-1'},
+        'tag': ['planning', 'award'],
+        'awards': [{'date': '2019-01-01'}, {'date': '2020-01-01'}, {'title': 'No date'}],
+        'nested': [[{'a': 1}], [{'a': 2}]],
+    }
+    assert list(path_values(json_dict, ['buyer', 'id'])) == ['GB-1']
+    assert list(path_values(json_dict, ['tag'])) == ['planning', 'award']
+    assert list(path_values(json_dict, ['awards', 'date'])) == ['2019-01-01', '2020-01-01']
+    assert list(path_values(json_dict, ['awards', '1', 'date'])) == ['2020-01-01']
+    assert list(path_values(json_dict, ['awards', '3', 'date'])) == []
+    assert list(path_values(json_dict, ['nested', 'a'])) == [1, 2]
+    assert list(path_values(json_dict, ['buyer', 'name'])) == []
+    assert list(path_values(json_dict, ['missing', 'id'])) == []
+
+
+@pytest.mark.parametrize('operator,value,data_value,expected', [
+    ('eq', 'a', 'a', True),
+    ('eq', 'a', 'b', False),
+    ('eq', '1.5', Decimal('1.5'), True),
+    ('eq', 'true', True, True),
+    ('eq', 1, 1, True),
+    ('in', 'a,b', 'b', True),
+    ('in', ['a', 'b'], 'c', False),
+    ('in', '1,2', 2, True),
+    ('prefix', 'GB-', 'GB-COH-123', True),
+    ('prefix', 'GB-', 'US-123', False),
+    ('from', '2019', '2019-01-01T00:00:00Z', True),
+    ('from', '2019-06', '2019-05-31', False),
+    ('to', '2019-06', '2019-06-30T23:59:59Z', True),
+    ('to', '2019-06', '2019-07-01', False),
+    ('to', '2019-06-30', '2019-06-30T12:00:00+01:00', True),
+])
+def test_predicate(operator, value, data_value, expected):
+    assert Predicate('field', operator, value).matches([data_value]) == expected
+
+
+def test_predicate_xml_text():
+    assert Predicate('field', 'eq', 'a').matches([OrderedDict([('@lang', 'en'), ('#text', 'a')])])
+    assert not Predicate('field', 'eq', 'a').matches([OrderedDict([('@lang', 'en')])])
+
+
+def test_predicate_unknown_operator():
+    with pytest.raises(ValueError):
+        Predicate('field', 'like', 'a')
+
+
+def test_record_filter():
+    record_filter = RecordFilter([
+        ('buyer/id', 'eq', 'GB-1'),
+        ('awards/date', 'from', '2020'),
+    ])
+    assert record_filter({'buyer': {'id': 'GB-1'}, 'awards': [{'date': '2019-01-01'}, {'date': '2020-01-01'}]})
+    assert not record_filter({'buyer': {'id': 'GB-1'}, 'awards': [{'date': '2019-01-01'}]})
+    assert not record_filter({'buyer': {'id': 'GB-2'}, 'awards': [{'date': '2020-01-01'}]})
+    assert not record_filter({'awards': [{'date': '2020-01-01'}]})
+
+
+def test_ids_predicate():
+    predicate = IdsPredicate('ocid', ['a', 'b', '3'])
+    record_filter = RecordFilter([predicate])
+    assert record_filter({'ocid': 'a'})
+    assert not record_filter({'ocid': 'c'})
+    assert record_filter({'ocid': 3})
+    assert predicate.found == {'a', '3'}
+    assert predicate.not_found() == {'b'}
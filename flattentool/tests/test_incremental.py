@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import sys
+import warnings
+
+import pytest
+
+from flattentool import flatten
+from flattentool.incremental import FingerprintStore
+
+pytestmark = pytest.mark.skipif(sys.version < '3', reason='Incremental flatten requires Python 3')
+
+
+def release(number, value=0, extra=False):
+    item = {'ocid': 'ocds-{}'.format(number), 'id': str(number),
+            'tender': {'value': value, 'items': [{'id': 'a', 'quantity': value + 1}, {'id': 'b'}]}}
+    if extra:
+        item['newField'] = 'x'
+        item['tender']['items'][0]['unit'] = 'kg'
+    return item
+
+
+def run(tmpdir, releases, name='incremental', incremental=True):
+    input_file = tmpdir.join('input.json')
+    input_file.write(json.dumps({'releases': releases}))
+    options = {}
+    if incremental:
+        options['incremental_state'] = tmpdir.join('state.json').strpath
+    flatten(input_file.strpath, output_name=tmpdir.join(name).strpath, output_format='csv',
+            root_list_path='releases', root_id='ocid', **options)
+    return dict((sheet_file.basename, sheet_file.read()) for sheet_file in tmpdir.join(name).listdir())
+
+
+def test_incremental_matches_full(tmpdir):
+    releases = [release(number) for number in range(5)]
+    assert run(tmpdir, releases) == run(tmpdir, releases, name='full', incremental=False)
+
+    # Changed, removed, unchanged and new records
+    releases = [release(0), release(1, value=9), release(3), release(4), release(5)]
+    assert run(tmpdir, releases) == run(tmpdir, releases, name='full', incremental=False)
+
+
+def test_incremental_only_flattens_changes(tmpdir, monkeypatch):
+    releases = [release(number) for number in range(5)]
+    run(tmpdir, releases)
+
+    parsed = []
+    parse_record = FingerprintStore.parse_record
+
+    def record_parse(self, parser, json_dict):
+        before = len(self.parsed_records)
+        parse_record(self, parser, json_dict)
+        if len(self.parsed_records) > before:
+            parsed.append(json_dict['id'])
+
+    monkeypatch.setattr(FingerprintStore, 'parse_record', record_parse)
+    run(tmpdir, [release(0), release(1, value=9), release(2), release(3), release(4), release(5)])
+    assert parsed == ['1', '5']
+
+
+def test_incremental_new_columns_at_end(tmpdir):
+    run(tmpdir, [release(0), release(1)])
+    sheets = run(tmpdir, [release(0, extra=True), release(1), release(2)])
+    assert sheets['main.csv'].splitlines() == [
+        'ocid,id,tender/value,newField',
+        'ocds-0,0,0,x',
+        'ocds-1,1,0,',
+        'ocds-2,2,0,',
+    ]
+    assert sheets['ten_items.csv'].splitlines() == [
+        'ocid,id,tender/items/0/id,tender/items/0/quantity,tender/items/0/unit',
+        'ocds-0,0,a,1,kg',
+        'ocds-0,0,b,,',
+        'ocds-1,1,a,1,',
+        'ocds-1,1,b,,',
+        'ocds-2,2,a,1,',
+        'ocds-2,2,b,,',
+    ]
+
+
+def test_incremental_duplicate_keys(tmpdir):
+    run(tmpdir, [release(0), release(0, value=1)])
+    sheets = run(tmpdir, [release(0), release(0, value=2)])
+    assert sheets['main.csv'].splitlines() == ['ocid,id,tender/value', 'ocds-0,0,0', 'ocds-0,0,2']
+
+
+def test_incremental_settings_changed(tmpdir, recwarn):
+    run(tmpdir, [release(0)])
+    input_file = tmpdir.join('input.json')
+    flatten(input_file.strpath, output_name=tmpdir.join('incremental').strpath, output_format='csv',
+            root_list_path='releases', root_id='ocid', use_titles=True,
+            incremental_state=tmpdir.join('state.json').strpath)
+    assert 'The settings have changed' in str(recwarn.pop(UserWarning).message)
+
+
+def test_incremental_missing_output(tmpdir, recwarn):
+    releases = [release(0), release(1)]
+    run(tmpdir, releases)
+    tmpdir.join('incremental', 'ten_items.csv').remove()
+    assert run(tmpdir, releases) == run(tmpdir, releases, name='full', incremental=False)
+    assert 'is missing' in str(recwarn.pop(UserWarning).message)
+
+
+def test_incremental_requires_csv(tmpdir):
+    tmpdir.join('input.json').write('{"main": []}')
+    with pytest.raises(Exception):
+        flatten(tmpdir.join('input.json').strpath, output_name=tmpdir.join('flattened').strpath,
+                output_format='all', incremental_state=tmpdir.join('state.json').strpath)
+
+
+def test_incremental_changed_record_new_rows_in_sheet(tmpdir):
+    # Run 1: only record 1 has items. Run 2: record 0 gains items, in a sheet
+    # it had no rows in before.
+    first = release(0)
+    del first['tender']['items']
+    run(tmpdir, [first, release(1)])
+    releases = [release(0), release(1)]
+    assert run(tmpdir, releases) == run(tmpdir, releases, name='full', incremental=False)
+    # Run 3 reads the rows the state file counts
+    assert run(tmpdir, releases) == run(tmpdir, releases, name='full', incremental=False)
+
+
+def test_incremental_changed_record_new_sheet(tmpdir):
+    # Run 2: record 0 changes, and has rows in a sheet that didn't exist
+    run(tmpdir, [release(0), release(1)])
+    changed = release(0, value=1)
+    changed['parties'] = [{'id': 'p'}]
+    releases = [changed, release(1)]
+    assert run(tmpdir, releases) == run(tmpdir, releases, name='full', incremental=False)
+    # Run 3 reads the rows the state file counts
+    changed['parties'].append({'id': 'q'})
+    assert run(tmpdir, releases) == run(tmpdir, releases, name='full', incremental=False)
+
+
+def test_incremental_rows_missing(tmpdir):
+    run(tmpdir, [release(0), release(1)])
+    tmpdir.join('incremental', 'ten_items.csv').write('ocid,id,tender/items/0/id,tender/items/0/quantity\n')
+    with pytest.raises(ValueError) as excinfo:
+        run(tmpdir, [release(0, value=1), release(1)])
+    assert 'has fewer rows than the state file' in str(excinfo.value)
+    assert not tmpdir.join('incremental', 'ten_items.csv.tmp').exists()
+
+
+def test_incremental_preserve_fields_and_id_list(tmpdir):
+    # Fields to preserve and ids count as present in records that aren't
+    # flattened again
+    tmpdir.join('preserve.txt').write('tender/value\nid\nocid\n')
+    tmpdir.join('ids.txt').write('ocds-0\nocds-1\n')
+    tmpdir.join('input.json').write(json.dumps({'releases': [release(0), {'ocid': 'ocds-1', 'id': '1'}]}))
+    for _ in range(2):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            flatten(tmpdir.join('input.json').strpath, output_name=tmpdir.join('incremental').strpath,
+                    output_format='csv', root_list_path='releases', root_id='ocid',
+                    preserve_fields=tmpdir.join('preserve.txt').strpath, id_list=tmpdir.join('ids.txt').strpath,
+                    incremental_state=tmpdir.join('state.json').strpath)
+        assert not [warning for warning in caught if 'not present' in str(warning.message)]
@@ -1012,6 +1012,34 @@ def test_unflatten_csv_utf8(tmpdir):
     assert 'éαГ😼𝒞人' in tmpdir.join('release.json').read_text(encoding='utf-8')
 
 
+def test_unflatten_raw_numbers(tmpdir):
+    input_dir = tmpdir.ensure('release_input', dir=True)
+    input_dir.join('main.csv').write_text(
+        'ocid,id,value/amount,numbers\n1,1,1.50,0.10000000000000000001;2e3\n1,2,.5,\n',
+        encoding='utf8'
+    )
+    tmpdir.join('schema.json').write(
+        '{"properties": {"id": {"type": "string"}, "value": {"type": "object", "properties": '
+        '{"amount": {"type": "number"}}}, "numbers": {"type": "array", "items": {"type": "number"}}}}')
+    unflatten(
+        input_dir.strpath,
+        input_format='csv',
+        output_name=tmpdir.join('release.json').strpath,
+        schema=tmpdir.join('schema.json').strpath,
+        raw_numbers=True)
+    release_json = tmpdir.join('release.json').read_text(encoding='utf-8')
+    assert '"amount": 1.50' in release_json
+    assert '0.10000000000000000001,' in release_json
+    assert '2e3' in release_json
+    # Numbers not written as JSON would write them are converted
+    assert '"amount": 0.5' in release_json
+    assert json.loads(release_json, parse_float=Decimal) == {'main': [
+        {'ocid': '1', 'id': '1', 'value': {'amount': Decimal('1.50')},
+         'numbers': [Decimal('0.10000000000000000001'), Decimal('2e3')]},
+        {'ocid': '1', 'id': '2', 'value': {'amount': Decimal('0.5')}},
+    ]}
+
+
 def test_unflatten_csv_latin1(tmpdir):
     input_dir = tmpdir.ensure('release_input', dir=True)
     input_dir.join('main.csv').write_text(
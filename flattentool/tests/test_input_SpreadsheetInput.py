@@ -5,11 +5,12 @@ Tests of unflatten method are in test_input_SpreadsheetInput_unflatten.py
 """
 from __future__ import unicode_literals
 from flattentool.input import SpreadsheetInput, CSVInput, XLSXInput, convert_type
+from flattentool.lib import RawNumber
 from decimal import Decimal
 from collections import OrderedDict
 import sys
-import pytest
 import openpyxl
+import pytest
 import datetime
 import pytz
 from six import text_type
@@ -50,6 +51,63 @@ class TestSuccessfulInput(object):
         assert list(csvinput.get_sheet_lines('subsheet')) == \
             [{'colC': 'cell5', 'colD': 'cell6'}, {'colC': 'cell7', 'colD': 'cell8'}]
 
+    def test_csv_input_opened_once(self, tmpdir, monkeypatch):
+        tmpdir.join('main.csv').write('#,skipRows 1,headerRows 2\nskipped\ncolA,colB,colA\ntitles\n'
+                                      'cell1,cell2,cell3\n\ncell4\n')
+        tmpdir.join('empty.csv').write('#,skipRows 5\ncolA\n')
+        opened = []
+        open_sheet_file = CSVInput.open_sheet_file
+
+        def record_open(self, sheet_name):
+            opened.append(sheet_name)
+            return open_sheet_file(self, sheet_name)
+
+        monkeypatch.setattr(CSVInput, 'open_sheet_file', record_open)
+        csvinput = CSVInput(input_name=tmpdir.strpath)
+        csvinput.read_sheets()
+
+        assert csvinput.get_sheet_headings('main') == ['colA', 'colB', 'colA']
+        assert list(csvinput.get_sheet_lines('main')) == \
+            [{'colA': 'cell3', 'colB': 'cell2'}, {'colA': None, 'colB': None}]
+        assert csvinput.get_sheet_headings('empty') is None
+        assert list(csvinput.get_sheet_lines('empty')) == []
+        assert sorted(opened) == ['empty', 'main']
+
+    def test_csv_input_closed(self, tmpdir):
+        """ The files of sheets that are skipped are closed too. """
+        tmpdir.join('main.csv').write('colA\ncell1\n')
+        tmpdir.join('ignored.csv').write('#,ignore\ncolA\ncell2\n')
+        tmpdir.join('empty.csv').write('')
+        csvinput = CSVInput(input_name=tmpdir.strpath)
+        csvinput.read_sheets()
+        sheets = list(csvinput.open_sheets.values())
+        assert csvinput.unflatten() == [{'colA': 'cell1'}]
+        assert csvinput.open_sheets == {}
+        assert all(sheet.sheet_file.closed for sheet in sheets)
+        # The files are opened again to unflatten again
+        assert csvinput.unflatten() == [{'colA': 'cell1'}]
+
+    def test_csv_input_compressed(self, tmpdir):
+        import gzip
+        import zipfile
+        with gzip.open(tmpdir.join('main.csv.gz').strpath, 'wb') as main:
+            main.write('colA,colB\ncell1,cell2\ncell3,cell4'.encode('utf-8'))
+        tmpdir.join('subsheet.csv').write('colC,colD\ncell5,cell6\ncell7,cell8')
+        with zipfile.ZipFile(tmpdir.join('input.zip').strpath, 'w') as zip_file:
+            zip_file.write(tmpdir.join('main.csv.gz').strpath, 'main.csv.gz')
+            zip_file.write(tmpdir.join('subsheet.csv').strpath, 'subsheet.csv')
+
+        for input_name in [tmpdir.strpath, tmpdir.join('input.zip').strpath]:
+            csvinput = CSVInput(input_name=input_name)
+
+            csvinput.read_sheets()
+
+            assert csvinput.sub_sheet_names == ['main', 'subsheet']
+            assert list(csvinput.get_sheet_lines('main')) == \
+                [{'colA': 'cell1', 'colB': 'cell2'}, {'colA': 'cell3', 'colB': 'cell4'}]
+            assert list(csvinput.get_sheet_lines('subsheet')) == \
+                [{'colC': 'cell5', 'colD': 'cell6'}, {'colC': 'cell7', 'colD': 'cell8'}]
+
     def test_xlsx_input(self):
         xlsxinput = XLSXInput(input_name='flattentool/tests/fixtures/xlsx/basic.xlsx')
 
@@ -131,6 +189,55 @@ class TestSuccessfulInput(object):
         assert list(xlsxinput.get_sheet_lines('subsheet')) == \
             [{'colC': 3, 'colD': 9}, {'colC': 4, 'colD': 12}]
 
+    def test_xlsx_input_empty_rows(self, tmpdir):
+        """ Empty rows are kept in the middle of a sheet, for the line numbers,
+        but not at the end, e.g. if the sheet is formatted to the end. """
+        workbook = openpyxl.Workbook()
+        worksheet = workbook.active
+        worksheet.title = 'main'
+        worksheet.append(['colA', 'colB', None])
+        worksheet.append(['cell1', 'cell2', 'no heading'])
+        worksheet.cell(row=5, column=2, value='cell3')
+        for row in range(6, 2000):
+            worksheet.cell(row=row, column=1).font = openpyxl.styles.Font(bold=True)
+        workbook.save(tmpdir.join('test.xlsx').strpath)
+
+        class FullXLSXInput(XLSXInput):
+            read_only = False
+
+        lines = []
+        for input_class in [XLSXInput, FullXLSXInput]:
+            xlsxinput = input_class(input_name=tmpdir.join('test.xlsx').strpath)
+            xlsxinput.read_sheets()
+            lines.append(list(xlsxinput.get_sheet_lines('main')))
+            assert xlsxinput.fancy_unflatten(True, True) == (
+                [{'colA': 'cell1', 'colB': 'cell2'}, {'colB': 'cell3'}],
+                {'main/0/colA': [('main', 'A', 2, 'colA')], 'main/0/colB': [('main', 'B', 2, 'colB')],
+                 'main/1/colB': [('main', 'B', 5, 'colB')], 'main/0': [('main', 2)], 'main/1': [('main', 5)]},
+                {'main/colA': [('main', 'colA')], 'main/colB': [('main', 'colB')]})
+
+        assert lines[0] == [
+            {'colA': 'cell1', 'colB': 'cell2'},
+            {'colA': None, 'colB': None},
+            {'colA': None, 'colB': None},
+            {'colA': None, 'colB': 'cell3'},
+        ]
+        # Loaded in full, the column with no heading is there too
+        assert [{header: value for header, value in line.items() if header is not None} for line in lines[1]] == \
+            lines[0] + [{'colA': None, 'colB': None}] * 1994
+
+    def test_xlsx_input_closed(self):
+        """ The read-only workbook is closed after unflattening, and opened
+        again if it's unflattened again. """
+        xlsxinput = XLSXInput(input_name='flattentool/tests/fixtures/xlsx/basic_meta.xlsx')
+        xlsxinput.read_sheets()
+        workbook, workbook_file = xlsxinput.workbook, xlsxinput.workbook_file
+        result = xlsxinput.unflatten()
+        assert workbook._archive.fp is None
+        assert workbook_file.closed
+        assert xlsxinput.unflatten() == result
+        assert xlsxinput.workbook is None
+
     def test_bad_xlsx(self):
         """ XLSX file that is not a XLSX"""
 
@@ -267,6 +374,18 @@ def test_convert_type(recwarn):
     assert convert_type('number_array', '1;2') == [1, 2]
     assert convert_type('number_array', '1,2;3,4') == [[1, 2], [3, 4]]
 
+    # Numbers written as JSON would write them are kept as they are
+    assert type(convert_type('number', '1.50', raw_numbers=True)) is RawNumber
+    assert convert_type('number', '1.50', raw_numbers=True) == '1.50'
+    assert convert_type('number', '-1e5', raw_numbers=True) == '-1e5'
+    assert convert_type('number', '.5', raw_numbers=True) == Decimal('0.5')
+    assert convert_type('number', 1.5, raw_numbers=True) == Decimal('1.5')
+    assert convert_type('number', 'one', raw_numbers=True) == 'one'
+    assert 'Non-numeric value "one"' in text_type(recwarn.pop(UserWarning).message)
+    assert convert_type('number_array', '1.0,2;3', raw_numbers=True) == [['1.0', '2'], ['3']]
+    assert convert_type('number_array', '1.0;2', raw_numbers=True) == ['1.0', '2']
+    assert convert_type('number_array', '1.0;.2', raw_numbers=True) == [Decimal('1.0'), Decimal('0.2')]
+
     with pytest.raises(ValueError) as e:
         convert_type('notatype', 'test')
     assert 'Unrecognised type: "notatype"' in text_type(e)
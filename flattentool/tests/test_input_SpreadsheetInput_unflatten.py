@@ -1070,3 +1070,95 @@ def test_unflatten_titles(root_id, root_id_kwargs, input_list, expected_output_l
     return test_unflatten(convert_titles=True, use_schema=True, root_id=root_id, root_id_kwargs=root_id_kwargs, input_list=input_list, expected_output_list=expected_output_list, recwarn=recwarn, comment=comment, warning_messages=warning_messages, reversible=reversible)
 
 
+
+
+def test_unflatten_plan_compiles_each_heading_once(monkeypatch):
+    from flattentool.input import UnflattenPlan
+    compiled = []
+    compile_heading = UnflattenPlan.compile
+
+    def record_compile(self, path, date):
+        compiled.append(path)
+        return compile_heading(self, path, date)
+
+    monkeypatch.setattr(UnflattenPlan, 'compile', record_compile)
+    spreadsheet_input = ListInput(
+        sheets={
+            'custom_main': [
+                OrderedDict([('id', 1), ('a/0/b', 'x'), ('c', '')]),
+                OrderedDict([('id', 2), ('a/0/b', 'y'), ('c', '')]),
+                OrderedDict([('id', 3), ('a/0/b', ''), ('c', 'z')]),
+            ]
+        },
+        root_id='')
+    spreadsheet_input.read_sheets()
+    assert list(spreadsheet_input.unflatten()) == [
+        {'id': 1, 'a': [{'b': 'x'}]},
+        {'id': 2, 'a': [{'b': 'y'}]},
+        {'id': 3, 'c': 'z'},
+    ]
+    assert compiled == ['id', 'a/0/b', 'c']
+
+
+def test_unflatten_plan_xml_dates():
+    from flattentool.input import UnflattenPlan, OBJECT_STEP, VALUE_STEP, convert_date, convert_untyped
+    plan = UnflattenPlan(xml=True)
+    assert plan.steps('a/b', 'text') == [(OBJECT_STEP, 'a', 'a'), (VALUE_STEP, 'b', 'a/b', None, convert_untyped)]
+    assert plan.steps('a/b', datetime.datetime(2020, 1, 2)) == \
+        [(OBJECT_STEP, 'a', 'a'), (VALUE_STEP, 'b', 'a/b', 'date', convert_date)]
+    assert plan.steps('a/datetime', datetime.datetime(2020, 1, 2)) == \
+        [(OBJECT_STEP, 'a', 'a'), (VALUE_STEP, 'datetime', 'a/datetime', None, convert_untyped)]
+
+
+def test_unflatten_warnings_once_per_column():
+    import warnings
+    spreadsheet_input = ListInput(
+        sheets={
+            'custom_main': [
+                OrderedDict([('id', 1), ('a', 'bad'), ('b', 'bad')]),
+                OrderedDict([('id', 2), ('a', 'bad'), ('b', 'worse')]),
+            ]
+        },
+        root_id='')
+    spreadsheet_input.parser = SchemaParser(root_schema_dict={'properties': {
+        'id': {'type': 'integer'}, 'a': {'type': 'number'}, 'b': {'type': 'number'}}})
+    spreadsheet_input.parser.parse()
+    spreadsheet_input.read_sheets()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        assert list(spreadsheet_input.unflatten()) == [
+            {'id': 1, 'a': 'bad', 'b': 'bad'},
+            {'id': 2, 'a': 'bad', 'b': 'worse'},
+        ]
+    assert [text_type(warning.message) for warning in caught] == [
+        'Non-numeric value "bad" found in number column, returning as string instead.',
+        'Non-numeric value "bad" found in number column, returning as string instead.',
+        'Non-numeric value "worse" found in number column, returning as string instead.',
+    ]
+
+
+def test_unflatten_without_cells():
+    import warnings
+    from flattentool.input import Cell
+    spreadsheet_input = ListInput(
+        sheets={
+            'custom_main': [
+                OrderedDict([('id', 1), ('a', 'x'), ('b/c', 'y')]),
+            ],
+            'sub': [
+                OrderedDict([('id', 1), ('a', 'x'), ('d/0/e', 'z')]),
+                OrderedDict([('id', 1), ('b', 'y')]),
+            ],
+        },
+        root_id='')
+    spreadsheet_input.read_sheets()
+    for with_source_maps in (False, True):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            result, cell_source_map, _ = spreadsheet_input.fancy_unflatten(with_source_maps, with_source_maps)
+        assert result == [{'id': 1, 'a': 'x', 'b': {'c': 'y'}, 'd': [{'e': 'z'}]}]
+        assert not any(isinstance(value, Cell) for value in result[0].values())
+        assert (cell_source_map is not None) == with_source_maps
+        assert [text_type(warning.message) for warning in caught] == [
+            'Column b has been ignored, because another column treats it as an array or object',
+        ]
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import os
-from flattentool.json_input import JSONParser, BadlyFormedJSONError, BadlyFormedJSONErrorUTF8
+from flattentool.json_input import JSONParser, BadlyFormedJSONError, BadlyFormedJSONErrorUTF8, add_id_field, json_lines_chunks
+from flattentool.lib import RawNumber
 from flattentool.schema import SchemaParser
 from flattentool.tests.test_schema_parser import object_in_array_example_properties
 import pytest
+import warnings
 from collections import OrderedDict
+from decimal import Decimal
 from six import text_type
 
 
@@ -139,6 +142,52 @@ def test_parse_array():
     assert parser.sub_sheets == {}
 
 
+def test_add_id_field():
+    id_fields = add_id_field((), 'ocid', 1)
+    assert id_fields == (('ocid', 1),)
+    assert add_id_field(id_fields, 'id', 2) == (('ocid', 1), ('id', 2))
+    assert add_id_field((('ocid', 1), ('id', 2)), 'ocid', 3) == (('ocid', 3), ('id', 2))
+    assert id_fields == (('ocid', 1),)
+
+
+def test_parse_ids_only_passed_down():
+    parser = JSONParser(root_json_dict=[OrderedDict([
+        ('id', 1),
+        ('a', OrderedDict([('id', 2), ('b', [OrderedDict([('c', 3)])])])),
+        ('d', [OrderedDict([('e', 4)])]),
+    ])])
+    parser.parse()
+    assert parser.sub_sheets['a_b'].lines == [{'id': 1, 'a/id': 2, 'a/b/0/c': 3}]
+    assert parser.sub_sheets['d'].lines == [{'id': 1, 'd/0/e': 4}]
+
+
+def test_parse_deeply_nested_json_dict():
+    json_dict = OrderedDict([('a', 'b')])
+    for _ in range(3000):
+        json_dict = OrderedDict([('c', json_dict), ('d', [OrderedDict([('e', 'f')])])])
+    parser = JSONParser(root_json_dict=[json_dict])
+    parser.parse()
+    assert list(parser.main_sheet) == ['c/' * 3000 + 'a']
+    assert parser.main_sheet.lines == [{'c/' * 3000 + 'a': 'b'}]
+    assert sum(len(sheet.lines) for sheet in parser.sub_sheets.values()) == 3000
+
+
+def test_flatten_plan_shared():
+    schema_parser = SchemaParser(
+        root_schema_dict={'properties': {'a': {'type': 'string'}}})
+    schema_parser.parse()
+    first_parser = JSONParser(root_json_dict=[OrderedDict([('a', 'b'), ('c', 'd')])], schema_parser=schema_parser)
+    first_parser.parse()
+    second_parser = JSONParser(root_json_dict=[OrderedDict([('a', 'e')])], schema_parser=schema_parser)
+    assert second_parser.plan is first_parser.plan
+    assert set(second_parser.plan.root.keys) == {'a', 'c'}
+    second_parser.parse()
+    assert list(second_parser.main_sheet) == ['a']
+    assert second_parser.main_sheet.lines == [{'a': 'e'}]
+    titles_parser = JSONParser(root_json_dict=[], schema_parser=schema_parser, use_titles=True)
+    assert titles_parser.plan is not first_parser.plan
+
+
 def test_root_list_path():
     parser = JSONParser(
         root_json_dict={'custom_key': [OrderedDict([
@@ -154,6 +203,317 @@ def test_root_list_path():
     assert parser.sub_sheets == {}
 
 
+@pytest.mark.parametrize('root_list_path', ['custom_key', 'nested/custom_key', None])
+def test_streaming(tmpdir, root_list_path):
+    pytest.importorskip('ijson')
+    items = '[{"a": "b", "c": 1.50, "d": [{"e": 2}]}, null, {"c": "f", "a": 1}]'
+    if root_list_path is None:
+        json_text = items
+    elif root_list_path == 'custom_key':
+        json_text = '{"meta": "x", "custom_key": ' + items + '}'
+    else:
+        json_text = '{"nested": {"custom_key": ' + items + '}}'
+    test_json = tmpdir.join('test.json')
+    test_json.write(json_text)
+
+    parser = JSONParser(json_filename=test_json.strpath, root_list_path=root_list_path, streaming=True)
+    assert parser.root_json_dict is None
+    parser.parse()
+    in_memory_parser = JSONParser(json_filename=test_json.strpath, root_list_path=root_list_path)
+    in_memory_parser.parse()
+
+    assert list(parser.main_sheet) == list(in_memory_parser.main_sheet) == ['a', 'c']
+    assert parser.main_sheet.lines == in_memory_parser.main_sheet.lines
+    assert [type(line['c']) for line in parser.main_sheet.lines] == [Decimal, text_type]
+    assert text_type(parser.main_sheet.lines[0]['c']) == '1.50'
+    assert listify(parser.sub_sheets) == listify(in_memory_parser.sub_sheets) == {'d': ['d/0/e']}
+    assert parser.sub_sheets['d'].lines == [{'d/0/e': 2}]
+
+
+def test_streaming_bad_json(tmpdir):
+    pytest.importorskip('ijson')
+    test_json = tmpdir.join('test.json')
+    test_json.write('{"main": [{"a":"b",}]}')
+    parser = JSONParser(json_filename=test_json.strpath, root_list_path='main', streaming=True)
+    with pytest.raises(BadlyFormedJSONError):
+        parser.parse()
+
+
+@pytest.mark.parametrize('backend', ['yajl2_c', 'python'])
+def test_streaming_bad_json_utf8(tmpdir, monkeypatch, backend):
+    ijson = pytest.importorskip('ijson')
+    try:
+        monkeypatch.setattr(ijson, 'items', ijson.get_backend(backend).items)
+    except ImportError:
+        pytest.skip('ijson backend {} is not available'.format(backend))
+    test_json = tmpdir.join('test.json')
+    test_json.write_binary(b'{"main": [{"a": "b\xff"}]}')
+    name = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures', 'bad-utf8.json')
+    for json_filename in [test_json.strpath, name]:
+        parser = JSONParser(json_filename=json_filename, root_list_path='main', streaming=True)
+        with pytest.raises(BadlyFormedJSONErrorUTF8):
+            parser.parse()
+    # Other errors aren't UTF-8 errors
+    test_json.write('{"main": [{"a":"b",}]}')
+    parser = JSONParser(json_filename=test_json.strpath, root_list_path='main', streaming=True)
+    with pytest.raises(BadlyFormedJSONError) as excinfo:
+        parser.parse()
+    assert not isinstance(excinfo.value, BadlyFormedJSONErrorUTF8)
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_filters(tmpdir, streaming):
+    if streaming:
+        pytest.importorskip('ijson')
+    test_json = tmpdir.join('test.json')
+    test_json.write('''{"releases": [
+        {"id": "1", "type": "pub", "buyer": {"id": "GB-1"}, "awards": [{"date": "2018-01-01"}, {"date": "2019-03-01"}]},
+        {"id": "2", "type": "pub", "buyer": {"id": "GB-2"}, "awards": [{"date": "2019-03-01"}]},
+        null,
+        {"id": "3", "type": "cafe", "buyer": {"id": "GB-1"}, "awards": [{"date": "2019-06-01"}]},
+        {"id": "4", "type": "pub", "buyer": {"id": "GB-1"}, "awards": [{"date": "2020-01-01"}]},
+        {"id": "5", "type": "pub", "buyer": {"id": "GB-1"}}
+    ]}''')
+
+    def parse(**kwargs):
+        parser = JSONParser(json_filename=test_json.strpath, root_list_path='releases', streaming=streaming, **kwargs)
+        parser.parse()
+        return [line['id'] for line in parser.main_sheet.lines]
+
+    assert parse() == ['1', '2', '3', '4', '5']
+    assert parse(filter_field='type', filter_value='pub') == ['1', '2', '4', '5']
+    assert parse(filters=[('buyer/id', 'eq', 'GB-1')]) == ['1', '3', '4', '5']
+    assert parse(filters=[('buyer/id', 'in', 'GB-2,GB-3')]) == ['2']
+    assert parse(filters=[('buyer/id', 'prefix', 'GB-')]) == ['1', '2', '3', '4', '5']
+    assert parse(filters=[('awards/date', 'from', '2019'), ('awards/date', 'to', '2019-03')]) == ['1', '2']
+    assert parse(filter_field='type', filter_value='pub', filters=[
+        ('buyer/id', 'eq', 'GB-1'),
+        ('awards/date', 'from', '2019'),
+    ]) == ['1', '4']
+
+
+def test_filter_field_exact(tmpdir):
+    # --filter-field and --filter-value match the field at the top level
+    # exactly, unlike an 'eq' filter
+    test_json = tmpdir.join('test.json')
+    test_json.write('''{"releases": [
+        {"id": "1", "number": 1, "tags": ["pub"], "buyer": {"id": "GB-1"}},
+        {"id": "2", "number": "1", "tags": "pub", "buyer/id": "GB-1"}
+    ]}''')
+
+    def parse(**kwargs):
+        parser = JSONParser(json_filename=test_json.strpath, root_list_path='releases', **kwargs)
+        parser.parse()
+        return [line['id'] for line in parser.main_sheet.lines]
+
+    assert parse(filter_field='number', filter_value='1') == ['2']
+    assert parse(filters=[('number', 'eq', '1')]) == ['1', '2']
+    assert parse(filter_field='tags', filter_value='pub') == ['2']
+    assert parse(filters=[('tags', 'eq', 'pub')]) == ['1', '2']
+    assert parse(filter_field='buyer/id', filter_value='GB-1') == ['2']
+    assert parse(filters=[('buyer/id', 'eq', 'GB-1')]) == ['1']
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('root_id', ['ocid', ''])
+def test_id_list(tmpdir, workers, root_id):
+    test_json = tmpdir.join('test.json')
+    test_json.write('''{"releases": [
+        {"ocid": "ocds-1", "id": "1", "awards": [{"id": "a1"}]},
+        {"ocid": "ocds-2", "id": "2", "awards": [{"id": "a2"}]},
+        {"ocid": "ocds-3", "id": 3},
+        null,
+        {"ocid": "ocds-1", "id": "4"}
+    ]}''')
+    id_list = tmpdir.join('id_list.txt')
+    if root_id:
+        id_list.write('ocds-1\nocds-3\n\nocds-5\nocds-0\n')
+    else:
+        id_list.write('1\n3\n\n5\n0\n')
+    parser = JSONParser(json_filename=test_json.strpath, root_list_path='releases', root_id=root_id,
+                        id_list=id_list.strpath, workers=workers)
+    parser.chunk_size = 2
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter('always')
+        parser.parse()
+    if root_id:
+        assert [line['id'] for line in parser.main_sheet.lines] == ['1', 3, '4']
+        assert [line['awards/0/id'] for line in parser.sub_sheets['awards'].lines] == ['a1']
+        assert [text_type(w.message) for w in caught_warnings] == [
+            "You wanted to flatten the following ids which are not present in the input data: ['ocds-0', 'ocds-5']"]
+    else:
+        assert [line['id'] for line in parser.main_sheet.lines] == ['1', 3]
+        assert [text_type(w.message) for w in caught_warnings] == [
+            "You wanted to flatten the following ids which are not present in the input data: ['0', '5']"]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('streaming', [False, True])
+def test_multiple_files(tmpdir, workers, streaming):
+    if streaming:
+        pytest.importorskip('ijson')
+    json_filenames = []
+    for number, json_text in enumerate([
+        '{"releases": [{"ocid": "1", "id": "1", "awards": [{"id": "a1"}]}, {"ocid": "2", "id": "2"}]}',
+        '{"releases": []}',
+        '{"releases": [{"ocid": "3", "id": "3", "extra": "x", "awards": [{"id": "a3", "title": "t"}]}]}',
+    ]):
+        test_json = tmpdir.join('test{}.json'.format(number))
+        test_json.write(json_text)
+        json_filenames.append(test_json.strpath)
+
+    parser = JSONParser(json_filename=json_filenames, root_list_path='releases', workers=workers,
+                        streaming=streaming, source_file_column='source')
+    parser.parse()
+    assert list(parser.main_sheet) == ['source', 'ocid', 'id', 'extra']
+    assert parser.main_sheet.lines == [
+        {'source': json_filenames[0], 'ocid': '1', 'id': '1'},
+        {'source': json_filenames[0], 'ocid': '2', 'id': '2'},
+        {'source': json_filenames[2], 'ocid': '3', 'id': '3', 'extra': 'x'},
+    ]
+    assert list(parser.sub_sheets['awards']) == ['source', 'ocid', 'id', 'awards/0/id', 'awards/0/title']
+    assert parser.sub_sheets['awards'].lines == [
+        {'source': json_filenames[0], 'ocid': '1', 'id': '1', 'awards/0/id': 'a1'},
+        {'source': json_filenames[2], 'ocid': '3', 'id': '3', 'awards/0/id': 'a3', 'awards/0/title': 't'},
+    ]
+
+
+def test_json_lines_chunks(tmpdir):
+    test_json = tmpdir.join('test.jsonl')
+    test_json.write_binary(b'{"a": 1}\n{"a": 22}\n\n{"a": 333}\n{"a": 4}')
+    assert list(json_lines_chunks(test_json.strpath, 12)) == [(0, 19, 1), (19, 31, 3), (31, 39, 5)]
+    assert list(json_lines_chunks(test_json.strpath, 1000)) == [(0, 39, 1)]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_json_lines(tmpdir, workers):
+    test_json = tmpdir.join('test.jsonl')
+    test_json.write(
+        '{"id": "1", "awards": [{"id": "a1"}]}\n'
+        '\n'
+        '{"id": "2", "awards": [{"id": "a2"}, {"id": "a3"}], "value": 1.50}\n'
+        '{"id": "3", "extra": "x"}\n'
+        '{"id": "4", "awards": [{"id": "a4"}, {"id": "a5"}]}\n'
+    )
+    parser = JSONParser(json_filename=test_json.strpath, json_lines=True, rollup=['awards'], workers=workers)
+    parser.json_lines_chunk_size = 10
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter('always')
+        parser.parse()
+    assert list(parser.main_sheet) == ['id', 'awards/0/id', 'value', 'extra']
+    assert [line['id'] for line in parser.main_sheet.lines] == ['1', '2', '3', '4']
+    assert parser.main_sheet.lines[1]['value'] == Decimal('1.50')
+    assert [line['awards/0/id'] for line in parser.sub_sheets['awards'].lines] == ['a1', 'a2', 'a3', 'a4', 'a5']
+    assert [text_type(w.message).split(':')[0] for w in caught_warnings] == ['Line 3', 'Line 5']
+    assert parser.line_number is None
+
+
+@pytest.mark.parametrize('json_decoder', ['stdlib', 'rapidjson'])
+def test_json_decoder(tmpdir, json_decoder):
+    test_json = tmpdir.join('test.json')
+    test_json.write('{"main": [{"id": "1", "value": 1.50, "b": [{"c": 10}]}]}')
+    with warnings.catch_warnings():
+        # A warning is given if rapidjson isn't installed
+        warnings.simplefilter('ignore')
+        parser = JSONParser(json_filename=test_json.strpath, root_list_path='main', json_decoder=json_decoder)
+    parser.parse()
+    assert list(parser.main_sheet) == ['id', 'value']
+    assert repr(parser.main_sheet.lines[0]['value']) == repr(Decimal('1.50'))
+    assert list(parser.sub_sheets['b'].lines) == [{'id': '1', 'b/0/c': 10}]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_raw_numbers(tmpdir, workers):
+    test_json = tmpdir.join('test.json')
+    test_json.write('{"main": [{"id": 1, "value": 1.50, "b": [{"c": 1e5, "d": [0.10000000000000000001, 2]}]}]}')
+    parser = JSONParser(json_filename=test_json.strpath, root_list_path='main', raw_numbers=True, workers=workers)
+    parser.parse()
+    assert list(parser.main_sheet.lines) == [{'id': 1, 'value': '1.50'}]
+    assert type(parser.main_sheet.lines[0]['value']) is RawNumber
+    assert list(parser.sub_sheets['b'].lines) == [{'id': 1, 'b/0/c': '1e5', 'b/0/d': '0.10000000000000000001;2'}]
+
+
+@pytest.mark.parametrize('json_lines', [False, True])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_compressed_input(tmpdir, json_lines, workers):
+    import gzip
+    if json_lines:
+        data = '{"id": "1", "a": [{"b": "c"}]}\n{"id": "2"}\n'
+    else:
+        data = '{"main": [{"id": "1", "a": [{"b": "c"}]}, {"id": "2"}]}'
+    with gzip.open(tmpdir.join('test.json.gz').strpath, 'wb') as gzip_file:
+        gzip_file.write(data.encode('utf-8'))
+    parser = JSONParser(
+        json_filename=tmpdir.join('test.json.gz').strpath, root_list_path='main', json_lines=json_lines,
+        workers=workers)
+    parser.parse()
+    assert [line['id'] for line in parser.main_sheet.lines] == ['1', '2']
+    assert list(parser.sub_sheets['a'].lines) == [{'id': '1', 'a/0/b': 'c'}]
+
+
+def test_json_lines_bad_json(tmpdir):
+    test_json = tmpdir.join('test.jsonl')
+    test_json.write('{"id": "1"}\n{"id": "2",}\n')
+    parser = JSONParser(json_filename=test_json.strpath, json_lines=True)
+    with pytest.raises(BadlyFormedJSONError) as excinfo:
+        parser.parse()
+    assert text_type(excinfo.value).startswith('Line 2: ')
+
+
+@pytest.mark.parametrize('use_schema', [False, True])
+@pytest.mark.parametrize('remove_empty_schema_columns', [False, True])
+def test_workers(tmpdir, use_schema, remove_empty_schema_columns):
+    test_json = tmpdir.join('test.json')
+    test_json.write('''{"releases": [
+        {"ocid": "1", "id": "1", "tender": {"id": "t1", "items": [{"id": "i1", "quantity": 1}]}},
+        {"ocid": "2", "id": "2", "awards": [{"id": "a1", "title": "x"}], "extra": "e"},
+        null,
+        {"ocid": "3", "id": "3", "awards": [{"id": "a2", "title": "y"}, {"id": "a3", "status": "active"}]},
+        {"ocid": "4", "id": "4", "tender": {"items": [{"id": "i2", "unit": {"name": "n"}}]}, "other": [{"a": "b"}]},
+        {"ocid": "5", "id": "5", "date": "2014-11-07"}
+    ]}''')
+    preserve_fields = tmpdir.join('preserve_fields.txt')
+    preserve_fields.write('ocid\nid\ntender/id\ntender/items\nawards\nother\nextra\nnotInTheData\n')
+
+    def parse(workers):
+        if use_schema:
+            schema_parser = SchemaParser(
+                schema_filename='flattentool/tests/fixtures/release-schema.json',
+                rollup=True,
+                root_id='ocid')
+            schema_parser.parse()
+        else:
+            schema_parser = None
+        parser = JSONParser(
+            json_filename=test_json.strpath,
+            root_list_path='releases',
+            schema_parser=schema_parser,
+            rollup=[True] if use_schema else ['awards'],
+            preserve_fields=preserve_fields.strpath,
+            remove_empty_schema_columns=remove_empty_schema_columns,
+            workers=workers)
+        parser.chunk_size = 2
+        with warnings.catch_warnings(record=True) as caught_warnings:
+            warnings.simplefilter('always')
+            parser.parse()
+        return parser, [text_type(w.message) for w in caught_warnings]
+
+    serial_parser, serial_warnings = parse(1)
+    parallel_parser, parallel_warnings = parse(2)
+
+    assert list(parallel_parser.main_sheet) == list(serial_parser.main_sheet)
+    assert parallel_parser.main_sheet.lines == serial_parser.main_sheet.lines
+    assert listify(parallel_parser.sub_sheets) == listify(serial_parser.sub_sheets)
+    for sheet_name, sheet in serial_parser.sub_sheets.items():
+        assert parallel_parser.sub_sheets[sheet_name].lines == sheet.lines
+    assert parallel_parser.seen_paths == serial_parser.seen_paths
+    assert parallel_warnings == serial_warnings
+
+    assert len(serial_parser.main_sheet.lines) == 5
+    assert 'awards' in serial_parser.sub_sheets
+    assert "not present in the input data: ['notInTheData']" in serial_warnings[-1]
+
+
 class TestParseIDs(object):
     def test_parse_ids(self):
         parser = JSONParser(root_json_dict=[OrderedDict([
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import json
 import pytest
 import os
 from flattentool import output, schema
@@ -163,3 +164,280 @@ def test_utf8(tmpdir):
     ])
     release_csv_text = tmpdir.join('release', 'release.csv').read_text(encoding='utf-8')
     assert release_csv_text.strip('\r\n').replace('\r', '') == 'é\néαГ😼𝒞人\ncell2'
+
+
+def output_files(directory):
+    return {
+        path.relto(directory): path.read_binary()
+        for path in directory.visit() if path.isfile()
+    }
+
+
+@pytest.mark.parametrize('schema', [None, 'flattentool/tests/fixtures/release-schema.json'])
+@pytest.mark.parametrize('remove_empty_schema_columns', [False, True])
+@pytest.mark.parametrize('use_titles', [False, True])
+def test_streaming_output_matches(tmpdir, schema, remove_empty_schema_columns, use_titles):
+    from flattentool import flatten
+    if use_titles and not schema:
+        pytest.skip('Titles require a schema')
+    for streaming_output in [False, True]:
+        flatten(
+            input_name='flattentool/tests/fixtures/tenders_releases_2_releases.json',
+            output_name=tmpdir.join(str(streaming_output)).strpath,
+            output_format='all',
+            schema=schema,
+            root_list_path='releases',
+            main_sheet_name='releases',
+            use_titles=use_titles,
+            remove_empty_schema_columns=remove_empty_schema_columns,
+            streaming_output=streaming_output)
+
+    in_memory_csvs = output_files(tmpdir.join('False'))
+    assert in_memory_csvs
+    assert output_files(tmpdir.join('True')) == in_memory_csvs
+    in_memory_wb = openpyxl.load_workbook(tmpdir.join('False.xlsx').strpath)
+    streamed_wb = openpyxl.load_workbook(tmpdir.join('True.xlsx').strpath)
+    assert streamed_wb.sheetnames == in_memory_wb.sheetnames
+    for sheet_name in in_memory_wb.sheetnames:
+        assert ([[cell.value for cell in row] for row in streamed_wb[sheet_name].rows] ==
+                [[cell.value for cell in row] for row in in_memory_wb[sheet_name].rows])
+
+
+def test_streaming_output_fields_not_in_schema(tmpdir):
+    """
+    A single pass is made when there's a schema, so data that is not in the
+    schema means the output has to be written again.
+
+    """
+    from flattentool import flatten
+    input_json = tmpdir.join('input.json')
+    input_json.write('{"main": [{"id": "1", "a": "b"}, {"id": "2", "c": [{"d": "e"}], "f": "g"}]}')
+    schema = tmpdir.join('schema.json')
+    schema.write('{"properties": {"id": {"type": "string"}, "a": {"type": "string"}}}')
+    for streaming_output in [False, True]:
+        flatten(
+            input_name=input_json.strpath,
+            output_name=tmpdir.join(str(streaming_output)).strpath,
+            output_format='csv',
+            schema=schema.strpath,
+            streaming_output=streaming_output)
+
+    streamed_csvs = output_files(tmpdir.join('True'))
+    assert streamed_csvs == output_files(tmpdir.join('False'))
+    assert sorted(streamed_csvs) == ['c.csv', 'main.csv']
+    assert streamed_csvs['main.csv'].replace(b'\r', b'') == b'id,a,f\n1,b,\n2,,g\n'
+
+
+def test_flatten_glob(tmpdir):
+    from flattentool import flatten
+    for number in range(3):
+        tmpdir.join('input{}.json'.format(number)).write('{"main": [{"id": "%s"}]}' % number)
+    tmpdir.join('other.json').write('{"main": [{"id": "other"}]}')
+    flatten(
+        input_name=[tmpdir.join('input*.json').strpath],
+        output_name=tmpdir.join('output').strpath,
+        output_format='csv')
+    assert output_files(tmpdir.join('output'))['main.csv'].replace(b'\r', b'') == b'id\n0\n1\n2\n'
+
+
+@pytest.mark.parametrize('streaming_output', [False, True])
+def test_csv_compression(tmpdir, streaming_output):
+    import gzip
+    import zipfile
+    from flattentool import flatten
+    for csv_compression in [None, 'gzip', 'zip']:
+        flatten(
+            input_name='flattentool/tests/fixtures/tenders_releases_2_releases.json',
+            output_name=tmpdir.join(str(csv_compression)).strpath,
+            output_format='csv',
+            root_list_path='releases',
+            main_sheet_name='releases',
+            streaming_output=streaming_output,
+            csv_compression=csv_compression)
+
+    csvs = output_files(tmpdir.join('None'))
+    assert len(csvs) > 1
+    with zipfile.ZipFile(tmpdir.join('zip.zip').strpath) as zip_file:
+        assert sorted(zip_file.namelist()) == sorted(csvs)
+        for name in csvs:
+            assert zip_file.read(name) == csvs[name]
+    for name in csvs:
+        with gzip.open(tmpdir.join('gzip', name + '.gz').strpath) as gzip_file:
+            assert gzip_file.read() == csvs[name]
+
+
+def test_max_rows(tmpdir):
+    parser = MockParser(['a'], {})
+    parser.main_sheet.lines = [{'a': number} for number in range(5)]
+    for format_name, spreadsheet_output_class in output.FORMATS.items():
+        spreadsheet_output = spreadsheet_output_class(
+            parser=parser,
+            main_sheet_name='release',
+            output_name=os.path.join(tmpdir.strpath, 'release'+output.FORMATS_SUFFIX[format_name]),
+            max_rows=2)
+        spreadsheet_output.write_sheets()
+
+    wb = openpyxl.load_workbook(tmpdir.join('release.xlsx').strpath)
+    assert wb.sheetnames == ['release', 'release_2', 'release_3']
+    assert [[cell.value for cell in row] for row in wb['release_3'].rows] == [['a'], [4]]
+
+    assert output_files(tmpdir.join('release')) == {
+        'release.csv': b'a\r\n0\r\n1\r\n',
+        'release_2.csv': b'a\r\n2\r\n3\r\n',
+        'release_3.csv': b'a\r\n4\r\n',
+    }
+
+
+def test_write_rows_batches(tmpdir, monkeypatch):
+    monkeypatch.setattr(output.SheetParts, 'batch_size', 3)
+    parser = MockParser(['a'], {})
+    parser.main_sheet.lines = [{'a': number} for number in range(10)]
+    output.CSVOutput(parser=parser, output_name=tmpdir.join('release').strpath, max_rows=4).write_sheets()
+    assert output_files(tmpdir.join('release')) == {
+        'main.csv': b'a\r\n0\r\n1\r\n2\r\n3\r\n',
+        'main_2.csv': b'a\r\n4\r\n5\r\n6\r\n7\r\n',
+        'main_3.csv': b'a\r\n8\r\n9\r\n',
+    }
+
+
+@pytest.mark.parametrize('csv_compression', [None, 'gzip', 'zip'])
+def test_output_threads(tmpdir, csv_compression):
+    import gzip
+    import zipfile
+    from flattentool import flatten
+    for output_threads in [1, 4]:
+        flatten(
+            input_name='flattentool/tests/fixtures/tenders_releases_2_releases.json',
+            output_name=tmpdir.join(str(output_threads)).strpath,
+            output_format='all',
+            root_list_path='releases',
+            main_sheet_name='releases',
+            csv_compression=csv_compression,
+            output_threads=output_threads)
+
+    def csv_files(name):
+        if csv_compression == 'zip':
+            with zipfile.ZipFile(tmpdir.join(name + '.zip').strpath) as zip_file:
+                return {member: zip_file.read(member) for member in zip_file.namelist()}
+        if csv_compression == 'gzip':
+            return {member: gzip.decompress(content) for member, content in output_files(tmpdir.join(name)).items()}
+        return output_files(tmpdir.join(name))
+
+    serial_files = csv_files('1')
+    assert len(serial_files) > 1
+    assert csv_files('4') == serial_files
+    assert workbook_cells(tmpdir.join('4.xlsx').strpath) == workbook_cells(tmpdir.join('1.xlsx').strpath)
+
+
+def test_partition_name():
+    assert output.partition_name('ocds-213czf-1') == 'ocds-213czf-1'
+    assert output.partition_name('a/b c') == 'a_b_c'
+    assert output.partition_name(None) == 'none'
+    assert output.partition_name(True) == 'true'
+    assert output.partition_name('ocds-213czf-1', partitions=16) in ['{:02d}'.format(number) for number in range(16)]
+    assert output.partition_output_name('flattened', '01') == 'flattened_01'
+    assert output.partition_output_name('flattened.xlsx', '01') == 'flattened_01.xlsx'
+
+
+@pytest.mark.parametrize('streaming_output', [False, True])
+def test_partitioned_output(tmpdir, streaming_output):
+    from flattentool import flatten
+    tmpdir.join('input.json').write(json.dumps({'main': [
+        {'id': str(number), 'buyer': {'id': 'buyer{}'.format(number % 2)}, 'items': [{'id': 'a'}, {'id': 'b'}]}
+        for number in range(3)
+    ]}))
+    flatten(
+        input_name=tmpdir.join('input.json').strpath,
+        output_name=tmpdir.join('output').strpath,
+        output_format='csv',
+        partition_by='buyer/id',
+        max_rows=3,
+        streaming_output=streaming_output)
+    assert sorted(tmpdir.listdir()) == [tmpdir.join('input.json'), tmpdir.join('output_buyer0'),
+                                        tmpdir.join('output_buyer1')]
+    assert output_files(tmpdir.join('output_buyer0')) == {
+        'main.csv': b'id,buyer/id\r\n0,buyer0\r\n2,buyer0\r\n',
+        'items.csv': b'id,items/0/id\r\n0,a\r\n0,b\r\n2,a\r\n',
+        'items_2.csv': b'id,items/0/id\r\n2,b\r\n',
+    }
+    assert output_files(tmpdir.join('output_buyer1')) == {
+        'main.csv': b'id,buyer/id\r\n1,buyer1\r\n',
+        'items.csv': b'id,items/0/id\r\n1,a\r\n1,b\r\n',
+    }
+
+
+def test_hash_partitioned_output(tmpdir):
+    from flattentool import flatten
+    tmpdir.join('input.json').write(json.dumps({'main': [{'id': str(number)} for number in range(20)]}))
+    flatten(
+        input_name=tmpdir.join('input.json').strpath,
+        output_name=tmpdir.join('output').strpath,
+        output_format='all',
+        partitions=2)
+    assert sorted(path.basename for path in tmpdir.listdir()) == [
+        'input.json', 'output_0', 'output_0.xlsx', 'output_1', 'output_1.xlsx']
+    ids = []
+    for name in ['output_0', 'output_1']:
+        main_csv = output_files(tmpdir.join(name))['main.csv']
+        ids.extend(main_csv.decode('utf-8').split()[1:])
+        wb = openpyxl.load_workbook(tmpdir.join(name + '.xlsx').strpath)
+        assert [row[0].value for row in wb['main'].rows][1:] == main_csv.decode('utf-8').split()[1:]
+    assert sorted(ids, key=int) == [str(number) for number in range(20)]
+
+
+def test_xlsx_illegal_characters(tmpdir, recwarn):
+    parser = MockParser(['a'], {})
+    parser.main_sheet.lines = [{'a': 'bad\x07value'}] * 3 + [{'a': 'good'}]
+    output.XLSXOutput(parser=parser, output_name=tmpdir.join('release.xlsx').strpath).write_sheets()
+
+    wb = openpyxl.load_workbook(tmpdir.join('release.xlsx').strpath)
+    assert [row[0].value for row in wb['main'].rows] == ['a', 'badvalue', 'badvalue', 'badvalue', 'good']
+    # Each distinct string is only checked once
+    assert len([warning for warning in recwarn if 'not allowed' in str(warning.message)]) == 1
+
+
+def workbook_cells(filename):
+    workbook = openpyxl.load_workbook(filename)
+    return [(worksheet.title, [[(cell.value, cell.data_type) for cell in row] for row in worksheet.rows])
+            for worksheet in workbook.worksheets]
+
+
+@pytest.mark.parametrize('streaming_output', [False, True])
+def test_native_xlsx_matches(tmpdir, streaming_output):
+    from flattentool import flatten
+    for output_format in ['xlsx', 'xlsx-native']:
+        flatten(
+            input_name='flattentool/tests/fixtures/tenders_releases_2_releases.json',
+            output_name=tmpdir.join(output_format + '.xlsx').strpath,
+            output_format=output_format,
+            schema='flattentool/tests/fixtures/release-schema.json',
+            root_list_path='releases',
+            main_sheet_name='releases',
+            streaming_output=streaming_output)
+    assert workbook_cells(tmpdir.join('xlsx-native.xlsx').strpath) == workbook_cells(tmpdir.join('xlsx.xlsx').strpath)
+
+
+def test_native_xlsx_values(tmpdir):
+    from decimal import Decimal
+    from flattentool.lib import RawNumber
+    values = ['', ' padded ', '=formula', '=', 'a&b<c>"\'', 'bad\x07', True, False, 0, -3, Decimal('1.50'),
+              Decimal('0.12345678901234567'), RawNumber('1e5'), 12345678901234567890, None, 'é', 'a\r\nb',
+              'x' * 40000]
+    parser = MockParser(['column{}'.format(number) for number in range(len(values))], {'sub "sheet" & <b>': ['a']})
+    parser.main_sheet.lines = [{'column{}'.format(number): value for number, value in enumerate(values)}]
+    for format_name in ['xlsx', 'xlsx-native']:
+        output.FORMATS[format_name](parser=parser, output_name=tmpdir.join(format_name + '.xlsx').strpath).write_sheets()
+    assert workbook_cells(tmpdir.join('xlsx-native.xlsx').strpath) == workbook_cells(tmpdir.join('xlsx.xlsx').strpath)
+
+
+def test_native_xlsx_non_finite_numbers(tmpdir):
+    from decimal import Decimal
+    from flattentool.lib import RawNumber
+    values = [Decimal('1E+400'), Decimal('NaN'), Decimal('-Infinity'), float('inf'), float('nan'), RawNumber('1e400'), 1]
+    parser = MockParser(['column{}'.format(number) for number in range(len(values))], {})
+    parser.main_sheet.lines = [{'column{}'.format(number): value for number, value in enumerate(values)}]
+    for format_name in ['xlsx', 'xlsx-native']:
+        output.FORMATS[format_name](parser=parser, output_name=tmpdir.join(format_name + '.xlsx').strpath).write_sheets()
+    cells = workbook_cells(tmpdir.join('xlsx-native.xlsx').strpath)
+    assert cells == workbook_cells(tmpdir.join('xlsx.xlsx').strpath)
+    assert [value for value, _ in cells[0][1][1]] == [None] * 6 + [1]
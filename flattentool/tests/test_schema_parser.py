@@ -1,7 +1,7 @@
 import pytest
 from collections import OrderedDict
 from six import text_type
-from flattentool.schema import SchemaParser, JsonLoaderLocalRefsDisabled, get_property_type_set
+from flattentool.schema import SchemaParser, JsonLoaderLocalRefsDisabled, get_property_type_set, restricted_paths
 from flattentool.sheet import Sheet
 
 
@@ -30,6 +30,15 @@ def test_get_property_type_set():
     assert get_property_type_set({'type': ['a', 'b']}) == set(['a', 'b'])
 
 
+def test_restricted_paths():
+    paths = restricted_paths(['tender/items/id', 'ocid'])
+    assert paths == set(['', 'tender/', 'ender/', 'nder/', 'der/', 'er/', 'r/', '/',
+                         'tender/items/', 'ender/items/', 'nder/items/', 'der/items/', 'er/items/',
+                         'r/items/', '/items/', 'items/', 'tems/', 'ems/', 'ms/', 's/'])
+    for path in paths:
+        assert any(path in field for field in ['tender/items/id', 'ocid'])
+
+
 def test_filename_and_dict_error(tmpdir):
     """A value error should be raised if both schema_filename and
     root_schema_dict are supplied to SchemaParser"""
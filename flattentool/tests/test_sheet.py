@@ -0,0 +1,48 @@
+from flattentool.sheet import Sheet, SheetLines, StreamedLines
+
+
+def test_sheet_columns():
+    sheet = Sheet(root_id='ocid')
+    sheet.add_field('id', id_field=True)
+    sheet.append('a')
+    sheet.append('b')
+    sheet.append('a')
+    assert list(sheet) == ['ocid', 'id', 'a', 'b']
+    assert 'ocid' in sheet
+    assert 'id' in sheet
+    assert 'b' in sheet
+    assert 'c' not in sheet
+
+    sheet.columns = []
+    assert list(sheet) == ['ocid', 'id']
+    assert 'a' not in sheet
+    sheet.append('b')
+    assert list(sheet) == ['ocid', 'id', 'b']
+    # Indexes don't change
+    assert [sheet.column_index(column) for column in ['id', 'a', 'b', 'c']] == [0, 1, 2, 3]
+
+
+def test_sheet_lines():
+    sheet = Sheet(lines=[{'a': 1, 'b': 2}, {'b': 3}])
+    sheet.lines.append({'a': 4, 'b': 5})
+    sheet.lines.append({'b': 6, 'a': 7})
+    assert isinstance(sheet.lines, SheetLines)
+    assert len(sheet.lines) == 4
+    assert sheet.lines == [{'a': 1, 'b': 2}, {'b': 3}, {'a': 4, 'b': 5}, {'a': 7, 'b': 6}]
+    assert sheet.lines[1] == {'b': 3}
+    assert len(sheet.lines.layouts) == 3
+    assert list(sheet.lines.rows(['b', 'c', 'a', 'b'])) == [
+        [2, None, 1, 2],
+        [3, None, None, 3],
+        [5, None, 4, 5],
+        [6, None, 7, 6],
+    ]
+    assert list(sheet.lines.rows([])) == [[], [], [], []]
+
+
+def test_sheet_streamed_lines():
+    written = []
+    sheet = Sheet(lines=StreamedLines(written.append))
+    sheet.lines.append({'a': 1})
+    assert len(sheet.lines) == 1
+    assert written == [{'a': 1}]
@@ -1,5 +1,9 @@
 from flattentool.json_input import JSONParser
 from flattentool.json_input import lists_of_dicts_paths, dicts_to_list_of_dicts, list_dict_consistency
+from flattentool.xml_input import element_to_dict, prescan_list_paths, xml_schemas_list_paths
+import lxml.etree as ET
+import pytest
+import xmltodict
 
 def test_xml_empty():
     parser = JSONParser(
@@ -141,3 +145,99 @@ def test_xml_whitespace():
         parser.parse()
     except TypeError as e:
         raise e
+
+
+@pytest.mark.parametrize('xml_filename', [
+    'examples/iati/expected.xml',
+    'examples/iati_multilang/expected.xml',
+    'examples/iati_xml_comment/expected.xml',
+    'flattentool/tests/fixtures/empty.xml',
+    'flattentool/tests/fixtures/narrative_whitespace.xml',
+    'flattentool/tests/fixtures/varying_transaction_count.xml',
+])
+def test_xml_streaming(xml_filename):
+    parsers = []
+    for streaming in (False, True):
+        parser = JSONParser(
+            json_filename=xml_filename,
+            root_list_path='iati-activity',
+            schema_parser=None,
+            root_id='',
+            xml=True,
+            id_name='iati-identifier',
+            streaming=streaming)
+        parser.parse()
+        parsers.append(parser)
+    parser, streaming_parser = parsers
+    assert list(streaming_parser.main_sheet) == list(parser.main_sheet)
+    assert streaming_parser.main_sheet.lines == parser.main_sheet.lines
+    assert list(streaming_parser.sub_sheets) == list(parser.sub_sheets)
+    for name, sub_sheet in parser.sub_sheets.items():
+        assert list(streaming_parser.sub_sheets[name]) == list(sub_sheet)
+        assert streaming_parser.sub_sheets[name].lines == sub_sheet.lines
+
+
+def test_element_to_dict():
+    xml = b"""<a xmlns:x="http://example.com/x" xml:lang="en" b="1">
+        text <!-- comment --><c>1</c> more<c x:d="2"/><e/><x:f>3</x:f>
+    </a>"""
+    assert element_to_dict(ET.fromstring(xml), force_list=('e',)) == \
+        xmltodict.parse(xml, force_cdata=True, force_list=('e',))['a']
+
+
+def test_prescan_list_paths(tmpdir):
+    xml_file = tmpdir.join('test.xml')
+    xml_file.write("""<root>
+        <item><a><b/></a><c>1</c><c>2</c></item>
+        <item><a><b><d/></b><b><d/></b></a><e>1</e><e/></item>
+        <item><f><g/><g>1</g></f></item>
+    </root>""")
+    # g is a list, but its first element isn't a dict
+    assert prescan_list_paths(str(xml_file), force_list=('item',)) == \
+        {('item',), ('item', 'a', 'b'), ('item', 'c'), ('item', 'e')}
+
+
+def test_xml_schemas_list_paths():
+    list_paths = xml_schemas_list_paths(
+        ['examples/iati/iati-activities-schema.xsd', 'examples/iati/iati-common.xsd'], 'iati-activity')
+    assert ('iati-activity', 'transaction') in list_paths
+    assert ('iati-activity', 'title', 'narrative') in list_paths
+    assert ('iati-activity', 'iati-identifier') not in list_paths
+    assert ('iati-activity', 'title') not in list_paths
+
+
+def test_xml_streaming_xml_schemas():
+    parser = JSONParser(
+        json_filename='examples/iati/expected.xml',
+        root_list_path='iati-activity',
+        schema_parser=None,
+        root_id='',
+        xml=True,
+        id_name='iati-identifier',
+        streaming=True,
+        xml_schemas=['examples/iati/iati-activities-schema.xsd', 'examples/iati/iati-common.xsd'])
+    parser.parse()
+    # Repeatable elements have their own sheets, even if they appear only once
+    assert 'participating-org' in parser.sub_sheets
+    assert 'transaction' in parser.sub_sheets
+    assert 'participating-org/@ref' not in list(parser.main_sheet)
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_xml_filters(streaming):
+    parser = JSONParser(
+        json_filename='examples/iati/expected.xml',
+        root_list_path='iati-activity',
+        schema_parser=None,
+        root_id='',
+        xml=True,
+        id_name='iati-identifier',
+        streaming=streaming,
+        filters=[
+            ('activity-status/@code', 'eq', '2'),
+            ('transaction/transaction-date/@iso-date', 'from', '2012-03'),
+            ('title/narrative', 'prefix', 'A '),
+        ])
+    parser.parse()
+    assert [line['iati-identifier'] for line in parser.main_sheet.lines] == ['AA-AAA-123456789-ABC123']
+    assert len(parser.sub_sheets['transaction'].lines) == 2
@@ -0,0 +1,234 @@
+"""
+Read the root list of an XML file for flatten one element at a time, using
+lxml's iterparse, instead of reading the whole file with xmltodict (see
+json_input.JSONParser).
+
+Elements are converted to the same dicts that xmltodict.parse gives with
+force_cdata=True. Which paths are lists (see json_input.list_dict_consistency)
+is found either from XML schemas, or from a first pass over the file that
+keeps only one element at a time in memory.
+
+"""
+
+from collections import OrderedDict
+import lxml.etree as ET
+import six
+
+from flattentool.compression import open_input
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+
+
+def qualified_name(name, nsmap):
+    """
+    Return an lxml tag or attribute name ('{uri}local') as it was written in
+    the XML (i.e. 'prefix:local'), which is how xmltodict gives it.
+
+    """
+    if name[0] != '{':
+        return name
+    uri, local_name = name[1:].split('}', 1)
+    if uri == XML_NAMESPACE:
+        return 'xml:' + local_name
+    for prefix, prefix_uri in nsmap.items():
+        if prefix_uri == uri and prefix is not None:
+            return prefix + ':' + local_name
+    return local_name
+
+
+def element_data(element):
+    """Return all the text directly in element, stripped, or None."""
+    data = [element.text or '']
+    for child in element:
+        data.append(child.tail or '')
+    return ''.join(data).strip() or None
+
+
+def element_attributes(element):
+    attributes = OrderedDict()
+    parent = element.getparent()
+    parent_nsmap = parent.nsmap if parent is not None else {}
+    for prefix, uri in element.nsmap.items():
+        if parent_nsmap.get(prefix) != uri:
+            attributes['@xmlns:' + prefix if prefix else '@xmlns'] = uri
+    for name, value in element.attrib.items():
+        attributes['@' + qualified_name(name, element.nsmap)] = value
+    return attributes
+
+
+def element_to_dict(element, force_list=()):
+    """
+    Return element converted the way xmltodict.parse(..., force_cdata=True,
+    force_list=force_list) would.
+
+    """
+    item = element_attributes(element) or None
+    for child in element:
+        if not isinstance(child.tag, six.string_types):
+            # Comments and processing instructions
+            continue
+        key = qualified_name(child.tag, child.nsmap)
+        value = element_to_dict(child, force_list)
+        if item is None:
+            item = OrderedDict()
+        if key in item:
+            if isinstance(item[key], list):
+                item[key].append(value)
+            else:
+                item[key] = [item[key], value]
+        elif key in force_list:
+            item[key] = [value]
+        else:
+            item[key] = value
+    data = element_data(element)
+    if data:
+        if item is None:
+            item = OrderedDict()
+        item['#text'] = data
+    return item
+
+
+def element_path_values(element, path):
+    """
+    Return the values at path (a list of keys, as in the dicts element_to_dict
+    gives) below element, without converting it to a dict. Elements are given
+    as their text, see element_data.
+
+    """
+    elements = [element]
+    for key in path[:-1]:
+        elements = [
+            child for parent in elements for child in parent
+            if isinstance(child.tag, six.string_types) and qualified_name(child.tag, child.nsmap) == key
+        ]
+    key = path[-1]
+    values = []
+    for parent in elements:
+        if key.startswith('@'):
+            for name, value in parent.attrib.items():
+                if qualified_name(name, parent.nsmap) == key[1:]:
+                    values.append(value)
+        elif key == '#text':
+            values.append(element_data(parent))
+        else:
+            for child in parent:
+                if isinstance(child.tag, six.string_types) and qualified_name(child.tag, child.nsmap) == key:
+                    values.append(element_data(child))
+    return values
+
+
+def iterparse(xml_filename):
+    """
+    Yield ('start', element) and ('end', element) for each element of the
+    file (which may be compressed, see compression.open_input).
+
+    """
+    with open_input(xml_filename) as xml_file:
+        for event, element in ET.iterparse(xml_file, events=('start', 'end')):
+            yield event, element
+
+
+def remove_previous_siblings(element):
+    parent = element.getparent()
+    while element.getprevious() is not None:
+        del parent[0]
+
+
+def prescan_list_paths(xml_filename, force_list=()):
+    """
+    Return the set of paths (tuples of keys, below the root element) that are
+    lists of dicts anywhere in the file, i.e. the paths that
+    json_input.list_dict_consistency would find, by reading through the file
+    once without keeping it in memory.
+
+    """
+    # For each open element, the children seen so far:
+    # tag -> [count, whether the first is a dict, list paths below them]
+    stack = []
+    # Whether each open element has any text
+    has_data = []
+    list_paths = set()
+    for event, element in iterparse(xml_filename):
+        if event == 'start':
+            stack.append(OrderedDict())
+            has_data.append(False)
+            continue
+
+        children = stack.pop()
+        element_has_data = has_data.pop() or bool(element_data(element))
+        is_dict = bool(element_has_data or children or element_attributes(element))
+        paths = set()
+        for key, (count, first_is_dict, child_paths) in children.items():
+            if first_is_dict:
+                if count > 1 or key in force_list:
+                    paths.add((key,))
+                paths.update((key,) + path for path in child_paths)
+
+        if not stack:
+            list_paths = paths
+            break
+        key = qualified_name(element.tag, element.nsmap)
+        if key not in stack[-1]:
+            stack[-1][key] = [0, is_dict, set()]
+        stack[-1][key][0] += 1
+        if is_dict:
+            stack[-1][key][2].update(paths)
+
+        # Only the text of the parent is needed from here on (the tail of
+        # this element isn't complete yet, but any before it are).
+        for sibling in element.itersiblings(preceding=True):
+            if sibling.tail and sibling.tail.strip():
+                has_data[-1] = True
+        element.clear(keep_tail=True)
+        remove_previous_siblings(element)
+    return list_paths
+
+
+def xml_schemas_list_paths(xml_schemas, root_list_path):
+    """
+    Return the set of paths (tuples of keys, below the root element) that can
+    have more than one element, according to the XML schemas.
+
+    """
+    from flattentool.sort_xml import XMLSchemaWalker
+    root_list_keys = tuple(root_list_path.split('/'))
+    walker = XMLSchemaWalker(xml_schemas)
+    return set(root_list_keys + path for path in walker.list_paths(root_list_keys[-1]))
+
+
+def iter_xml_root_list(xml_filename, root_list_path, xml_schemas=None, record_filter=None):
+    """
+    Yield the elements of the root list of the XML file, converted as
+    xmltodict would with json_input.list_dict_consistency applied. Only one
+    element is kept in memory at a time.
+
+    If record_filter (a filters.RecordFilter) is given, elements that don't
+    match it are skipped before they are converted.
+
+    """
+    from flattentool.json_input import dicts_to_list_of_dicts
+
+    force_list = (root_list_path,)
+    root_list_keys = root_list_path.split('/')
+    if xml_schemas:
+        list_paths = xml_schemas_list_paths(xml_schemas, root_list_path)
+    else:
+        list_paths = prescan_list_paths(xml_filename, force_list=force_list)
+
+    path = []
+    for event, element in iterparse(xml_filename):
+        if event == 'start':
+            path.append(qualified_name(element.tag, element.nsmap))
+            continue
+
+        if path[1:] == root_list_keys:
+            if record_filter is None or record_filter.matches(lambda keys: element_path_values(element, keys)):
+                item = element_to_dict(element, force_list=force_list)
+                if item is not None:
+                    dicts_to_list_of_dicts(list_paths, item, path=tuple(root_list_keys))
+                yield item
+        path.pop()
+        if len(path) <= len(root_list_keys) and path:
+            # Outside of the root list elements nothing needs keeping
+            element.clear(keep_tail=True)
+            remove_previous_siblings(element)
@@ -18,6 +18,8 @@ setup(
     description='Tools for generating CSV and other flat versions of the structured data',
     install_requires=install_requires,
     extras_require = {
-        'HTTP': ['requests']
+        'HTTP': ['requests'],
+        'streaming': ['ijson>=3.1; python_version >= "3.5"'],
+        'rapidjson': ['python-rapidjson; python_version >= "3.7"'],
     }
 )